@@ -0,0 +1,308 @@
+import ctypes
+import gc
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+
+import export
+import struct2seq
+import synthetic
+import utils
+from protein_features import gather_nodes
+
+
+COMPONENTS = ("features", "encoder_layer", "ipa", "decoder", "crf_loss", "crf_decode", "train_step", "sample", "sample_loop", "mask_predict")
+# model loading timed in a fresh process, the imports are done before the clock starts
+COLD_START = {
+    # meta device model + memory-mapped tensors, exported weights or a training checkpoint
+    "load_model": "model = export.load_model(path)",
+    # unpickle the whole training checkpoint, initialize TMPNN and copy the weights into it
+    "torch_load": "checkpoint = torch.load(path, map_location='cpu', weights_only=False)\n"
+                  "model = struct2seq.TMPNN(device=torch.device('cpu'), **export.model_hyperparams(checkpoint['hyperparams']))\n"
+                  "model.load_state_dict(checkpoint['model_state_dict'])\n"
+                  "model.eval()",
+}
+COLD_START_SCRIPT = '''
+import json, resource, sys, time
+import torch
+import export, struct2seq
+path = sys.argv[1]
+# imports done, wait until the parent has (optionally) emptied the page cache
+print("ready", flush=True)
+sys.stdin.readline()
+start = time.perf_counter()
+{}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"time_ms": 1000 * elapsed, "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}}))
+'''
+
+
+def _rss():
+    """ Resident set size of this process in bytes """
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def _release_memory():
+    gc.collect()
+    try:
+        # hand the freed heap back to the OS so that the next baseline RSS is not inflated (glibc only)
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+class PeakMemory:
+    """
+    Peak memory above the level at entry
+    cuda : allocator statistics, cpu : RSS sampled from /proc/self/statm by a background thread
+    """
+    def __init__(self, device, interval=0.0005):
+        self.device = device
+        self.interval = interval
+        self.peak = 0
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self._max = max(self._max, _rss())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        _release_memory()
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            self._base = torch.cuda.memory_allocated(self.device)
+        else:
+            self._base = self._max = _rss()
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+            self.peak = torch.cuda.max_memory_allocated(self.device) - self._base
+        else:
+            self._stop.set()
+            self._thread.join()
+            self.peak = max(self._max, _rss()) - self._base
+        return False
+
+
+def _synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def measure(function, device, repeats=5, warmup=1):
+    """
+    Peak memory of the first call, then the wall time of repeats calls after warmup more calls
+    Output :
+    {"peak_mb", "time_ms", "time_ms_min", "time_ms_std"}
+    """
+    with PeakMemory(device) as memory:
+        function()
+    for _ in range(warmup):
+        function()
+    times = []
+    for _ in range(repeats):
+        _synchronize(device)
+        start = time.perf_counter()
+        function()
+        _synchronize(device)
+        times.append(1000 * (time.perf_counter() - start))
+    return {
+        "peak_mb": memory.peak / 2 ** 20,
+        "time_ms": statistics.median(times),
+        "time_ms_min": min(times),
+        "time_ms_std": statistics.pstdev(times),
+    }
+
+
+def helix_backbone(batch_size, length, device, seed=0):
+    """ Synthetic membrane helix bundles X [B, L, 5, 3] (N, CA, C, CB, O) """
+    rng = np.random.default_rng(seed)
+    X = [np.stack([coords[atom] for atom in synthetic.ATOMS], -2) for coords in
+         (synthetic.helix_bundle(length, rng) for _ in range(batch_size))]
+    return torch.tensor(np.stack(X), dtype=torch.float32, device=device)
+
+
+def run_config(model, optimizer, length, batch_size, components, device, repeats, warmup, sample_max_length):
+    """ Measure every component on one batch of batch_size helices of length residues """
+    X = helix_backbone(batch_size, length, device)
+    S = torch.randint(0, 20, (batch_size, length), device=device)
+    C = torch.randint(0, model.num_tags, (batch_size, length), device=device)
+    mask = torch.ones(batch_size, length, dtype=torch.float32, device=device)
+    L = torch.full((batch_size, 1), length, dtype=torch.long, device=device)
+
+    model.eval()
+    with torch.no_grad():
+        V, E, E_idx, r = model.features(X, mask, L, device)
+        h_V, h_E = model.W_v(V), model.W_e(E)
+        mask_attend = gather_nodes(mask.unsqueeze(-1), E_idx).squeeze(-1)
+        mask_attend = mask.unsqueeze(-1) * mask_attend
+        h_S = model.W_seq(S)
+        logits_cctop = torch.randn(batch_size, length, model.num_tags, device=device)
+
+    def train_step():
+        model.train()
+        optimizer.zero_grad(set_to_none=True)
+        log_probs_seq, logits = model(X, S, S, L, mask, device=device)
+        _, loss_av_smoothed = utils.loss_smoothed(S, log_probs_seq, mask, weight=0.05, num_classes=22)
+        loss = 0.2 * model.neg_loss_crf(logits, C, mask) + loss_av_smoothed
+        loss.backward()
+        optimizer.step()
+        model.eval()
+
+    functions = {
+        "features": lambda: model.features(X, mask, L, device),
+        "ipa": lambda: model.ipa(h_V, h_E, r, mask, E_idx),
+        "decoder": lambda: model.decode(h_V, h_E, E_idx, h_S, mask),
+        "crf_loss": lambda: model.neg_loss_crf(logits_cctop, C, mask),
+        "crf_decode": lambda: model.decode_crf(logits_cctop, mask),
+        "train_step": train_step,
+        "sample": lambda: model.sample(X, L, mask, temperature=0.1),
+        # reference loop without the key/value caches
+        "sample_loop": lambda: model.sample(X, L, mask, temperature=0.1, incremental=False),
+        "mask_predict": lambda: model.mask_predict(X, L, mask, iterations=5),
+    }
+    for i, layer in enumerate(model.Encoder):
+        functions[f"encoder_layer{i}"] = lambda layer=layer: layer(h_V, h_E, None, E_idx, mask, mask_attend)
+
+    results = []
+    for name, function in functions.items():
+        if name.rstrip("0123456789") not in components:
+            continue
+        sequential = name.startswith("sample")
+        if sequential and length > sample_max_length:
+            continue
+        grad = torch.enable_grad() if name == "train_step" else torch.no_grad()
+        with grad:
+            result = measure(function, device, repeats=1 if sequential else repeats, warmup=0 if sequential else warmup)
+        result.update(component=name, length=length, batch_size=batch_size, tokens=length * batch_size,
+                      residues_per_second=1000 * length * batch_size / result["time_ms"])
+        results.append(result)
+        print(f"{name:16s} L={length:5d} B={batch_size:3d} {result['time_ms']:10.2f} ms {result['peak_mb']:10.1f} MB", flush=True)
+    return results
+
+
+def drop_caches():
+    """ Empty the page cache, Linux and root only """
+    os.sync()
+    with open("/proc/sys/vm/drop_caches", "w") as f:
+        f.write("3\n")
+
+
+def cold_start(method, path, repeats, cold=False):
+    """
+    Time of COLD_START[method] on path, median of repeats fresh processes
+    cold : empty the page cache before every load, otherwise the file is read from memory after the first run
+    Output :
+    {"component", "method", "path", "file_mb", "cold", "time_ms", "time_ms_min", "max_rss_mb"}
+    """
+    script = COLD_START_SCRIPT.format(COLD_START[method])
+    runs = []
+    for _ in range(repeats):
+        process = subprocess.Popen([sys.executable, "-c", script, path], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        process.stdout.readline()
+        if cold:
+            drop_caches()
+        output, _ = process.communicate("\n")
+        if process.returncode != 0:
+            raise RuntimeError(f"cold start of {method} on {path} failed")
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    times = [run["time_ms"] for run in runs]
+    return {
+        "component": "cold_start",
+        "method": method,
+        "path": path,
+        "file_mb": os.path.getsize(path) / 2 ** 20,
+        "cold": cold,
+        "time_ms": statistics.median(times),
+        "time_ms_min": min(times),
+        "max_rss_mb": statistics.median(run["max_rss_mb"] for run in runs),
+    }
+
+
+def environment(device):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "device": str(device),
+        "threads": torch.get_num_threads(),
+    }
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Time and peak memory of the TMPNN components')
+    parser.add_argument('--checkpoint', type=str, default=None, help='exported weights or training checkpoint, default is a randomly initialized TMPNN')
+    parser.add_argument('--device', type=str, default="cpu")
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    parser.add_argument('--lengths', type=int, nargs='+', default=[50, 100, 200, 500, 1000, 2000])
+    parser.add_argument('--token_budgets', type=int, nargs='+', default=[0, 2000, 8000], help='tokens per batch, batch size = budget // length (at least 1), 0 is one structure')
+    parser.add_argument('--components', type=str, nargs='+', default=list(COMPONENTS), choices=COMPONENTS)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--sample_max_length', type=int, default=500, help='the samplers are sequential in L, longer chains are skipped')
+    parser.add_argument('--output', type=str, default="benchmark.jsonl", help='one JSON record per component and shape, appended')
+    parser.add_argument('--checkpoint_layers', type=int, nargs=3, default=[0, 0, 0], metavar=('ENCODER', 'IPA', 'DECODER'),
+                        help='activation checkpointing of train_step, every N-th layer of the encoder / ipa / decoder stage, 0 disables')
+    parser.add_argument('--cold_start', type=str, nargs='+', default=None, metavar='PATH',
+                        help='only time the model loading in fresh processes: a training checkpoint (torch.load + TMPNN + load_state_dict '
+                             'and export.load_model), then any exported weights (export.load_model)')
+    parser.add_argument('--drop_caches', action='store_true', help='empty the page cache before every cold start load (Linux, root)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.cold_start is not None:
+        env = environment(torch.device("cpu"))
+        print(env)
+        with open(args.output, "a") as f:
+            for i, path in enumerate(args.cold_start):
+                for method in (("torch_load", "load_model") if i == 0 else ("load_model",)):
+                    result = cold_start(method, path, args.repeats, args.drop_caches)
+                    print(f"{method:12s} {'cold' if args.drop_caches else 'warm'} {result['file_mb']:8.1f} MB file {result['time_ms']:10.1f} ms {result['max_rss_mb']:10.1f} MB max RSS  {path}", flush=True)
+                    f.write(json.dumps(dict(env, **result)) + "\n")
+        sys.exit(0)
+
+    torch.manual_seed(args.seed)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+    if args.checkpoint is not None:
+        model = export.load_model(args.checkpoint, device)
+    else:
+        model = struct2seq.TMPNN(device=device, dropout=0.).to(device)
+    model.checkpoint_encoder, model.checkpoint_ipa, model.checkpoint_decoder = args.checkpoint_layers
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    env = dict(environment(device), checkpoint_layers=args.checkpoint_layers)
+    print(env)
+
+    with open(args.output, "a") as f:
+        for length in args.lengths:
+            batch_sizes = sorted({max(1, budget // length) for budget in args.token_budgets})
+            for batch_size in batch_sizes:
+                for result in run_config(model, optimizer, length, batch_size, args.components, device,
+                                         args.repeats, args.warmup, args.sample_max_length):
+                    f.write(json.dumps(dict(env, **result)) + "\n")
+                f.flush()
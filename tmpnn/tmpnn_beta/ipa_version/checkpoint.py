@@ -0,0 +1,119 @@
+import json
+import os
+import queue
+import threading
+
+import torch
+
+
+def snapshot(state):
+    """
+    Copy every tensor of a (nested) state dict to the cpu, the copy is decoupled from further training steps
+    """
+    if torch.is_tensor(state):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {k: snapshot(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(v) for v in state)
+    return state
+
+
+def atomic_save(obj, path, save=torch.save):
+    """ Write to a temporary file in the same folder and rename it, a crash never leaves a truncated file """
+    tmp = path + ".tmp"
+    save(obj, tmp)
+    os.replace(tmp, path)
+
+
+def _save_json(obj, path):
+    with open(path, "w") as f:
+        json.dump(obj, f, indent=1)
+
+
+def find_resume(folder):
+    """ Most recent of the latest epoch checkpoint (manifest.json) and the mid-epoch resume.pt, None if neither exists """
+    candidates = [os.path.join(folder, "resume.pt")]
+    manifest_path = os.path.join(folder, "manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            candidates.append(json.load(f)["latest"])
+    candidates = [p for p in candidates if p is not None and os.path.exists(p)]
+    return max(candidates, key=os.path.getmtime) if candidates else None
+
+
+class AsyncCheckpointWriter:
+    """
+    Save checkpoints from a background thread
+    save() snapshots the state to the cpu on the calling thread, serialization and disk io happen on the
+    writer thread. Only the keep best checkpoints by metric (lower is better, e.g. validation perplexity)
+    and the latest one are kept, manifest.json in the folder records them.
+    """
+    def __init__(self, folder, keep=3):
+        self.folder = folder
+        self.keep = keep
+        os.makedirs(folder, exist_ok=True)
+        self.manifest_path = os.path.join(folder, "manifest.json")
+        # [{"path", "metric"}], latest path
+        self.checkpoints, self.latest = [], None
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            self.checkpoints, self.latest = manifest["checkpoints"], manifest["latest"]
+        self.queue = queue.Queue(maxsize=2)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self, state, name, metric):
+        """
+        state  : dict of state dicts / python objects
+        name   : file name inside the folder
+        metric : lower is better, None writes the file without retention (e.g. the mid-epoch resume.pt)
+        """
+        if self.error is not None:
+            raise self.error
+        # blocks if two checkpoints are still being written
+        self.queue.put((snapshot(state), os.path.join(self.folder, name), None if metric is None else float(metric)))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            state, path, metric = item
+            try:
+                atomic_save(state, path)
+                if metric is not None:
+                    self._retain(path, metric)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def _retain(self, path, metric):
+        self.checkpoints = [c for c in self.checkpoints if c["path"] != path] + [{"path": path, "metric": metric}]
+        self.checkpoints.sort(key=lambda c: c["metric"])
+        kept = self.checkpoints[:self.keep]
+        removed = [c for c in self.checkpoints[self.keep:] if c["path"] != path]
+        self.checkpoints = kept + ([{"path": path, "metric": metric}] if path not in [c["path"] for c in kept] else [])
+        self.latest = path
+        atomic_save({"checkpoints": self.checkpoints, "latest": self.latest}, self.manifest_path, save=_save_json)
+        for c in removed:
+            if os.path.exists(c["path"]):
+                os.remove(c["path"])
+
+    def best(self):
+        """ Path of the best checkpoint written so far """
+        self.wait()
+        return min(self.checkpoints, key=lambda c: c["metric"])["path"] if self.checkpoints else None
+
+    def wait(self):
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
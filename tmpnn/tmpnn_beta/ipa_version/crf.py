@@ -0,0 +1,121 @@
+import torch
+import torch.nn as nn
+
+
+# log semiring identity off the diagonal, finite so that the float32 log-sum-exp never sees inf - inf
+NEG_INF = -1e9
+
+
+def viterbi_decode(emissions, mask, start_transitions, end_transitions, transitions):
+    """
+    Batched Viterbi decoding on device, same paths as torchcrf.CRF.decode (ties go to the first tag)
+    Input :
+    emissions   [B, L, C] (batch_first)
+    mask        [B, L]    1 for the residues, the first residue of every sequence must be unmasked
+    start_transitions, end_transitions [C], transitions [C, C]
+    Output :
+    tags [B, L] LongTensor, padding positions are 0
+    """
+    B, L, C = emissions.shape
+    mask = mask > 0
+    # score [B, C] : best score of the paths ending in each tag
+    score = start_transitions + emissions[:, 0]
+    history = []
+    for i in range(1, L):
+        next_score, indices = (score.unsqueeze(2) + transitions + emissions[:, i].unsqueeze(1)).max(dim=1)
+        score = torch.where(mask[:, i].unsqueeze(1), next_score, score)
+        history.append(indices)
+    score = score + end_transitions
+    best_last = score.argmax(dim=1)
+    seq_ends = mask.long().sum(dim=1) - 1
+
+    # backtracking without leaving the device
+    tags = torch.zeros((B, L), dtype=torch.long, device=emissions.device)
+    tag = best_last
+    for i in range(L - 1, -1, -1):
+        inside = i <= seq_ends
+        tag = torch.where(i == seq_ends, best_last, tag)
+        tags[:, i] = torch.where(inside, tag, 0)
+        if i > 0:
+            tag = torch.where(inside, history[i - 1].gather(1, tag.unsqueeze(1)).squeeze(1), tag)
+    return tags
+
+
+def log_matmul(A, B):
+    """ Matrix product in the log semiring, A [..., C, C] B [..., C, C] """
+    return torch.logsumexp(A.unsqueeze(-1) + B.unsqueeze(-3), dim=-2)
+
+
+class CRF(nn.Module):
+    """
+    Linear chain CRF with the parameters (and state_dict keys) of torchcrf.CRF, always batch_first
+    The partition function is a tree reduction of the per step transfer matrices in the log semiring,
+    log2(L) parallel steps instead of a Python loop over the length, computed in float32 under autocast.
+    """
+    def __init__(self, num_tags, batch_first=True):
+        super().__init__()
+        assert batch_first, "only batch_first CRF is supported"
+        self.num_tags = num_tags
+        self.batch_first = batch_first
+        self.start_transitions = nn.Parameter(torch.empty(num_tags))
+        self.end_transitions = nn.Parameter(torch.empty(num_tags))
+        self.transitions = nn.Parameter(torch.empty(num_tags, num_tags))
+        nn.init.uniform_(self.start_transitions, -0.1, 0.1)
+        nn.init.uniform_(self.end_transitions, -0.1, 0.1)
+        nn.init.uniform_(self.transitions, -0.1, 0.1)
+
+    def forward(self, emissions, tags, mask=None, reduction="sum"):
+        """
+        Log likelihood of tags
+        Input :
+        emissions [B, L, C]
+        tags      [B, L]
+        mask      [B, L] 1 for the residues, the first residue of every sequence must be unmasked
+        reduction : none | sum | mean | token_mean
+        """
+        if mask is None:
+            mask = torch.ones(tags.shape, device=tags.device)
+        with torch.autocast(device_type=emissions.device.type, enabled=False):
+            emissions, mask = emissions.float(), mask.float()
+            llh = self._score(emissions, tags, mask) - self._partition(emissions, mask)
+        if reduction == "none":
+            return llh
+        if reduction == "sum":
+            return llh.sum()
+        if reduction == "mean":
+            return llh.mean()
+        return llh.sum() / mask.sum()
+
+    @torch.no_grad()
+    def decode(self, emissions, mask=None):
+        """
+        Viterbi path [B, L] LongTensor, padding positions are 0
+        """
+        if mask is None:
+            mask = torch.ones(emissions.shape[:2], device=emissions.device)
+        with torch.autocast(device_type=emissions.device.type, enabled=False):
+            return viterbi_decode(emissions.float(), mask, self.start_transitions, self.end_transitions, self.transitions)
+
+    def _score(self, emissions, tags, mask):
+        """ Score of the given paths [B] """
+        seq_ends = mask.long().sum(dim=1) - 1
+        score = self.start_transitions[tags[:, 0]]
+        score = score + torch.sum(emissions.gather(2, tags.unsqueeze(-1)).squeeze(-1) * mask, dim=1)
+        score = score + torch.sum(self.transitions[tags[:, :-1], tags[:, 1:]] * mask[:, 1:], dim=1)
+        return score + self.end_transitions[tags.gather(1, seq_ends.unsqueeze(1)).squeeze(1)]
+
+    def _partition(self, emissions, mask):
+        """ log Z [B] """
+        B, L, C = emissions.shape
+        alpha = self.start_transitions + emissions[:, 0]
+        if L > 1:
+            # transfer matrix of step i : M_i[j, k] = transitions[j, k] + emissions[i, k], identity for padding
+            identity = torch.full((C, C), NEG_INF, device=emissions.device).fill_diagonal_(0.)
+            M = self.transitions + emissions[:, 1:].unsqueeze(2)
+            M = torch.where(mask[:, 1:, None, None] > 0, M, identity)
+            while M.size(1) > 1:
+                if M.size(1) % 2 == 1:
+                    M = torch.cat([M, identity.expand(B, 1, C, C)], dim=1)
+                M = log_matmul(M[:, 0::2], M[:, 1::2])
+            alpha = torch.logsumexp(alpha.unsqueeze(-1) + M[:, 0], dim=1)
+        return torch.logsumexp(alpha + self.end_transitions, dim=1)
@@ -33,15 +33,35 @@ restypes = [
     "V",
 ]
 restype_order = {restype: i for i, restype in enumerate(restypes)}
+# cctop topology labels, T is merged into S
+cctop_code = 'IMOULS'
+
+
+def aa_bias(bias_AA="", omit_AAs=""):
+    """
+    Amino acid logit bias and omit list of the command line options of the design scripts
+    bias_AA  : e.g. "A=-0.5,W=1.0"
+    omit_AAs : e.g. "CM", omitting all 20 amino acids is a ValueError since nothing could be sampled
+    Output :
+    bias [20] float, omit [20] bool
+    """
+    bias = torch.zeros(20)
+    for item in filter(None, bias_AA.split(',')):
+        aa, value = item.split('=')
+        bias[restype_order[aa.strip()]] = float(value)
+    omit = torch.tensor([aa in omit_AAs for aa in restypes])
+    if bool(omit.all()):
+        raise ValueError(f"omit_AAs '{omit_AAs}' omits all 20 amino acids")
+    return bias, omit
 
 class StructureDataset(Dataset):
-    def __init__(self,jsonl_file,max_length=500,low_fraction=0.7,high_fraction=0.9):
-        dataset = utils.load_jsonl(jsonl_file)
+    def __init__(self,jsonl_file=None,max_length=500,low_fraction=0.7,high_fraction=0.9,entries=None):
+        # entries : already loaded jsonl records (e.g. synthetic.generate), used instead of jsonl_file
+        dataset = utils.load_jsonl(jsonl_file) if entries is None else entries
         for i in dataset:
             if i['name'].startswith("AF"):
                 i['name'] += "_A"
             i['cctop'] = i['cctop'].replace("T","S") #替换减少一类
-        cctop_code = 'IMOULS'
         self.data = []
         self.discard = {"bad_chars":0,"too_long":0}
         for entry in dataset:
@@ -134,17 +154,47 @@ def StructureDataloader(dataset,batch_size,num_workers=0,shuffle=True):
     """
     return DataLoader(dataset,batch_size=batch_size,num_workers=num_workers,shuffle=shuffle,collate_fn=batch_collate_function)
 
-def StructureTokenloader(dataset,batch_size,num_workers=0,shuffle=True):
+def StructureTokenloader(dataset,batch_size,num_workers=0,shuffle=True,num_replicas=1,rank=0,seed=0):
     """
     A wrap up batch token dataloader,the batch_size is the number of tokens
+    num_replicas > 1 shards the batches over the ranks of a distributed run
+    call loader.batch_sampler.set_epoch(epoch) every epoch, the batch order is fixed by seed + epoch
     """
     lengths = [len(i['seq']) for i in dataset]
-    return DataLoader(dataset,num_workers=num_workers,batch_sampler=StructureBatchSampler(lengths,batch_size=batch_size,shuffle=shuffle),collate_fn=batch_collate_function)
+    if num_replicas > 1:
+        sampler = DistributedStructureBatchSampler(lengths,batch_size=batch_size,num_replicas=num_replicas,rank=rank,shuffle=shuffle,seed=seed)
+    else:
+        sampler = StructureBatchSampler(lengths,batch_size=batch_size,shuffle=shuffle,seed=seed)
+    # own generator : creating an iterator does not draw from the global torch RNG, so a resumed run sees the same random stream
+    return DataLoader(dataset,num_workers=num_workers,batch_sampler=sampler,collate_fn=batch_collate_function,generator=torch.Generator().manual_seed(seed))
+
+def accumulate_batches(loader, tokens_per_step=0, num_batches=None):
+    """
+    Group the batches of a token loader into optimizer steps of at least tokens_per_step real residues
+    tokens_per_step = 0 gives one batch per optimizer step
+    num_batches : fixed number of batches per step instead, distributed ranks must all take the same steps
+    Output :
+    list of collated batches (still on the cpu) per optimizer step
+    """
+    group, tokens = [], 0
+    for batch in loader:
+        group.append(batch)
+        tokens += int(torch.sum(batch["mask"]))
+        if (len(group) >= num_batches) if num_batches is not None else (tokens >= tokens_per_step):
+            yield group
+            group, tokens = [], 0
+    if len(group) > 0:
+        yield group
 
 class StructureBatchSampler(Sampler):
-    def __init__(self,lengths,batch_size,shuffle=True):
+    def __init__(self,lengths,batch_size,shuffle=True,seed=0):
         self.lengths = lengths
         self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        # the order of an epoch only depends on seed + epoch, start skips the batches already done (resume)
+        self.epoch = 0
+        self.start = 0
         sorted_ix = np.argsort(self.lengths)
         # Cluster into batches of similar sizes
         clusters, batch = [], []
@@ -163,18 +213,28 @@ class StructureBatchSampler(Sampler):
 
     def __len__(self):
         return len(self.clusters)
+
+    def set_epoch(self, epoch, start=0):
+        self.epoch = epoch
+        self.start = start
     
     def __iter__(self):
-        np.random.shuffle(self.clusters)
-        for b_idx in self.clusters:
-            yield b_idx
+        if self.shuffle:
+            order = np.random.RandomState(self.seed + self.epoch).permutation(len(self.clusters))
+        else:
+            order = np.arange(len(self.clusters))
+        start, self.start = self.start, 0
+        for i in order[start:]:
+            yield self.clusters[i]
 
 
 class DistributedStructureBatchSampler(torch.utils.data.distributed.DistributedSampler):
-    def __init__(self,dataset,batch_size,num_replicas,rank,shuffle=True):
-        super().__init__(dataset,num_replicas,rank,shuffle)
+    def __init__(self,dataset,batch_size,num_replicas,rank,shuffle=True,seed=0):
+        super().__init__(dataset,num_replicas,rank,shuffle,seed)
         """
         the dataset here is just the length
+        Every rank builds the same token clusters and takes a disjoint share of them,
+        the number of clusters is padded to a multiple of num_replicas so all ranks run the same number of steps
         """
         self.batch_size = batch_size
         sorted_ix = np.argsort(self.dataset)
@@ -192,30 +252,33 @@ class DistributedStructureBatchSampler(torch.utils.data.distributed.DistributedS
         if len(batch) > 0:
             clusters.append(batch)
         self.clusters = clusters
+        self.start = 0
 
     def __len__(self):
-        return len(self.clusters)
+        return -(-len(self.clusters) // self.num_replicas)
+
+    def set_epoch(self, epoch, start=0):
+        """ start : batches of this rank already done in the epoch (resume) """
+        super().set_epoch(epoch)
+        self.start = start
     
     def __iter__(self):
-        # deterministically shuffle based on epoch
+        # deterministically shuffle based on epoch, same order on every rank
         g = torch.Generator()
-        g.manual_seed(self.epoch)
-        #print('here is pytorch code and you can delete it in the /home/lzk/anaconda3/lib/python3.7/site-packages/torch/utils/data')
+        g.manual_seed(self.seed + self.epoch)
         if self.shuffle:
-            indices = torch.randperm(len(self.dataset), generator=g).tolist()
+            indices = torch.randperm(len(self.clusters), generator=g).tolist()
         else:
-            indices = list(range(len(self.dataset)))
-        # add extra samples to make it evenly divisible
-        indices += indices[:(self.total_size - len(indices))]
-        assert len(indices) == self.total_size
-
-        indices = indices[self.rank:self.total_size:self.num_replicas]
-        assert len(indices) == self.num_samples
+            indices = list(range(len(self.clusters)))
+        # add extra clusters to make it evenly divisible
+        total_size = len(self) * self.num_replicas
+        indices += indices[:(total_size - len(indices))]
+        assert len(indices) == total_size
 
-        # 然后我也要拿到每个数据的长度 (每个rank不同)
-        np.random.shuffle(self.clusters)
-        for b_idx in self.clusters:
-            yield b_idx
+        # 每个rank拿到不同的cluster
+        start, self.start = self.start, 0
+        for b_idx in indices[self.rank:total_size:self.num_replicas][start:]:
+            yield self.clusters[b_idx]
 
 class StructureLoader:
     def __init__(self, dataset, batch_size=10000, shuffle=True,
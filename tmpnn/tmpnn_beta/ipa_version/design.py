@@ -0,0 +1,240 @@
+import collections
+import json
+import os
+import time
+from argparse import ArgumentParser
+from multiprocessing import Pool
+
+import torch
+
+import data
+import export
+import structure_io
+from inference import LENGTH_BUCKETS, bucket, run_batch
+
+
+STRUCTURE_SUFFIXES = (".pdb", ".ent", ".cif", ".mmcif")
+
+
+def find_structures(inputs):
+    """ PDB / mmCIF files (optionally gzipped) of the input files and folders, in a stable order """
+    for path in inputs:
+        if os.path.isfile(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for file in sorted(files):
+                name = file[:-3] if file.endswith(".gz") else file
+                if name.lower().endswith(STRUCTURE_SUFFIXES):
+                    yield os.path.join(root, file)
+
+
+def _parse(path):
+    try:
+        return path, structure_io.parse_file(path), None
+    except Exception as e:
+        return path, [], repr(e)
+
+
+class Manifest:
+    """
+    JSON lines of the finished input files, the designs of a file are on disk before its line is written
+    {"path", "status", "chains", "offset"} offset is the FASTA size after the file was written
+    """
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        self.offset = 0
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # line cut by the interruption
+                        continue
+                    self.done.add(record["path"])
+                    if record.get("offset") is not None:
+                        self.offset = record["offset"]
+        self.f = open(path, "a")
+
+    def add(self, path, status, chains=0, offset=None):
+        self.f.write(json.dumps({"path": path, "status": status, "chains": chains, "offset": offset}) + "\n")
+        self.f.flush()
+        self.done.add(path)
+
+    def close(self):
+        self.f.close()
+
+
+class FastaWriter:
+    """ Designs appended to a FASTA file, truncated back to the last manifest offset on resume """
+    def __init__(self, path, offset=0):
+        with open(path, "a") as f:
+            f.truncate(offset)
+        self.f = open(path, "a")
+
+    def write(self, records):
+        for r in records:
+            self.f.write(f">{r['name']}, T={r['temperature']}, sample={r['sample']}, score={r['score']:.4f}, "
+                         f"native_score={r['native_score']:.4f}, recovery={r['recovery']:.3f}\n{r['seq']}\n")
+
+    def commit(self, final=False):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        return True
+
+    def offset(self):
+        return self.f.tell()
+
+    def close(self):
+        self.f.close()
+
+
+class ParquetWriter:
+    """ Parquet part files of rows_per_part designs in a folder, every part is written atomically """
+    def __init__(self, folder, rows_per_part=50000):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.rows_per_part = rows_per_part
+        self.rows = []
+        self.part = len([f for f in os.listdir(folder) if f.startswith("part-") and f.endswith(".parquet")])
+
+    def write(self, records):
+        self.rows.extend(records)
+
+    def commit(self, final=False):
+        if not self.rows:
+            return True
+        if len(self.rows) < self.rows_per_part and not final:
+            return False
+        import pandas as pd
+        path = os.path.join(self.folder, f"part-{self.part:05d}.parquet")
+        pd.DataFrame(self.rows).to_parquet(path + ".tmp", index=False)
+        os.replace(path + ".tmp", path)
+        self.part += 1
+        self.rows = []
+        return True
+
+    def offset(self):
+        return None
+
+    def close(self):
+        # rows which are not committed belong to files missing from the manifest, they are designed again
+        self.rows = []
+
+
+def design(model, pool, writer, manifest, paths, args, fixed_positions=None, bias=None, omit=None):
+    """
+    Stream the structures through the parser pool, design them in length bucketed batches of at most
+    args.max_tokens padded tokens and write the designs of every finished file
+    fixed_positions : {chain name: [1-based residue numbers]} kept native, bias / omit : see TMPNN.sample
+    """
+    fixed_positions = fixed_positions or {}
+    buckets = collections.defaultdict(list)
+    remaining, rows, finished = {}, collections.defaultdict(list), []
+    stats = collections.Counter()
+    start = time.time()
+
+    def run(length):
+        items = buckets.pop(length)
+        natives = run_batch(model, items, "score", length=length)
+        designs = run_batch(model, items, "design", args.num_samples, args.temperature, length,
+                            bias=bias, omit=omit, fixed_first=args.fixed_first)
+        for item, native, result in zip(items, natives, designs):
+            for sample, r in enumerate(result["sequences"]):
+                recovery = sum(a == b for a, b in zip(r["seq"], native["seq"])) / len(r["seq"])
+                rows[item["path"]].append({
+                    "name": item["name"], "path": item["path"], "length": len(r["seq"]),
+                    "temperature": args.temperature, "sample": sample, "seq": r["seq"], "score": r["score"],
+                    "cctop": r["cctop"], "native_seq": native["seq"], "native_score": native["score"],
+                    "recovery": recovery,
+                })
+            remaining[item["path"]] -= 1
+            if remaining[item["path"]] == 0:
+                del remaining[item["path"]]
+                records = rows.pop(item["path"])
+                writer.write(records)
+                finished.append((item["path"], len({r["name"] for r in records})))
+        stats.update(batches=1, chains=len(items), residues=sum(len(item["seq"]) for item in items),
+                     padded_tokens=len(items) * length)
+        commit()
+
+    def commit(final=False):
+        if writer.commit(final):
+            for path, chains in finished:
+                manifest.add(path, "ok", chains, writer.offset())
+            finished.clear()
+
+    # the files are parsed in chunks so that the parsed structures waiting for the model stay bounded
+    chunk = args.workers * 16
+    for i in range(0, len(paths), chunk):
+        for path, entries, error in pool.imap(_parse, paths[i:i + chunk]):
+            entries = [entry for entry in entries if len(entry["seq"]) <= args.max_length]
+            if error is not None or not entries:
+                manifest.add(path, "error" if error is not None else "no_chains")
+                stats.update(skipped=1)
+                continue
+            remaining[path] = len(entries)
+            for entry in entries:
+                item = structure_io.to_item(entry)
+                item["path"] = path
+                item["fixed"] = fixed_positions.get(item["name"], [])
+                length = bucket(len(entry["seq"]), LENGTH_BUCKETS)
+                buckets[length].append(item)
+                if len(buckets[length]) * length * args.num_samples >= args.max_tokens:
+                    run(length)
+            stats.update(files=1)
+        elapsed = time.time() - start
+        print(f"{stats['files']} files {stats['chains']} chains {stats['residues'] / elapsed :.1f} residues / s "
+              f"batch fill {stats['residues'] / max(1, stats['padded_tokens']) :.3f}", flush=True)
+    for length in sorted(buckets):
+        run(length)
+    commit(final=True)
+    return stats
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(prog='tmpnn-design', description='Design sequences for folders of PDB / mmCIF backbones')
+    parser.add_argument('inputs', nargs='+', help='structure files or folders, searched recursively')
+    parser.add_argument('--checkpoint', type=str, required=True, help='exported weights or training checkpoint')
+    parser.add_argument('--output', type=str, required=True, help='.fa / .fasta file or a folder of Parquet parts')
+    parser.add_argument('--manifest', type=str, default=None, help='finished files, defaults to <output>.manifest.jsonl, without it the output starts over')
+    parser.add_argument('--num_samples', type=int, default=8, help='sequences per chain')
+    parser.add_argument('--temperature', type=float, default=0.1)
+    parser.add_argument('--max_tokens', type=int, default=16384, help='padded tokens (length * samples) per batch')
+    parser.add_argument('--max_length', type=int, default=2048, help='longer chains are skipped')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='structure parsing processes')
+    parser.add_argument('--rows_per_part', type=int, default=50000, help='designs per Parquet part file')
+    parser.add_argument('--fixed_positions_json', type=str, default=None, help='json {chain name: [1-based residue numbers]} of residues kept native')
+    parser.add_argument('--fixed_first', action='store_true', help='decode the fixed positions first in one pass, the time then scales with the designed residues. '
+                        'Same order as training when the fixed positions precede all designed ones, otherwise validate it first')
+    parser.add_argument('--omit_AAs', type=str, default="", help='amino acids which are never sampled, e.g. CM')
+    parser.add_argument('--bias_AA', type=str, default="", help='per amino acid logit bias, e.g. A=-0.5,W=1.0')
+    parser.add_argument('--device', type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+    # ValueError before any file is touched, e.g. when every amino acid is omitted
+    bias, omit = data.aa_bias(args.bias_AA, args.omit_AAs)
+    fixed_positions = {}
+    if args.fixed_positions_json is not None:
+        with open(args.fixed_positions_json) as f:
+            fixed_positions = json.load(f)
+
+    manifest = Manifest(args.manifest or args.output.rstrip("/") + ".manifest.jsonl")
+    paths = [path for path in find_structures(args.inputs) if path not in manifest.done]
+    print(f"{len(paths)} structures to design, {len(manifest.done)} already done")
+    if args.output.endswith((".fa", ".fasta")):
+        writer = FastaWriter(args.output, manifest.offset)
+    else:
+        writer = ParquetWriter(args.output, args.rows_per_part)
+    # the parser processes are forked before the model is loaded
+    pool = Pool(args.workers)
+    model = export.load_model(args.checkpoint, args.device)
+    try:
+        stats = design(model, pool, writer, manifest, paths, args, fixed_positions, bias, omit)
+    finally:
+        pool.terminate()
+        writer.close()
+        manifest.close()
+    print(dict(stats))
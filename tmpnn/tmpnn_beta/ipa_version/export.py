@@ -0,0 +1,131 @@
+import contextlib
+import json
+import os
+import time
+from argparse import ArgumentParser
+
+import torch
+
+import struct2seq
+
+
+# training arguments of train_s2s.py -> TMPNN constructor arguments
+TRAINING_ARGS = {
+    "num_tags": "num_tags",
+    "ipa_layer": "ipa_layer",
+    "encoder_layer": "num_encoder_layers",
+    "decoder_layer": "num_decoder_layers",
+}
+# tied parameters (alias -> owner), RobertaLMHead projects with the sequence embedding matrix
+TIED_WEIGHTS = {
+    "W_out_seq.weight": "W_seq.weight",
+}
+
+
+def model_hyperparams(hyperparams):
+    """
+    TMPNN constructor arguments of an inference model from the hyperparams of a training checkpoint,
+    training noise, dropout and activation checkpointing are switched off
+    """
+    kwargs = {TRAINING_ARGS.get(k, k): v for k, v in hyperparams.items() if k in TRAINING_ARGS}
+    kwargs.update(noise_2D=0., noise_3D=0., dropout=0.)
+    return kwargs
+
+
+def export(checkpoint_path, output_path, dtype=None):
+    """
+    Write the inference-only weights of a training checkpoint (no optimizer / scheduler state)
+    .safetensors : safetensors file, the hyperparams are stored in its metadata
+    otherwise    : torch file readable with torch.load(mmap=True, weights_only=True)
+    dtype        : optional cast of the floating point weights, e.g. torch.bfloat16
+    """
+    # training checkpoints pickle numpy objects (RNG states), they are not weights_only loadable
+    checkpoint = torch.load(checkpoint_path, map_location="cpu", weights_only=False)
+    hyperparams = model_hyperparams(checkpoint["hyperparams"])
+    # tied weights share storage, which safetensors refuses, only the owner is stored
+    state_dict = {k: v.contiguous() for k, v in checkpoint["model_state_dict"].items() if k not in TIED_WEIGHTS}
+    if dtype is not None:
+        state_dict = {k: v.to(dtype) if v.is_floating_point() else v for k, v in state_dict.items()}
+    if output_path.endswith(".safetensors"):
+        from safetensors.torch import save_file
+        save_file(state_dict, output_path, metadata={"hyperparams": json.dumps(hyperparams)})
+    else:
+        tmp = output_path + ".tmp"
+        torch.save({"hyperparams": hyperparams, "model_state_dict": state_dict}, tmp)
+        os.replace(tmp, output_path)
+    return hyperparams
+
+
+@contextlib.contextmanager
+def skip_init():
+    """
+    torch.nn.init functions are no-ops inside the block, for modules built on the meta device : their values are
+    replaced anyway, and normal_ on a meta tensor goes through torch._refs, which imports torch._dynamo (seconds)
+    """
+    names = [name for name in dir(torch.nn.init) if name.endswith("_") and not name.startswith("_")]
+    saved = {name: getattr(torch.nn.init, name) for name in names}
+    for name in names:
+        setattr(torch.nn.init, name, lambda tensor, *args, **kwargs: tensor)
+    try:
+        yield
+    finally:
+        for name, function in saved.items():
+            setattr(torch.nn.init, name, function)
+
+
+def read_weights(path):
+    """
+    Memory-mapped state dict and hyperparams of an exported file, or of a training checkpoint
+    Output :
+    (hyperparams, state_dict)
+    """
+    if path.endswith(".safetensors"):
+        from safetensors import safe_open
+        from safetensors.torch import load_file
+        with safe_open(path, framework="pt") as f:
+            hyperparams = json.loads(f.metadata()["hyperparams"])
+        return hyperparams, load_file(path)
+    try:
+        checkpoint = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    except Exception:
+        # training checkpoints pickle numpy objects (RNG states), they are not mmap / weights_only loadable
+        checkpoint = torch.load(path, map_location="cpu", weights_only=False)
+    hyperparams = checkpoint["hyperparams"]
+    if "optimizer_state_dict" in checkpoint:
+        hyperparams = model_hyperparams(hyperparams)
+    return hyperparams, checkpoint["model_state_dict"]
+
+
+def load_model(path, device="cpu"):
+    """
+    Build TMPNN from the hyperparams stored with the weights
+    The modules are created on the meta device (no allocation or initialization of the weights) and take
+    the memory-mapped tensors as they are, so only the pages which are used are read from disk.
+    """
+    device = torch.device(device)
+    hyperparams, state_dict = read_weights(path)
+    state_dict = dict(state_dict)
+    for alias, owner in TIED_WEIGHTS.items():
+        state_dict.setdefault(alias, state_dict[owner])
+    with torch.device("meta"), skip_init():
+        model = struct2seq.TMPNN(device=device, **hyperparams)
+    model.load_state_dict(state_dict, assign=True)
+    # assign=True replaces the parameters one by one, tie them again
+    for alias, owner in TIED_WEIGHTS.items():
+        module, name = alias.rsplit(".", 1)
+        setattr(model.get_submodule(module), name, model.get_parameter(owner))
+    return model.to(device).eval()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Export a training checkpoint for inference')
+    parser.add_argument('--checkpoint', type=str, help='training checkpoint of train_s2s.py')
+    parser.add_argument('--output', type=str, help='exported weights, .safetensors or .pt')
+    parser.add_argument('--dtype', type=str, default=None, choices=["float32", "bfloat16", "float16"], help='cast the weights')
+    args = parser.parse_args()
+
+    hyperparams = export(args.checkpoint, args.output, None if args.dtype is None else getattr(torch, args.dtype))
+    print(f"exported {args.checkpoint} -> {args.output} {hyperparams}")
+    start = time.time()
+    load_model(args.output)
+    print(f"cold start {time.time() - start :.3f} s")
@@ -0,0 +1,331 @@
+import os
+import time
+
+import torch
+
+import data
+
+
+# Padded shapes are rounded up to these buckets so that torch.compile only sees a few shapes
+LENGTH_BUCKETS = (64, 128, 256, 384, 512, 768, 1024, 1536, 2048)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+
+def bucket(size, buckets):
+    """
+    Smallest bucket >= size, sizes beyond the last bucket are rounded up to its multiple
+    """
+    for b in buckets:
+        if size <= b:
+            return b
+    return -(-size // buckets[-1]) * buckets[-1]
+
+
+def pad_to(tensor, shape, value=0):
+    """
+    Pad the leading dimensions of tensor up to shape
+    """
+    if tuple(tensor.shape[:len(shape)]) == tuple(shape):
+        return tensor
+    out = tensor.new_full((*shape, *tensor.shape[len(shape):]), value)
+    out[tuple(slice(0, k) for k in tensor.shape[:len(shape)])] = tensor
+    return out
+
+
+class CompiledTMPNN:
+    """
+    torch.compile'd inference entry point of TMPNN
+
+    The encoder (featurization + encoder + IPA), the cctop head and the decoder are compiled as
+    separate graphs with static shapes. Batches are padded to (batch bucket, length bucket), padded
+    rows and residues have mask 0, so one graph is built per bucket and reused afterwards.
+    Compiled kernels are stored in the inductor cache directory (cache_dir), a restarted process
+    with the same cache_dir skips most of the compilation in warmup().
+    TorchScript is not used: the Rigid / openfold helpers in the IPA are not scriptable.
+    """
+    def __init__(self, model, length_buckets=LENGTH_BUCKETS, batch_buckets=BATCH_BUCKETS,
+                 backend="inductor", mode=None, cache_dir=None):
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            os.environ["TORCHINDUCTOR_CACHE_DIR"] = cache_dir
+            os.environ["TORCHINDUCTOR_FX_GRAPH_CACHE"] = "1"
+        # every (batch, length) bucket is one entry of the dynamo cache of each stage
+        torch._dynamo.config.cache_size_limit = max(
+            torch._dynamo.config.cache_size_limit, len(length_buckets) * len(batch_buckets))
+
+        self.model = model.eval()
+        self.length_buckets = tuple(sorted(length_buckets))
+        self.batch_buckets = tuple(sorted(batch_buckets))
+        self.encode = torch.compile(model.encode, backend=backend, mode=mode, dynamic=False)
+        self.cctop = torch.compile(model.cctop, backend=backend, mode=mode, dynamic=False)
+        self.decode = torch.compile(model.decode, backend=backend, mode=mode, dynamic=False)
+        # (batch bucket, length bucket) -> warmup time in seconds
+        self.compiled = {}
+
+    @property
+    def device(self):
+        return self.model.W_v.weight.device
+
+    def shape(self, batch_size, length):
+        return bucket(batch_size, self.batch_buckets), bucket(length, self.length_buckets)
+
+    def pad(self, X, S, mask):
+        """
+        Pad a batch to its bucket
+        Input :
+        X [B, L, 5, 3], S [B, L], mask [B, L]
+        """
+        B, L = S.shape
+        shape = self.shape(B, L)
+        return pad_to(X, shape, 0.), pad_to(S, shape, 0), pad_to(mask, shape, 0.)
+
+    @torch.no_grad()
+    def encoder(self, X, mask):
+        """
+        Bucketed encoder, the outputs keep the padded shape
+        """
+        lengths = torch.sum(mask, dim=-1).long()
+        return self.encode(X, lengths, mask, self.device)
+
+    @torch.no_grad()
+    def __call__(self, X, S, mask=None):
+        """
+        Same outputs as TMPNN.forward in eval mode
+        Output :
+        log_probs_seq [B, L, vocab]
+        logits_cctop  [B, L, num_tags]
+        """
+        B, L = S.shape
+        if mask is None:
+            mask = torch.ones_like(S, dtype=torch.float32)
+        key = self.shape(B, L)
+        X, S, mask = self.pad(X, S, mask)
+        h_V_initial, h_V, h_E, E_idx = self.encoder(X, mask)
+        h_S = self.model.W_seq(S)
+        logits_cctop = self.cctop(h_V_initial, h_V, h_S)
+        log_probs_seq = self.decode(h_V, h_E, E_idx, h_S, mask)
+        self.compiled.setdefault(key, None)
+        return log_probs_seq[:B, :L], logits_cctop[:B, :L]
+
+    def warmup(self, lengths=None, batch_sizes=(1,)):
+        """
+        Compile the graphs of the given buckets ahead of the first request
+        Output :
+        dict {(batch bucket, length bucket): seconds}
+        """
+        if lengths is None:
+            lengths = self.length_buckets
+        for batch_size in batch_sizes:
+            for length in lengths:
+                key = self.shape(batch_size, length)
+                if self.compiled.get(key) is not None:
+                    continue
+                X = torch.randn((*key, 5, 3), device=self.device) * 10.
+                S = torch.zeros(key, dtype=torch.long, device=self.device)
+                start = time.time()
+                self(X, S)
+                if self.device.type == "cuda":
+                    torch.cuda.synchronize(self.device)
+                self.compiled[key] = time.time() - start
+        return dict(self.compiled)
+
+
+class RaggedSampler:
+    """
+    Continuous batching of autoregressive sampling over a queue of structures
+
+    Every sampled sequence occupies one row slot of a fixed size pool of decoder caches and steps through
+    its own residues only (per row position t). A finished row is returned right away and its slot is
+    refilled from the pending queue, so the number of decoder steps is bounded by the real residues of
+    the queue and not by the longest chain of a padded batch.
+    Structures are admitted in groups of up to admit_batch, their featurization + Encoder + IPA run as
+    one padded batch and the num_samples rows of a structure share its encoder outputs.
+    """
+    def __init__(self, model, max_rows=64, max_structures=None, max_length=1024, admit_batch=8):
+        self.model = model.eval()
+        self.max_rows = max_rows
+        self.max_structures = max_rows if max_structures is None else max_structures
+        self.max_length = max_length
+        self.admit_batch = admit_batch
+        self.pending = []
+        self.cache = None
+        # decoder steps and sampled residues, steps * active rows is the work actually done
+        self.steps = 0
+        self.residues = 0
+
+    @property
+    def device(self):
+        return self.model.W_v.weight.device
+
+    def submit(self, name, X, mask=None, num_samples=1, temperature=1.0):
+        """
+        Queue one structure
+        X    [L, 5, 3]
+        mask [L]
+        """
+        if mask is None:
+            mask = torch.ones(X.shape[0], dtype=torch.float32)
+        length = int(torch.sum(mask))
+        if X.shape[0] > self.max_length or num_samples > self.max_rows:
+            raise ValueError(f"{name} : length {X.shape[0]} or num_samples {num_samples} exceeds the pool size")
+        self.pending.append((name, X, mask, num_samples, temperature, length))
+
+    def _allocate(self, h_V, cache):
+        P, R, L = self.max_structures, self.max_rows, self.max_length
+        # a group of chains shorter than top_k has fewer neighbors, the pool is sized for any later group
+        K, H = self.model.features.top_k, self.model.hidden_dim
+        new = lambda *shape, dtype=h_V.dtype: torch.zeros(shape, dtype=dtype, device=self.device)
+        self.cache = {
+            "rows": torch.arange(R, device=self.device),
+            "src": torch.zeros(R, dtype=torch.long, device=self.device),
+            "h_V": new(P, L, H),
+            "E_idx": new(P, L, K, dtype=torch.long),
+            "mask": new(P, L, dtype=torch.float32),
+            "mask_bw": new(P, L, K, 1, dtype=torch.float32),
+            "attend": new(P, L, K, dtype=torch.float32),
+            "static": [new(P, L, K, 2 * H) for _ in cache["static"]],
+            "tables": [new(R, L, 2 * H) for _ in cache["tables"]],
+        }
+        self.S = new(R, L, dtype=torch.long)
+        self.t = new(R, dtype=torch.long)
+        self.lengths = new(R, dtype=torch.long)
+        self.temperature = new(R, dtype=torch.float32)
+        self.free_rows = list(range(R))
+        self.free_structures = list(range(P))
+        # structure slot -> (name, row slots)
+        self.owner = {}
+
+    @torch.no_grad()
+    def _admit(self):
+        group = []
+        if self.cache is None:
+            rows_left, structures_left = self.max_rows, self.max_structures
+        else:
+            rows_left, structures_left = len(self.free_rows), len(self.free_structures)
+        while self.pending and len(group) < self.admit_batch and structures_left > 0 and self.pending[0][3] <= rows_left:
+            group.append(self.pending.pop(0))
+            rows_left -= group[-1][3]
+            structures_left -= 1
+        if not group:
+            return 0
+        L = max(item[1].shape[0] for item in group)
+        X = torch.stack([pad_to(item[1], (L,), 0.) for item in group]).to(self.device)
+        mask = torch.stack([pad_to(item[2], (L,), 0.) for item in group]).to(self.device)
+        lengths = torch.sum(mask, dim=-1).long()
+        _, h_V, h_E, E_idx = self.model.encode(X, lengths, mask, self.device)
+        cache = self.model._decoder_cache(h_V, h_E, E_idx, mask)
+        if self.cache is None:
+            self._allocate(h_V, cache)
+        pool = self.cache
+        K = E_idx.size(-1)
+        for i, (name, _, _, num_samples, temperature, length) in enumerate(group):
+            p = self.free_structures.pop()
+            rows = [self.free_rows.pop() for _ in range(num_samples)]
+            for key in ("h_V", "mask"):
+                pool[key][p].zero_()
+                pool[key][p, :L] = cache[key][i]
+            # neighbor slots K: and beyond stay zero and are masked out of the attention
+            for key in ("E_idx", "mask_bw"):
+                pool[key][p].zero_()
+                pool[key][p, :L, :K] = cache[key][i]
+            pool["attend"][p].zero_()
+            pool["attend"][p, :L, :K] = 1.
+            for l in range(len(pool["static"])):
+                pool["static"][l][p].zero_()
+                pool["static"][l][p, :L, :K] = cache["static"][l][i]
+                pool["tables"][l][rows] = 0.
+            rows = torch.tensor(rows, device=self.device)
+            pool["src"][rows] = p
+            self.S[rows] = 0
+            self.t[rows] = 0
+            self.lengths[rows] = length
+            self.temperature[rows] = temperature
+            self.owner[p] = (name, rows)
+        return len(group)
+
+    @torch.no_grad()
+    def run(self):
+        """
+        Decode the whole queue, structures are yielded as soon as all of their samples are finished
+        Output :
+        (name, S [num_samples, length]) in order of completion
+        """
+        model = self.model
+        while self.pending or (self.cache is not None and len(self.free_rows) < self.max_rows):
+            self._admit()
+            pool = self.cache
+            busy = torch.ones(self.max_rows, dtype=torch.bool, device=self.device)
+            busy[self.free_rows] = False
+            # rows which reached the end of their own chain drop out of the step
+            rows = torch.nonzero(busy & (self.t < self.lengths)).squeeze(-1)
+            if rows.numel() > 0:
+                t = self.t[rows]
+                step_cache = dict(pool, rows=rows, src=pool["src"][rows])
+                logits = model._decode_step(step_cache, t)
+                S_t = model._sample_logits(logits, self.temperature[rows])
+                model._decode_commit(step_cache, t, S_t)
+                self.S[rows, t] = S_t
+                self.t[rows] = t + 1
+                self.steps += 1
+                self.residues += rows.numel()
+
+            done = (busy & (self.t >= self.lengths)).tolist()
+            for p, (name, rows_p) in list(self.owner.items()):
+                if all(done[r] for r in rows_p.tolist()):
+                    length = int(self.lengths[rows_p[0]])
+                    yield name, self.S[rows_p, :length].clone()
+                    self.free_rows.extend(rows_p.tolist())
+                    self.free_structures.append(p)
+                    del self.owner[p]
+
+
+def run_batch(model, items, op="design", num_samples=1, temperature=0.1, length=None, bias=None, omit=None, fixed_first=False):
+    """
+    Design or score a list of StructureDataset items as one padded batch
+    op          : "design" samples num_samples sequences per item, "score" scores the item sequences
+    temperature : scalar or one value per item
+    length      : padded length, e.g. a length bucket, defaults to the longest item
+    bias, omit, fixed_first : see TMPNN.sample, the residues item["fixed"] (1-based) of an item keep their native token
+    Output :
+    one record per item, {"name", "sequences": [{"seq", "score", "cctop"}]} for design and
+    {"name", "seq", "score", "cctop", "nll"} for score, score is the mean negative log probability
+    """
+    device = next(model.parameters()).device
+    collated = data.batch_collate_function(items)
+    B = len(items)
+    length = length or collated["seq"].size(1)
+    X = pad_to(collated["coord"], (B, length)).to(device)
+    S = pad_to(collated["seq"], (B, length)).to(device)
+    mask = pad_to(collated["mask"], (B, length)).to(device)
+    lengths = collated["length"].to(device)
+    if op == "score":
+        num_samples = 1
+    with torch.no_grad():
+        if op == "design":
+            temperature = torch.as_tensor(temperature, dtype=torch.float32, device=device).expand(B)
+            fixed = torch.zeros_like(mask)
+            for b, item in enumerate(items):
+                fixed[b, [i - 1 for i in item.get("fixed", [])]] = 1.
+            S = model.sample(X, lengths, mask, temperature=temperature.repeat_interleave(num_samples),
+                             num_samples=num_samples, S=S, fixed=fixed, bias=bias, omit=omit, fixed_first=fixed_first)
+        log_probs, logits_cctop = model.score(X, S, lengths, mask)
+        mask_rows = mask.repeat_interleave(num_samples, 0)
+        nll = -torch.gather(log_probs, -1, S.unsqueeze(-1)).squeeze(-1) * mask_rows
+        scores = nll.sum(-1) / mask_rows.sum(-1)
+        cctop = model.decode_crf(logits_cctop, mask_rows)
+
+    S, cctop, scores, nll = S.cpu(), cctop.cpu(), scores.cpu(), nll.cpu()
+    results = []
+    for b, item in enumerate(items):
+        rows = range(b * num_samples, (b + 1) * num_samples)
+        L = len(item["seq"])
+        records = [{
+            "seq": "".join(data.restypes[i] for i in S[r, :L].tolist()),
+            "score": float(scores[r]),
+            "cctop": "".join(data.cctop_code[i] for i in cctop[r, :L].tolist()),
+        } for r in rows]
+        if op == "score":
+            results.append(dict(records[0], name=item["name"], nll=nll[rows[0], :L].tolist()))
+        else:
+            results.append({"name": item["name"], "sequences": records})
+    return results
@@ -0,0 +1,213 @@
+import json
+import os
+import queue
+import threading
+import time
+
+import torch
+import torch.distributed
+
+
+class MetricsAccumulator:
+    """
+    Running weighted sums of training metrics kept on device
+    add() never synchronizes with the host, flush() copies every sum in one transfer
+    """
+    def __init__(self):
+        self.sums = {}
+        self.weights = {}
+
+    def add(self, name, value, weight=1.):
+        """ value, weight : tensors or numbers, value is the weighted sum of the metric over weight items """
+        value = value.detach() if torch.is_tensor(value) else value
+        weight = weight.detach() if torch.is_tensor(weight) else weight
+        self.sums[name] = self.sums.get(name, 0.) + value
+        self.weights[name] = self.weights.get(name, 0.) + weight
+
+    def flush(self, reset=True, distributed=False):
+        """
+        distributed : sum over the ranks of the process group first, every rank has to call flush
+        Output :
+        {name: weighted mean} as python floats
+        """
+        names = list(self.sums)
+        if not names:
+            return {}
+        device = _device(self.sums, self.weights)
+        values = [self.sums[k] for k in names] + [self.weights[k] for k in names]
+        values = torch.stack([torch.as_tensor(v, dtype=torch.float32, device=device) for v in values])
+        if distributed:
+            torch.distributed.all_reduce(values)
+        values = values.tolist()
+        if reset:
+            self.sums, self.weights = {}, {}
+        return {k: values[i] / max(values[i + len(names)], 1e-12) for i, k in enumerate(names)}
+
+
+    def state_dict(self):
+        return {"sums": dict(self.sums), "weights": dict(self.weights)}
+
+    def load_state_dict(self, state, device=None):
+        move = lambda v: v.to(device) if torch.is_tensor(v) and device is not None else v
+        self.sums = {k: move(v) for k, v in state["sums"].items()}
+        self.weights = {k: move(v) for k, v in state["weights"].items()}
+
+
+def _device(*dicts):
+    for d in dicts:
+        for v in d.values():
+            if torch.is_tensor(v):
+                return v.device
+    return torch.device("cpu")
+
+
+class BufferedWriter:
+    """
+    Append text to a file from a background thread, write() only enqueues the line
+    """
+    def __init__(self, path, mode="a", buffer_lines=64):
+        self.path = path
+        self.buffer_lines = buffer_lines
+        self.queue = queue.Queue()
+        self.file = open(path, mode)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        buffer = []
+        while True:
+            line = self.queue.get()
+            if line is not None:
+                buffer.append(line)
+            # write out when the buffer is full, the queue is drained or on close
+            if buffer and (line is None or len(buffer) >= self.buffer_lines or self.queue.empty()):
+                self.file.write("".join(buffer))
+                self.file.flush()
+                buffer = []
+            if line is None:
+                break
+
+    def write(self, line):
+        self.queue.put(line)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+
+
+class JSONLBackend:
+    """
+    Local append-only metrics store, one JSON record per log() call, written by a BufferedWriter
+    """
+    def __init__(self, path, config=None):
+        self.path = path
+        self.writer = BufferedWriter(path)
+        if config is not None:
+            self.writer.write(json.dumps({"config": config}) + "\n")
+
+    def log(self, record):
+        self.writer.write(json.dumps(record) + "\n")
+
+    def close(self):
+        self.writer.close()
+
+
+class WandbBackend:
+    """
+    Weights & Biases backend, wandb is only imported when this backend is used
+    """
+    def __init__(self, project, config=None):
+        import wandb
+        self.wandb = wandb
+        wandb.init(project=project, config=config)
+
+    def log(self, record):
+        self.wandb.log(record)
+
+    def close(self):
+        self.wandb.finish()
+
+
+class MetricsLogger:
+    """
+    Send every record to each backend, records are dicts of python numbers
+    """
+    def __init__(self, backends):
+        self.backends = backends
+
+    def log(self, record):
+        record = dict(record, time=time.time())
+        for backend in self.backends:
+            backend.log(record)
+
+    def close(self):
+        for backend in self.backends:
+            backend.close()
+
+
+def metrics_logger(backends, output_folder, project=None, config=None):
+    """
+    backends : list of "local" (output_folder/metrics.jsonl) and "wandb"
+    """
+    loggers = []
+    for name in backends:
+        if name == "local":
+            loggers.append(JSONLBackend(os.path.join(output_folder, "metrics.jsonl"), config))
+        elif name == "wandb":
+            loggers.append(WandbBackend(project, config))
+        else:
+            raise ValueError(f"unknown metrics backend {name}")
+    return MetricsLogger(loggers)
+
+
+def load_metrics(path):
+    """
+    Read a metrics.jsonl file
+    Output :
+    pandas DataFrame, one row per record, the config record is skipped
+    """
+    import pandas as pd
+    records = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if "config" not in record:
+                records.append(record)
+    return pd.DataFrame.from_records(records)
+
+
+class RecordAccumulator:
+    """
+    Column store of per-sample evaluation records
+    add() appends a block of rows given as equal length columns (lists, numpy arrays or scalars which are
+    broadcast), frame() builds the DataFrame once at the end instead of growing it row by row
+    """
+    def __init__(self):
+        self.columns = {}
+        self.rows = 0
+
+    def add(self, **columns):
+        import numpy as np
+        n = max(np.size(v) for v in columns.values())
+        for name, values in columns.items():
+            values = np.asarray(values)
+            self.columns.setdefault(name, []).append(np.broadcast_to(values, (n,)) if values.ndim == 0 else values)
+        self.rows += n
+
+    def frame(self):
+        import numpy as np
+        import pandas as pd
+        return pd.DataFrame({name: np.concatenate(blocks) for name, blocks in self.columns.items()})
+
+    def write(self, path):
+        """ .parquet or .csv """
+        df = self.frame()
+        if path.endswith(".parquet"):
+            df.to_parquet(path, index=False)
+        else:
+            df.to_csv(path, index=False)
+        return df
@@ -0,0 +1,44 @@
+import os
+from argparse import ArgumentParser
+
+from matplotlib import pyplot as plt
+plt.switch_backend('agg')
+
+import metrics
+
+
+# Plot the loss, perplexity and cctop accuracy curves of training runs from their metrics.jsonl
+parser = ArgumentParser(description='Plot the metrics written by the local metrics backend')
+parser.add_argument('metrics', type=str, nargs='+', help='metrics.jsonl files (or output folders) of the runs')
+parser.add_argument('--keys', type=str, nargs='+', default=['PPL', 'Acc/train', 'PPL-epoch/train', 'PPL-epoch/validation', 'Acc-epoch/train', 'Acc-epoch/validation'],
+                    help='metrics to plot, one panel each')
+parser.add_argument('--output', type=str, default='metrics.pdf', help='output figure')
+parser.add_argument('--summary', action='store_true', help='print the best validation perplexity of every run')
+args = parser.parse_args()
+
+runs = {}
+for path in args.metrics:
+    if os.path.isdir(path):
+        path = os.path.join(path, 'metrics.jsonl')
+    runs[path] = metrics.load_metrics(path)
+
+fig, axes = plt.subplots(len(args.keys), 1, figsize=(6, 2.5 * len(args.keys)), squeeze=False)
+for ax, key in zip(axes[:, 0], args.keys):
+    for path, df in runs.items():
+        if key not in df:
+            continue
+        df_key = df.dropna(subset=[key])
+        # step metrics against the optimizer step, epoch metrics against the epoch
+        x = 'epoch' if key.endswith(('-epoch/train', '-epoch/validation')) else 'step'
+        ax.plot(df_key[x], df_key[key], label=os.path.dirname(path) or path)
+        ax.set_xlabel(x)
+    ax.set_ylabel(key)
+axes[0, 0].legend(fontsize=6)
+plt.tight_layout()
+plt.savefig(args.output)
+
+if args.summary:
+    for path, df in runs.items():
+        if 'PPL-epoch/validation' in df:
+            best = df.loc[df['PPL-epoch/validation'].idxmin()]
+            print(f"{path}\tbest epoch {int(best['epoch'])}\tvalidation PPL {best['PPL-epoch/validation'] :.3f}")
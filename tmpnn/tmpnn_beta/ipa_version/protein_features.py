@@ -117,7 +117,7 @@ class ProteinFeatures(nn.Module):
         # D_max   : [B,L] 统计每一个氨基酸最大的距离,给mask节点用的
         D_adjust = D + (1. - mask_2D) * D_max
         # D_adjust: [B,L,L] 根据D_max和mask来调整节点,因为在原始的D中mask节点的距离都是0,现在将mask节点的距离调整为最大
-        D_neighbors, E_idx = torch.topk(D_adjust, np.minimum(
+        D_neighbors, E_idx = torch.topk(D_adjust, min(
             self.top_k, X.shape[1]), dim=-1, largest=False)
         # D_neighbors : [B,L,K]根据最小距离选择的top_k个节点的距离
         # E_idx       : [B,L,K]对应最小top_k个节点的索引
@@ -255,67 +255,70 @@ class ProteinFeatures(nn.Module):
 
 
     def forward(self, X, mask, L,device):
-        # 3D frame添加噪音
-        if self.noise_3D > 0.:
-            bb_frame = self.backbone_frame(X + self.noise_3D * torch.randn_like(X))
-        else:
-            bb_frame = self.backbone_frame(X)
+        # 几何特征(frame, 距离, RBF, 二面角)在autocast下也保持float32
+        with torch.autocast(device_type=X.device.type, enabled=False):
+            X = X.float()
+            # 3D frame添加噪音
+            if self.noise_3D > 0.:
+                bb_frame = self.backbone_frame(X + self.noise_3D * torch.randn_like(X))
+            else:
+                bb_frame = self.backbone_frame(X)
         
-        # 2D distance map增加噪音
-        if self.noise_2D > 0:
-            X = X + self.noise_2D * torch.randn_like(X)
+            # 2D distance map增加噪音
+            if self.noise_2D > 0:
+                X = X + self.noise_2D * torch.randn_like(X)
 
 
-        N  = X[:, :, 0, :]
-        Ca = X[:, :, 1, :]
-        C  = X[:, :, 2, :]
-        CB = X[:, :, 3, :]
-        O  = X[:, :, 4, :]
+            N  = X[:, :, 0, :]
+            Ca = X[:, :, 1, :]
+            C  = X[:, :, 2, :]
+            CB = X[:, :, 3, :]
+            O  = X[:, :, 4, :]
         
 
 
-        D_neighbors, E_idx, mask_neighbors = self._dist(Ca, mask)
-
-        RBF_all = []
-        RBF_all.append(self._rbf(D_neighbors))  # Ca-Ca
-        RBF_all.append(self._get_rbf(N, N, E_idx))  # N-N
-        RBF_all.append(self._get_rbf(C, C, E_idx))  # C-C
-        RBF_all.append(self._get_rbf(O, O, E_idx))  # O-O
-        RBF_all.append(self._get_rbf(CB, CB, E_idx))  # Cb-Cb
-        RBF_all.append(self._get_rbf(Ca, N, E_idx))  # Ca-N
-        RBF_all.append(self._get_rbf(Ca, C, E_idx))  # Ca-C
-        RBF_all.append(self._get_rbf(Ca, O, E_idx))  # Ca-O
-        RBF_all.append(self._get_rbf(Ca, CB, E_idx))  # Ca-Cb
-        RBF_all.append(self._get_rbf(N, C, E_idx))  # N-C
-        RBF_all.append(self._get_rbf(N, O, E_idx))  # N-O
-        RBF_all.append(self._get_rbf(N, CB, E_idx))  # N-Cb
-        RBF_all.append(self._get_rbf(CB, C, E_idx))  # Cb-C
-        RBF_all.append(self._get_rbf(CB, O, E_idx))  # Cb-O
-        RBF_all.append(self._get_rbf(O, C, E_idx))  # O-C
-        RBF_all.append(self._get_rbf(N, Ca, E_idx))  # N-Ca
-        RBF_all.append(self._get_rbf(C, Ca, E_idx))  # C-Ca
-        RBF_all.append(self._get_rbf(O, Ca, E_idx))  # O-Ca
-        RBF_all.append(self._get_rbf(CB, Ca, E_idx))  # Cb-Ca
-        RBF_all.append(self._get_rbf(C, N, E_idx))  # C-N
-        RBF_all.append(self._get_rbf(O, N, E_idx))  # O-N
-        RBF_all.append(self._get_rbf(CB, N, E_idx))  # Cb-N
-        RBF_all.append(self._get_rbf(C, CB, E_idx))  # C-Cb
-        RBF_all.append(self._get_rbf(O, CB, E_idx))  # O-Cb
-        RBF_all.append(self._get_rbf(C, O, E_idx))  # C-O
-        RBF_all = torch.cat(tuple(RBF_all), dim=-1)
-
-        # 只看一个batch: 从mpnn和nips2019结合而来的简化版本
-        # residue_idx[0,:,None]表示横坐标i为第i个氨基酸
-        # residue_idx[0,None,:]表示纵坐标j为第j个氨基酸
-        # offset[0,i,j]为第i个氨基酸index和第j个氨基酸坐标的差值
-        residue_idx = [np.arange(X.size(1)) for _ in range(len(L))]
-        # 其他tensor都是生成的，而residue_idx是第一次出现，所以应该添加tensor元素
-        residue_idx = torch.from_numpy(np.array(residue_idx))
-        residue_idx = residue_idx.to(device)
-        offset = residue_idx[:, :, None] - residue_idx[:, None, :]
-        offset = gather_edges(offset[:, :, :, None], E_idx)[
-            :, :, :, 0]  # [B, L, K]
-        # offset此时是氨基酸序列的相对位置的信息
+            D_neighbors, E_idx, mask_neighbors = self._dist(Ca, mask)
+
+            RBF_all = []
+            RBF_all.append(self._rbf(D_neighbors))  # Ca-Ca
+            RBF_all.append(self._get_rbf(N, N, E_idx))  # N-N
+            RBF_all.append(self._get_rbf(C, C, E_idx))  # C-C
+            RBF_all.append(self._get_rbf(O, O, E_idx))  # O-O
+            RBF_all.append(self._get_rbf(CB, CB, E_idx))  # Cb-Cb
+            RBF_all.append(self._get_rbf(Ca, N, E_idx))  # Ca-N
+            RBF_all.append(self._get_rbf(Ca, C, E_idx))  # Ca-C
+            RBF_all.append(self._get_rbf(Ca, O, E_idx))  # Ca-O
+            RBF_all.append(self._get_rbf(Ca, CB, E_idx))  # Ca-Cb
+            RBF_all.append(self._get_rbf(N, C, E_idx))  # N-C
+            RBF_all.append(self._get_rbf(N, O, E_idx))  # N-O
+            RBF_all.append(self._get_rbf(N, CB, E_idx))  # N-Cb
+            RBF_all.append(self._get_rbf(CB, C, E_idx))  # Cb-C
+            RBF_all.append(self._get_rbf(CB, O, E_idx))  # Cb-O
+            RBF_all.append(self._get_rbf(O, C, E_idx))  # O-C
+            RBF_all.append(self._get_rbf(N, Ca, E_idx))  # N-Ca
+            RBF_all.append(self._get_rbf(C, Ca, E_idx))  # C-Ca
+            RBF_all.append(self._get_rbf(O, Ca, E_idx))  # O-Ca
+            RBF_all.append(self._get_rbf(CB, Ca, E_idx))  # Cb-Ca
+            RBF_all.append(self._get_rbf(C, N, E_idx))  # C-N
+            RBF_all.append(self._get_rbf(O, N, E_idx))  # O-N
+            RBF_all.append(self._get_rbf(CB, N, E_idx))  # Cb-N
+            RBF_all.append(self._get_rbf(C, CB, E_idx))  # C-Cb
+            RBF_all.append(self._get_rbf(O, CB, E_idx))  # O-Cb
+            RBF_all.append(self._get_rbf(C, O, E_idx))  # C-O
+            RBF_all = torch.cat(tuple(RBF_all), dim=-1)
+
+            # 只看一个batch: 从mpnn和nips2019结合而来的简化版本
+            # residue_idx[0,:,None]表示横坐标i为第i个氨基酸
+            # residue_idx[0,None,:]表示纵坐标j为第j个氨基酸
+            # offset[0,i,j]为第i个氨基酸index和第j个氨基酸坐标的差值
+            # 直接在device上生成residue_idx, 避免numpy往返(也避免torch.compile断图)
+            residue_idx = torch.arange(X.size(1), device=X.device).unsqueeze(0).expand(X.size(0), -1)
+            offset = residue_idx[:, :, None] - residue_idx[:, None, :]
+            offset = gather_edges(offset[:, :, :, None], E_idx)[
+                :, :, :, 0]  # [B, L, K]
+            # offset此时是氨基酸序列的相对位置的信息
+
+            V = self._dihedrals(X)
 
         # Pairwise embeddings
         E_positional = self.pos_embeddings(offset.long(), mask_neighbors)
@@ -327,7 +330,6 @@ class ProteinFeatures(nn.Module):
         E = self.norm_edges(E)
 
         # Node embeddings
-        V = self._dihedrals(X)
         V = self.node_embedding(V)
         V = self.norm_nodes(V)
 
@@ -0,0 +1,269 @@
+import asyncio
+import collections
+import json
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+import data
+import export
+import structure_io
+from inference import LENGTH_BUCKETS, bucket, run_batch
+
+
+class Request:
+    def __init__(self, op, item, num_samples=1, temperature=1.0):
+        self.op = op
+        self.item = item
+        self.num_samples = num_samples
+        self.temperature = temperature
+        self.length = len(item["seq"])
+        self.arrival = time.time()
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class DesignServer:
+    """
+    Dynamic batching of design / scoring requests
+    Requests are queued per (op, length bucket, num_samples) and a queue is run as one padded batch once it
+    holds max_tokens padded tokens (bucket length * rows) or max_batch requests, or its oldest request has
+    waited max_wait seconds. max_memory (bytes, CUDA only) further caps the tokens of a batch with the peak
+    memory per token measured on the previous batches.
+    The model runs in a single worker thread, the requests arriving meanwhile form the next batches.
+    """
+    def __init__(self, model, max_tokens=16384, max_batch=32, max_wait=0.01, max_memory=None,
+                 length_buckets=LENGTH_BUCKETS, history=1000):
+        self.model = model
+        self.max_tokens = max_tokens
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.max_memory = max_memory
+        self.length_buckets = length_buckets
+        self.queues = collections.defaultdict(list)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.bytes_per_token = {}
+        self.latency = collections.deque(maxlen=history)
+        self.queue_latency = collections.deque(maxlen=history)
+        self.counters = collections.Counter()
+        self.started = time.time()
+        self._wakeup = None
+
+    @property
+    def device(self):
+        return next(self.model.parameters()).device
+
+    def _key(self, request):
+        return request.op, bucket(request.length, self.length_buckets), request.num_samples
+
+    def _token_budget(self, op):
+        if self.max_memory is None or op not in self.bytes_per_token:
+            return self.max_tokens
+        return max(1, min(self.max_tokens, int(self.max_memory / self.bytes_per_token[op])))
+
+    async def submit(self, op, item, num_samples=1, temperature=1.0):
+        request = Request(op, item, num_samples, temperature)
+        self.queues[self._key(request)].append(request)
+        self._wakeup.set()
+        return await request.future
+
+    def _ready(self, now):
+        """ Key of the queue to run next and its requests, None when no queue is full or due """
+        due = None
+        for key, queue in self.queues.items():
+            if not queue:
+                continue
+            op, length, num_samples = key
+            budget = self._token_budget(op) // (length * num_samples)
+            if len(queue) >= min(self.max_batch, max(1, budget)):
+                return key, max(1, min(self.max_batch, budget))
+            if now - queue[0].arrival >= self.max_wait and (due is None or queue[0].arrival < due[2]):
+                due = (key, max(1, min(self.max_batch, budget)), queue[0].arrival)
+        return None if due is None else due[:2]
+
+    def _next_deadline(self):
+        arrivals = [queue[0].arrival for queue in self.queues.values() if queue]
+        return None if not arrivals else min(arrivals) + self.max_wait
+
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            ready = self._ready(time.time())
+            if ready is None:
+                deadline = self._next_deadline()
+                timeout = None if deadline is None else max(0., deadline - time.time())
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            key, size = ready
+            batch, self.queues[key] = self.queues[key][:size], self.queues[key][size:]
+            start = time.time()
+            try:
+                results = await loop.run_in_executor(self.executor, self._run, key, batch)
+            except Exception as e:
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                continue
+            end = time.time()
+            for request, result in zip(batch, results):
+                latency = {"queue": start - request.arrival, "compute": end - start, "total": end - request.arrival}
+                self.latency.append(latency["total"])
+                self.queue_latency.append(latency["queue"])
+                if not request.future.done():
+                    request.future.set_result(dict(result, latency=latency, batch_size=len(batch)))
+
+    def _run(self, key, batch):
+        """ Run one padded batch in the worker thread """
+        op, length, num_samples = key
+        device = self.device
+        if device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(device)
+        results = run_batch(self.model, [request.item for request in batch], op, num_samples,
+                            [request.temperature for request in batch], length)
+        if op == "score":
+            num_samples = 1
+        padded = len(batch) * num_samples * length
+        if device.type == "cuda":
+            self.bytes_per_token[op] = torch.cuda.max_memory_allocated(device) / padded
+        residues = sum(request.length for request in batch) * num_samples
+        self.counters.update(batches=1, requests=len(batch), residues=residues, padded_tokens=padded, **{op: len(batch)})
+        return results
+
+    def metrics(self):
+        def percentiles(values):
+            if not values:
+                return {}
+            return {f"p{q}": float(np.percentile(values, q)) for q in (50, 95, 99)}
+        counters = dict(self.counters)
+        elapsed = time.time() - self.started
+        return {
+            "uptime": elapsed,
+            "queued": sum(len(queue) for queue in self.queues.values()),
+            "latency": percentiles(list(self.latency)),
+            "queue_latency": percentiles(list(self.queue_latency)),
+            # real residues / padded tokens of the executed batches
+            "batch_fill": counters.get("residues", 0) / max(1, counters.get("padded_tokens", 0)),
+            "mean_batch_size": counters.get("requests", 0) / max(1, counters.get("batches", 0)),
+            "residues_per_second": counters.get("residues", 0) / max(elapsed, 1e-9),
+            "bytes_per_token": self.bytes_per_token,
+            **counters,
+        }
+
+    def _parse(self, body, op):
+        """ Dataset item of a request body with either "pdb" (text of a PDB file) or "coords" """
+        name = body.get("name", "protein")
+        if "pdb" in body:
+            entries = structure_io.parse_pdb(body["pdb"], name)
+            if "chain" in body:
+                entries = [entry for entry in entries if entry["name"] == f"{name}_{body['chain']}"]
+            if not entries:
+                raise ValueError("no protein chain with a complete backbone")
+            entry = entries[0]
+            if "seq" in body:
+                entry = structure_io.from_coords(entry["coords"], body["seq"], entry["name"])
+        elif "coords" in body:
+            entry = structure_io.from_coords(body["coords"], body.get("seq"), name)
+        else:
+            raise ValueError('request needs "pdb" or "coords"')
+        if op == "score" and "seq" not in body and "pdb" not in body:
+            raise ValueError('scoring needs "seq"')
+        bad_chars = set(entry["seq"]).difference(data.restypes)
+        if bad_chars:
+            raise ValueError(f"unknown amino acids {sorted(bad_chars)}")
+        return structure_io.to_item(entry)
+
+    async def _route(self, method, path, body):
+        if method == "GET" and path == "/metrics":
+            return 200, self.metrics()
+        if method == "GET" and path == "/health":
+            return 200, {"status": "ok"}
+        if method == "POST" and path in ("/design", "/score"):
+            op = path[1:]
+            body = json.loads(body or b"{}")
+            item = self._parse(body, op)
+            if op == "design":
+                num_samples = int(body.get("num_samples", 1))
+                temperature = float(body.get("temperature", 0.1))
+                # a zero / nan temperature would fail the whole batch the request is put in
+                if num_samples < 1 or not 0 < temperature < float("inf"):
+                    raise ValueError("num_samples must be >= 1 and temperature > 0")
+                return 200, await self.submit(op, item, num_samples, temperature)
+            return 200, await self.submit(op, item)
+        return 404, {"error": f"{method} {path} not found"}
+
+    async def handle(self, reader, writer):
+        """ Minimal HTTP/1.1 with keep-alive, JSON in and out """
+        try:
+            while True:
+                line = await reader.readline()
+                if not line.strip():
+                    break
+                method, path, _ = line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    header = await reader.readline()
+                    if header in (b"\r\n", b"\n", b""):
+                        break
+                    k, v = header.decode("latin-1").split(":", 1)
+                    headers[k.strip().lower()] = v.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                try:
+                    status, payload = await self._route(method, path, body)
+                except (ValueError, KeyError, TypeError) as e:
+                    status, payload = 400, {"error": str(e)}
+                except Exception as e:
+                    status, payload = 500, {"error": repr(e)}
+                content = json.dumps(payload).encode()
+                close = headers.get("connection", "").lower() == "close"
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(content)}\r\n"
+                    f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n".encode() + content
+                )
+                await writer.drain()
+                if close:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8000, unix=None):
+        self._wakeup = asyncio.Event()
+        batcher = asyncio.create_task(self.batcher())
+        if unix is not None:
+            server = await asyncio.start_unix_server(self.handle, path=unix)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        print(f"serving on {unix if unix is not None else f'http://{host}:{port}'}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            self.executor.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='TMPNN design / scoring server')
+    parser.add_argument('--checkpoint', type=str, help='exported weights or training checkpoint')
+    parser.add_argument('--device', type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument('--host', type=str, default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix', type=str, default=None, help='serve on this unix socket instead of TCP')
+    parser.add_argument('--max_tokens', type=int, default=16384, help='padded tokens (length * rows) per batch')
+    parser.add_argument('--max_batch', type=int, default=32, help='requests per batch')
+    parser.add_argument('--max_wait_ms', type=float, default=10., help='longest time a request waits for its batch to fill')
+    parser.add_argument('--max_memory_gb', type=float, default=None, help='peak CUDA memory per batch')
+    args = parser.parse_args()
+
+    model = export.load_model(args.checkpoint, args.device)
+    server = DesignServer(model, max_tokens=args.max_tokens, max_batch=args.max_batch, max_wait=args.max_wait_ms / 1000,
+                          max_memory=None if args.max_memory_gb is None else args.max_memory_gb * 2 ** 30)
+    asyncio.run(server.serve(args.host, args.port, args.unix))
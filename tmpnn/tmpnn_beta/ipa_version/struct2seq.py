@@ -2,7 +2,8 @@ import utils
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torchcrf import CRF
+import torch.utils.checkpoint
+from crf import CRF
 import data
 import protein_features
 import numpy as np
@@ -18,6 +19,14 @@ import rigid_utils
 import math,json,sys
 
 
+def _per_row(x, like):
+    """ Broadcast a scalar or a per row [R] setting against a [R, ...] tensor """
+    x = torch.as_tensor(x, device=like.device)
+    if x.dim() == 0:
+        return x
+    return x.view(x.shape + (1,) * (like.dim() - x.dim()))
+
+
 class RobertaLMHead(nn.Module):
     """Head for masked language modeling."""
     def __init__(self, embed_dim, output_dim, weight):
@@ -232,28 +241,30 @@ class InvariantPointAttention(nn.Module):
         a *= math.sqrt(1.0 / (3 * self.c_hidden))
         a += (math.sqrt(1.0 / 3) * permute_final_dims(b, (2, 0, 1)))
 
-        # [*, N_res, N_res, H, P_q, 3]
-        pt_att = q_pts.unsqueeze(-4) - k_pts.unsqueeze(-5)
-        if(inplace_safe):
-            pt_att *= pt_att
-        else:
-            pt_att = pt_att ** 2
-
-        # [*, N_res, N_res, H, P_q]
-        pt_att = sum(torch.unbind(pt_att, dim=-1))
-        head_weights = self.softplus(self.head_weights).view(
-            *((1,) * len(pt_att.shape[:-2]) + (-1, 1))
-        )
-        head_weights = head_weights * math.sqrt(
-            1.0 / (3 * (self.no_qk_points * 9.0 / 2))
-        )
-        if(inplace_safe):
-            pt_att *= head_weights
-        else:
-            pt_att = pt_att * head_weights
+        # Point distances are kept in float32 under autocast
+        with torch.autocast(device_type=s.device.type, enabled=False):
+            # [*, N_res, N_res, H, P_q, 3]
+            pt_att = q_pts.float().unsqueeze(-4) - k_pts.float().unsqueeze(-5)
+            if(inplace_safe):
+                pt_att *= pt_att
+            else:
+                pt_att = pt_att ** 2
+
+            # [*, N_res, N_res, H, P_q]
+            pt_att = sum(torch.unbind(pt_att, dim=-1))
+            head_weights = self.softplus(self.head_weights.float()).view(
+                *((1,) * len(pt_att.shape[:-2]) + (-1, 1))
+            )
+            head_weights = head_weights * math.sqrt(
+                1.0 / (3 * (self.no_qk_points * 9.0 / 2))
+            )
+            if(inplace_safe):
+                pt_att *= head_weights
+            else:
+                pt_att = pt_att * head_weights
 
-        # [*, N_res, N_res, H]
-        pt_att = torch.sum(pt_att, dim=-1) * (-0.5)
+            # [*, N_res, N_res, H]
+            pt_att = torch.sum(pt_att, dim=-1) * (-0.5)
         # [*, N_res, N_res]
         square_mask = mask.unsqueeze(-1) * mask.unsqueeze(-2)
         square_mask = self.inf * (square_mask - 1)
@@ -308,10 +319,11 @@ class InvariantPointAttention(nn.Module):
         o_pt = permute_final_dims(o_pt, (2, 0, 3, 1))
         o_pt = r[..., None, None].invert_apply(o_pt)
 
-        # [*, N_res, H * P_v]
-        o_pt_norm = flatten_final_dims(
-            torch.sqrt(torch.sum(o_pt ** 2, dim=-1) + self.eps), 2
-        )
+        # [*, N_res, H * P_v], eps=1e-8 underflows in half precision
+        with torch.autocast(device_type=s.device.type, enabled=False):
+            o_pt_norm = flatten_final_dims(
+                torch.sqrt(torch.sum(o_pt.float() ** 2, dim=-1) + self.eps), 2
+            )
 
         # [*, N_res, H * P_v, 3]
         o_pt = o_pt.reshape(*o_pt.shape[:-3], -1, 3)
@@ -379,18 +391,30 @@ class NeighborAttention(nn.Module):
         """ Numerically stable masked softmax 
         mask_attend : 1代表非mask, 0代表mask,应该加一个非常大的负数
         """
-        negative_inf = np.finfo(np.float32).min
+        negative_inf = torch.finfo(attend_logits.dtype).min
         attend_logits = torch.where(
-            mask_attend > 0, attend_logits, torch.tensor(negative_inf,device=self.device))
+            mask_attend > 0, attend_logits, torch.tensor(negative_inf,dtype=attend_logits.dtype,device=attend_logits.device))
         attend = nn.functional.softmax(attend_logits, dim)
         attend = mask_attend * attend
         return attend
 
-    def forward(self, h_V, h_E, mask_attend=None):
+    def project(self, h, start, end):
+        """ Apply the W_K/W_V blocks acting on input channels [start, end)
+        Because W_K and W_V are linear, W([h_E, h_j]) = W_E h_E + W_j h_j, so the node blocks
+        can be projected once per residue [B, L, C] and gathered afterwards instead of
+        projecting the gathered [B, L, K, C] tensors.
+        Returns:
+            h_KV:           Keys and values         [..., 2 * N_hidden]
+        """
+        W = torch.cat([self.W_K.weight[:, start:end], self.W_V.weight[:, start:end]], 0)
+        return F.linear(h, W)
+
+    def forward(self, h_V, h_E, mask_attend=None, projected=False):
         """ Self-attention, graph-structured O(Nk)
         Args:
             h_V:            Node features           [N_batch, N_nodes, N_hidden]
             h_E:            Neighbor features       [N_batch, N_nodes, top_k, N_hidden]
+                            or keys/values from project() when projected=True [N_batch, N_nodes, top_k, 2 * N_hidden]
             bias:           Bias for attn_logits    [N_batch, N_nodes, top_k]
             mask_attend:    Mask for attention      [N_batch, N_nodes, top_k]
         Returns:
@@ -402,9 +426,13 @@ class NeighborAttention(nn.Module):
         n_heads = self.num_heads
 
         d = int(self.num_hidden / n_heads)
+        if projected:
+            K, V = torch.split(h_E, self.num_hidden, dim=-1)
+        else:
+            K, V = self.W_K(h_E), self.W_V(h_E)
         Q = self.W_Q(h_V).view([n_batch, n_nodes, 1, n_heads, 1, d])
-        K = self.W_K(h_E).view([n_batch, n_nodes, top_k, n_heads, d, 1])
-        V = self.W_V(h_E).view([n_batch, n_nodes, top_k, n_heads, d])
+        K = K.reshape([n_batch, n_nodes, top_k, n_heads, d, 1])
+        V = V.reshape([n_batch, n_nodes, top_k, n_heads, d])
 
         # Attention with scaled inner product
         attend_logits = torch.matmul(Q, K).view(
@@ -489,13 +517,13 @@ class EdgeSelfAttention(nn.Module):
 
         if mask_attend is not None:
             # Masked softmax
-            negative_inf = np.finfo(np.float32).min
+            negative_inf = torch.finfo(attend_logits.dtype).min
             mask = mask_attend.unsqueeze(2).expand(-1, -1, n_heads, -1)
             # mask_attend:    Mask for attention      [N_batch, N_nodes, N_head, top_k]
             # mask : [N_batch, N_nodes, N_head, top_k]
             mask_2d = mask.unsqueeze(-1) * mask.unsqueeze(-2)
             # mask_2d : [N_batch, N_nodes, N_head, top_k, top_k]
-            attend = torch.where(mask_2d > 0, attend_logits, torch.tensor(negative_inf,device=self.W_K.weight.device))
+            attend = torch.where(mask_2d > 0, attend_logits, torch.tensor(negative_inf,dtype=attend_logits.dtype,device=attend_logits.device))
             attend = nn.functional.softmax(attend, dim=-1)
         else:
             attend = F.softmax(attend_logits, -1)
@@ -537,9 +565,16 @@ class EncoderLayer(nn.Module):
         self.act = nn.GELU()
 
     def forward(self, h_V,  h_E, h_EV, E_idx, mask_V=None, mask_attend=None):
-        """ Parallel computation of full transformer layer """
+        """ Parallel computation of full transformer layer
+        h_EV=None uses the factored keys/values: [h_E, h_V_j] is never materialized
+        """
         # Self-attention
-        dh = self.act(self.node_attention(h_V, h_EV, mask_attend))
+        if h_EV is None:
+            h_KV = self.node_attention.project(h_E, 0, self.num_hidden)
+            h_KV = h_KV + gather_nodes(self.node_attention.project(h_V, self.num_hidden, self.num_in), E_idx)
+            dh = self.act(self.node_attention(h_V, h_KV, mask_attend, projected=True))
+        else:
+            dh = self.act(self.node_attention(h_V, h_EV, mask_attend))
         h_V = self.norm1(h_V + self.dropout1(dh))
 
         # Position-wise feedforward
@@ -551,7 +586,7 @@ class EncoderLayer(nn.Module):
             h_V = mask_V * h_V
 
         # Outer product information
-        h_E += self.OuterProduct(h_V, E_idx)
+        h_E = h_E + self.OuterProduct(h_V, E_idx)
 
         # Self attention
         dh_E = self.act(self.edge_attention(h_E, mask_attend))
@@ -577,10 +612,10 @@ class DecoderLayer(nn.Module):
         self.attention = NeighborAttention(num_hidden, num_in, num_heads)
         self.dense = PositionWiseFeedForward(num_hidden, num_hidden * 4)
 
-    def forward(self, h_V, h_E, mask_V=None, mask_attend=None):
+    def forward(self, h_V, h_E, mask_V=None, mask_attend=None, projected=False):
         """ Parallel computation of full transformer layer """
         # Self-attention
-        dh = self.attention(h_V, h_E, mask_attend)
+        dh = self.attention(h_V, h_E, mask_attend, projected=projected)
         h_V = self.norm[0](h_V + self.dropout(dh))
 
         # Position-wise feedforward
@@ -592,26 +627,25 @@ class DecoderLayer(nn.Module):
             h_V = mask_V * h_V
         return h_V
 
-    def step(self, t, h_V, h_E, mask_V=None, mask_attend=None):
-        """ Sequential computation of step t of a transformer layer """
-        # Self-attention
-        h_V_t = h_V[:,t,:]
-        dh_t = self.attention.step(t, h_V, h_E, mask_attend)
-        h_V_t = self.norm[0](h_V_t + self.dropout(dh_t))
-
-        # Position-wise feedforward
-        dh_t = self.dense(h_V_t)
-        h_V_t = self.norm[1](h_V_t + self.dropout(dh_t))
-
-        if mask_V is not None:
-            mask_V_t = mask_V[:,t].unsqueeze(-1)
-            h_V_t = mask_V_t * h_V_t
-        return h_V_t
+    def step(self, h_V_t, h_E_t, mask_V_t=None, mask_attend_t=None):
+        """ Sequential computation of one residue per row
+        h_V_t    [R, N_hidden]
+        h_E_t    [R, top_k, 2 * N_hidden] projected keys/values
+        mask_V_t [R]
+        mask_attend_t [R, top_k] 0 for neighbor slots which do not exist (padded caches)
+        """
+        if mask_V_t is not None:
+            mask_V_t = mask_V_t.unsqueeze(1)
+        if mask_attend_t is not None:
+            mask_attend_t = mask_attend_t.unsqueeze(1)
+        h_V_t = self.forward(h_V_t.unsqueeze(1), h_E_t.unsqueeze(1), mask_V=mask_V_t, mask_attend=mask_attend_t, projected=True)
+        return h_V_t.squeeze(1)
 
 
 class TMPNN(nn.Module):
     def __init__(self,device,node_features=128, edge_features=128, hidden_dim=128, num_encoder_layers=3, num_decoder_layers=3,ipa_layer=3,
-                 vocab=22, num_tags=5, k_neighbors=30, noise_2D=0., noise_3D=0.,dropout=0.1):
+                 vocab=22, num_tags=5, k_neighbors=30, noise_2D=0., noise_3D=0.,dropout=0.1,
+                 checkpoint_encoder=0, checkpoint_ipa=0, checkpoint_decoder=0):
         super().__init__()
         self.device=device
         # Hypeparameters
@@ -620,6 +654,10 @@ class TMPNN(nn.Module):
         self.hidden_dim = hidden_dim
         self.num_tags = num_tags
         self.vocab = vocab
+        # Activation checkpointing : checkpoint every N-th layer of each stage, 0 is off
+        self.checkpoint_encoder = checkpoint_encoder
+        self.checkpoint_ipa = checkpoint_ipa
+        self.checkpoint_decoder = checkpoint_decoder
 
         # Featurization layers
         self.features = ProteinFeatures(node_features,edge_features,top_k=k_neighbors,noise_2D=noise_2D, noise_3D=noise_3D,dropout=dropout)
@@ -667,7 +705,14 @@ class TMPNN(nn.Module):
             if p.dim() > 1:
                 nn.init.xavier_uniform_(p)
 
-    def _autoregressive_mask(self,E_idx):
+    def _autoregressive_mask(self,E_idx,order=None):
+        """
+        1 for the neighbors decoded before residue i
+        order [B, L] : decoding rank of every residue, default is the left to right order of training
+        """
+        if order is not None:
+            mask = gather_nodes(order.unsqueeze(-1), E_idx).squeeze(-1) < order.unsqueeze(-1)
+            return mask.type(torch.float32)
         N_nodes = E_idx.size(1)
         ii = torch.arange(N_nodes)
         ii = ii.to(self.W_v.weight.device)
@@ -677,69 +722,113 @@ class TMPNN(nn.Module):
 
         return mask
 
-    def forward(self,X, S, S_mask=None, L=None, mask=None,device=None):
-        # Prepare node and edge embeddings and sequence embeddings
-        if device is None:
-            device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
-        if S_mask is None:
-            S_mask = S
-        if mask is None:
-            mask = torch.ones_like(S,dtype=torch.float32,dtype=device)
+    def _decoding_order(self, mask, fixed):
+        """
+        Decoding order of a partial redesign : fixed residues, then designable residues, then padding,
+        left to right inside each group
+        Output :
+        order     [B, L] decoding rank of every residue
+        positions [B, L] residue decoded at each rank
+        """
+        idx = torch.arange(mask.size(1), device=mask.device).unsqueeze(0)
+        group = torch.where(mask > 0, 1 - fixed.long(), 2)
+        positions = torch.argsort(group * mask.size(1) + idx, dim=-1)
+        order = torch.argsort(positions, dim=-1)
+        return order, positions
+
+    def _checkpoint(self, every, i, function, *args):
+        """
+        Run function(*args), with activation checkpointing on every `every`-th layer of a stage
+        every = 0 disables checkpointing for the stage, every = 1 checkpoints all of its layers
+        """
+        if every > 0 and i % every == 0 and self.training and torch.is_grad_enabled():
+            return torch.utils.checkpoint.checkpoint(function, *args, use_reentrant=False)
+        return function(*args)
+
+    def _ipa_block(self, h_V, h_E, r, mask, E_idx):
+        h_V = h_V + self.ipa(h_V,h_E,r,mask,E_idx)
+        h_V = self.ipa_dropout(h_V)
+        h_V = self.layer_norm_ipa(h_V)
+        h_V = self.transition(h_V)
+        return h_V
 
+    def _decoder_block(self, layer, h_V, h_V_encoder, h_E, h_S, E_idx, mask, mask_bw, mask_fw):
+        # h_ESV = [h_E, h_S_j, h_V_j] is projected blockwise: the node blocks are projected per
+        # residue and gathered, the encoder (future) part h_ESV_encoder = [h_E, 0, h_V_j] is fixed
+        # Masked positions attend to encoder information, unmasked see.
+        H = self.hidden_dim
+        attention = layer.attention
+        h_KV_E = attention.project(h_E, 0, H)
+        h_KV_S = attention.project(h_S, H, 2 * H)
+        h_KV_V = attention.project(h_V, 2 * H, 3 * H)
+        h_KV_encoder = attention.project(h_V_encoder, 2 * H, 3 * H)
+        h_KV = (mask_bw + mask_fw) * h_KV_E + mask_bw * gather_nodes(h_KV_S + h_KV_V, E_idx) + mask_fw * gather_nodes(h_KV_encoder, E_idx)
+        return layer(h_V, h_KV, mask_V=mask, projected=True)
+
+    def encode(self, X, L, mask, device):
+        """
+        Featurization + Encoder + IPA
+        Output :
+        h_V_initial [B, L, hidden] encoder output
+        h_V         [B, L, hidden] IPA output
+        h_E         [B, L, K, hidden]
+        E_idx       [B, L, K]
+        """
         V, E, E_idx,r = self.features(X, mask, L,device)
         h_V = self.W_v(V)
         h_E = self.W_e(E)
-        h_S = self.W_seq(S)
-        h_S_mask = self.W_seq(S_mask)
-        V = V + self.merge_seq_2(self.act(self.merge_seq_1(V+h_S_mask)))
         # Encoder is unmasked self-attention
         mask_attend = gather_nodes(mask.unsqueeze(-1),  E_idx).squeeze(-1)
         mask_attend = mask.unsqueeze(-1) * mask_attend
-        for layer in self.Encoder:
-            # Encoder中同时更新h_V和h_E
-            h_EV = cat_neighbors_nodes(h_V, h_E, E_idx)
-            h_V ,h_E = layer(h_V, h_E, h_EV, E_idx ,mask_V=mask, mask_attend=mask_attend)
-        #     h_V, h_E, h_EV,E_idx, mask_V=None, mask_attend=None
+        for i, layer in enumerate(self.Encoder):
+            # Encoder中同时更新h_V和h_E, h_EV=None走分解后的K/V投影
+            h_V ,h_E = self._checkpoint(self.checkpoint_encoder, i, layer, h_V, h_E, None, E_idx, mask, mask_attend)
         h_V_initial = h_V
 
         # IPA module
-        for layer in range(self.ipa_layer):
-            h_V = h_V + self.ipa(h_V,h_E,r,mask,E_idx)
-            h_V = self.ipa_dropout(h_V)
-            h_V = self.layer_norm_ipa(h_V)
-            h_V = self.transition(h_V)
+        for i in range(self.ipa_layer):
+            h_V = self._checkpoint(self.checkpoint_ipa, i, self._ipa_block, h_V, h_E, r, mask, E_idx)
+        return h_V_initial, h_V, h_E, E_idx
 
-        # Predict the cctop label using sequence embedding h_S and encoder backbone information h_V
+    def cctop(self, h_V_initial, h_V, h_S):
+        """ Predict the cctop label using sequence embedding h_S and encoder backbone information h_V """
         h_temp = self.act(h_V_initial + h_V + h_S)
         h_vs = self.layer_norm_cctop1(self.W_cv(h_temp) + h_temp) 
         logits_cctop = self.W_out_cctop(h_vs)
+        return logits_cctop
 
-        # Decoder module just from the
-        # Concatenate sequence embeddings for autoregressive decoder
-        # h_S = self.W_seq(S) move to line 318
-        h_ES = cat_neighbors_nodes(h_S, h_E, E_idx)
-
-        # Build encoder embeddings
-        h_ES_encoder = cat_neighbors_nodes(torch.zeros_like(h_S), h_E, E_idx)
-        h_ESV_encoder = cat_neighbors_nodes(h_V, h_ES_encoder, E_idx)
-
-        # Decoder uses masked self-attention
-        mask_attend = (self._autoregressive_mask(E_idx=E_idx)).unsqueeze(-1)
+    def decode(self, h_V, h_E, E_idx, h_S, mask, mask_attend=None):
+        """
+        Parallel decoder pass
+        mask_attend [B, L, K, 1] : 1 for the neighbors already decoded, default is the autoregressive order
+        Output :
+        log_probs_seq [B, L, vocab]
+        """
+        if mask_attend is None:
+            mask_attend = (self._autoregressive_mask(E_idx=E_idx)).unsqueeze(-1)
         mask_1D = mask.view([mask.size(0), mask.size(1), 1, 1])
         mask_bw = mask_1D * mask_attend
-
-
         mask_fw = mask_1D * (1. - mask_attend)
-        h_ESV_encoder_fw = mask_fw * h_ESV_encoder
 
-        for layer in self.Decoder:
-            # Masked positions attend to encoder information, unmasked see.
-            h_ESV = cat_neighbors_nodes(h_V, h_ES, E_idx)
-            h_ESV = mask_bw * h_ESV + h_ESV_encoder_fw
-            h_V = layer(h_V, h_ESV, mask_V=mask)
+        h_V_encoder = h_V
+        for i, layer in enumerate(self.Decoder):
+            h_V = self._checkpoint(self.checkpoint_decoder, i, self._decoder_block, layer, h_V, h_V_encoder, h_E, h_S, E_idx, mask, mask_bw, mask_fw)
 
         logits_seq = self.W_out_seq(h_V)
         log_probs_seq = F.log_softmax(logits_seq, dim=-1)
+        return log_probs_seq
+
+    def forward(self,X, S, S_mask=None, L=None, mask=None,device=None):
+        # Prepare node and edge embeddings and sequence embeddings
+        if device is None:
+            device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+        if mask is None:
+            mask = torch.ones_like(S,dtype=torch.float32,device=device)
+
+        h_V_initial, h_V, h_E, E_idx = self.encode(X, L, mask, device)
+        h_S = self.W_seq(S)
+        logits_cctop = self.cctop(h_V_initial, h_V, h_S)
+        log_probs_seq = self.decode(h_V, h_E, E_idx, h_S, mask)
 
         # logits_cctop [B, N, C]
 
@@ -755,48 +844,377 @@ class TMPNN(nn.Module):
         output : 
         scaler
         """
-        if not isinstance(mask.dtype,torch.ByteTensor):
-            return (self.crf(emission, tag, mask=mask.byte(),reduction="token_mean")).neg()
-        else:
-            return (self.crf(emission, tag, mask=mask,reduction="token_mean")).neg()
-    
+        # log-sum-exp of the CRF is kept in float32 under autocast
+        return (self.crf(emission, tag, mask=mask, reduction="token_mean")).neg()
+
     def decode_crf(self,emission,mask):
         """
-        CRF decode the sequence
+        CRF decode the sequence on device
+        Output :
+        tags [B, N] LongTensor, padding positions are 0
         """
-        if not isinstance(mask.dtype,torch.ByteTensor):
-            return self.crf.decode(emission,mask=mask.byte())
-        else:
-            return self.crf.decode(emission,mask=mask)
+        return self.crf.decode(emission, mask=mask)
 
-    def sample(self, X, L, mask=None, temperature=1.0):
+    def _decoder_cache(self, h_V, h_E, E_idx, mask, num_samples=1, order=None):
+        """
+        Key/value caches for incremental decoding of num_samples sequences per structure
+        static[l] [B, L, K, 2H] : edge keys/values plus the encoder keys/values of the neighbors
+                                  which are not decoded yet (the h_ESV_encoder part), fixed while sampling
+                                  and shared by the samples of a structure
+        tables[l] [R, L, 2H]    : per residue keys/values W_S h_S + W_V h_V^l of the decoded residues,
+                                  filled in while sampling, R = B * num_samples rows
+        src       [R]           : structure of each row
+        order     [B, L]        : decoding rank, default is left to right
+        """
+        mask_attend = self._autoregressive_mask(E_idx, order).unsqueeze(-1)
+        mask_1D = mask.view([mask.size(0), mask.size(1), 1, 1])
+        mask_fw = mask_1D * (1. - mask_attend)
+        H = self.hidden_dim
+        static, tables = [], []
+        for layer in self.Decoder:
+            attention = layer.attention
+            static.append(mask_1D * attention.project(h_E, 0, H) + mask_fw * gather_nodes(attention.project(h_V, 2 * H, 3 * H), E_idx))
+            tables.append(torch.zeros((h_V.size(0) * num_samples, h_V.size(1), 2 * H), dtype=h_V.dtype, device=h_V.device))
+        return {
+            "rows": torch.arange(h_V.size(0) * num_samples, device=h_V.device),
+            "src": torch.arange(h_V.size(0), device=h_V.device).repeat_interleave(num_samples),
+            "h_V": h_V,
+            "E_idx": E_idx,
+            "mask": mask,
+            "mask_bw": mask_1D * mask_attend,
+            "static": static,
+            "tables": tables,
+        }
+
+    def _decode_step(self, cache, t):
+        """
+        Decoder pass of residue t[r] of every row r from the caches, O(K * layers) per step
+        t : [R] LongTensor
+        cache["attend"] [B, L, K], optional : 0 for padded neighbor slots, which are left out of the attention
+        Output :
+        logits [R, vocab]
+        """
+        rows, src = cache["rows"], cache["src"]
+        E_idx_t = cache["E_idx"][src, t]
+        mask_bw_t = cache["mask_bw"][src, t]
+        mask_t = cache["mask"][src, t]
+        h_V_t = cache["h_V"][src, t]
+        attend_t = cache["attend"][src, t] if "attend" in cache else None
+        H = self.hidden_dim
+        for l, layer in enumerate(self.Decoder):
+            tables = cache["tables"][l]
+            # residue t is never its own decoded neighbor, so its entry can be written before the gather
+            tables[rows, t] += layer.attention.project(h_V_t, 2 * H, 3 * H)
+            # neighbors are read from the table of the row itself, rows may be any subset of the pool
+            h_KV_t = cache["static"][l][src, t] + mask_bw_t * tables[rows.unsqueeze(-1), E_idx_t]
+            h_V_t = layer.step(h_V_t, h_KV_t, mask_t, attend_t)
+        return self.W_out_seq(h_V_t)
+
+    def _decode_prefill(self, cache, S, fixed, num_samples=1):
+        """
+        Teacher forced parallel pass over the fixed residues, which come first in the decoding order,
+        so their table entries only depend on each other and are written for all of them at once
+        S     [B, L] native tokens
+        fixed [B, L] 1 for the residues kept fixed
+        """
+        h_V, E_idx, mask, mask_bw = cache["h_V"], cache["E_idx"], cache["mask"], cache["mask_bw"]
+        fixed = (fixed * mask).unsqueeze(-1).type(h_V.dtype)
+        h_S = self.W_seq(S)
+        H = self.hidden_dim
+        for l, layer in enumerate(self.Decoder):
+            attention = layer.attention
+            tables = fixed * (attention.project(h_S, H, 2 * H) + attention.project(h_V, 2 * H, 3 * H))
+            cache["tables"][l] = tables.repeat_interleave(num_samples, 0)
+            if l < len(self.Decoder) - 1:
+                h_V = layer(h_V, cache["static"][l] + mask_bw * gather_nodes(tables, E_idx), mask_V=mask, projected=True)
+
+    def _decode_commit(self, cache, t, S_t):
+        """ Add the embeddings of the sampled residues S_t [R] at t [R] to the tables """
+        rows = cache["rows"]
+        h_S_t = self.W_seq(S_t)
+        H = self.hidden_dim
+        for l, layer in enumerate(self.Decoder):
+            cache["tables"][l][rows, t] += layer.attention.project(h_S_t, H, 2 * H)
+
+    def sample(self, X, L, mask=None, temperature=1.0, num_samples=1, top_k=0, top_p=1.0, incremental=True,
+               S=None, fixed=None, bias=None, omit=None, fixed_first=False):
         """ Autoregressive decoding of a model
-        X : [B, N ,4 ,3]
+        X : [B, N ,5 ,3]
         L : a list contains a batch of length
+        num_samples : sequences per structure, featurization + Encoder + IPA run once per structure
+        temperature, top_k, top_p : scalars or [B * num_samples] tensors with one setting per row,
+                      e.g. a whole temperature sweep in one call
+        incremental : decode from the key/value caches, False runs the full decoder gathers at every step
+        Partial redesign :
+        S     [B, N] native sequence, kept at the fixed positions
+        fixed [B, N] 1 for the positions kept fixed, by default they are teacher forced in place in the left to
+              right order the model was trained with
+        fixed_first : decode the fixed positions first in one teacher forced pass, the sequential loop then only
+              runs over the designable positions and its time scales with their number (by default every position
+              is a step of the loop). Safe when the fixed positions come before all designable ones, e.g. a fixed
+              N-terminal segment: both orders are then identical. Otherwise designable residues see fixed residues
+              downstream of them, which the left to right training masks never show, so compare the recovery with
+              and without it (e.g. on the test split) before relying on it
+        bias  [20] or [B, N, 20] added to the amino acid logits
+        omit  [20] or [B, N, 20] bool, amino acids which are never sampled, at least one has to be left
+        Output :
+        S : [B * num_samples, N] the samples of structure b are rows b * num_samples, ..., (b + 1) * num_samples - 1
+            only the 20 amino acids are sampled (no mask / padding token)
+        """
+        N_batch, N_nodes = X.size(0), X.size(1)
+        if mask is None:
+            mask = torch.ones((N_batch, N_nodes), dtype=torch.float32, device=X.device)
+        if omit is not None and bool(torch.as_tensor(omit).all(-1).any()):
+            raise ValueError("omit excludes all 20 amino acids, nothing can be sampled")
+        # Prepare node and edge embeddings, Encoder + IPA
+        _, h_V, h_E, E_idx = self.encode(X, L, mask, X.device)
+        if not incremental:
+            assert fixed is None and bias is None and omit is None, "partial redesign needs incremental decoding"
+            h_V, h_E, E_idx, mask = [i.repeat_interleave(num_samples, 0) for i in (h_V, h_E, E_idx, mask)]
+            return self._sample_loop(h_V, h_E, E_idx, mask, temperature, top_k, top_p)
+
+        if fixed is None:
+            fixed = torch.zeros_like(mask)
+        if S is None:
+            S = torch.zeros((N_batch, N_nodes), dtype=torch.int64, device=X.device)
+        fixed = fixed * mask
+        if fixed_first:
+            order, positions = self._decoding_order(mask, fixed)
+            n_fixed = torch.sum(fixed, dim=-1).long()
+        else:
+            # left to right : the fixed residues stay in the loop and take their native token
+            order, positions = self._decoding_order(mask, torch.zeros_like(fixed))
+            n_fixed = torch.zeros(N_batch, dtype=torch.long, device=X.device)
+        cache = self._decoder_cache(h_V, h_E, E_idx, mask, num_samples, order)
+        n_design = torch.sum(mask, dim=-1).long() - n_fixed
+        if fixed_first and bool((n_fixed > 0).any()):
+            self._decode_prefill(cache, S, fixed, num_samples)
+        S = torch.where(fixed > 0, S, 0).repeat_interleave(num_samples, 0)
+        fixed_rows = fixed.repeat_interleave(num_samples, 0) > 0
+        if bias is not None or omit is not None:
+            bias = torch.zeros((N_batch, N_nodes, 20), device=X.device) + (0. if bias is None else torch.as_tensor(bias, device=X.device))
+            if omit is not None:
+                bias = bias.masked_fill(torch.as_tensor(omit, device=X.device), float("-inf"))
+
+        rows, src = cache["rows"], cache["src"]
+        settings = (temperature, top_k, top_p)
+        max_design = int(n_design.max())
+        ragged = bool((n_design < max_design).any())
+        # step s decodes the s-th designable residue of every structure which still has one
+        for step in range(max_design):
+            if ragged:
+                rows = torch.nonzero(step < n_design[cache["src"]]).squeeze(-1)
+                src = cache["src"][rows]
+                settings = [i[rows] if torch.is_tensor(i) and i.dim() > 0 else i for i in (temperature, top_k, top_p)]
+            t_rows = positions[src, n_fixed[src] + step]
+            step_cache = dict(cache, rows=rows, src=src)
+            logits = self._decode_step(step_cache, t_rows)[..., :20]
+            if bias is not None:
+                logits = logits + bias[src, t_rows]
+            S_t = self._sample_logits(logits, *settings)
+            if not fixed_first:
+                S_t = torch.where(fixed_rows[rows, t_rows], S[rows, t_rows], S_t)
+            self._decode_commit(step_cache, t_rows, S_t)
+            S[rows, t_rows] = S_t
+        return S
 
+    def mask_predict(self, X, L, mask=None, iterations=5, temperature=None, num_samples=1):
+        """ Non-autoregressive design with iterative mask-predict
+        Each iteration predicts every position in one parallel decoder pass, the positions kept from the
+        previous iteration act as decoded neighbors (their h_S and decoder states are visible), all others only
+        expose encoder information. After iteration i the N * (T - 1 - i) / T least confident positions are
+        masked again and re-predicted.
+        X : [B, N ,5 ,3]
+        temperature : None takes the argmax, otherwise sample at this temperature (scalar or [B * num_samples])
+        Output :
+        S : [B * num_samples, N]
         """
-        # Prepare node and edge embeddings
-        V, E, E_idx = self.features(X, mask, L,self.device)
-        h_V = self.W_v(V)
-        h_E = self.W_e(E)
+        if mask is None:
+            mask = torch.ones(X.shape[:2], dtype=torch.float32, device=X.device)
+        _, h_V, h_E, E_idx = self.encode(X, L, mask, X.device)
+        h_V, h_E, E_idx, mask = [i.repeat_interleave(num_samples, 0) for i in (h_V, h_E, E_idx, mask)]
+
+        S = torch.zeros(mask.shape, dtype=torch.int64, device=X.device)
+        confidence = torch.zeros(mask.shape, dtype=torch.float32, device=X.device)
+        known = torch.zeros_like(mask)
+        lengths = torch.sum(mask, dim=-1)
+        # the self edge of E_idx is never a decoded neighbor, as in the strict autoregressive mask of training
+        not_self = (E_idx != torch.arange(E_idx.size(1), device=E_idx.device).view(1, -1, 1)).unsqueeze(-1)
+        for i in range(iterations):
+            mask_attend = gather_nodes(known.unsqueeze(-1), E_idx) * not_self
+            log_probs = self.decode(h_V, h_E, E_idx, self.W_seq(S), mask, mask_attend)[..., :20]
+            if temperature is None:
+                S_new = torch.argmax(log_probs, dim=-1)
+            else:
+                S_new = self._sample_logits(log_probs, temperature)
+            # only the masked positions are re-predicted
+            update = known == 0
+            S = torch.where(update, S_new, S)
+            confidence = torch.where(update, torch.gather(log_probs, -1, S_new.unsqueeze(-1)).squeeze(-1), confidence)
+            if i == iterations - 1:
+                break
+            # re-mask the least confident positions, padding is never kept
+            n_mask = torch.floor(lengths * (iterations - 1 - i) / iterations)
+            ranks = torch.argsort(torch.argsort(confidence.masked_fill(mask == 0, float("inf")), dim=-1), dim=-1)
+            known = (ranks >= n_mask.unsqueeze(-1)).float() * mask
+        return S
 
-        # Encoder is unmasked self-attention
-        mask_attend = gather_nodes(mask.unsqueeze(-1), E_idx).squeeze(-1)
-        mask_attend = mask.unsqueeze(-1) * mask_attend
-        for layer in self.Encoder:
-            h_EV = cat_neighbors_nodes(h_V, h_E, E_idx)
-            h_V, h_E = layer(h_V, h_E, h_EV, E_idx, mask_V=mask, mask_attend=mask_attend)
+    def sample_speculative(self, X, L, mask=None, temperature=1.0, block=8, num_samples=1, return_rounds=False):
+        """ Speculative block decoding, same output distribution as sample()
+        Every round, a parallel draft pass (decoder with the decoded prefix x_<t as decoded neighbors) proposes
+        x_t, ..., x_t+block-1 from q, one teacher forced autoregressive pass over the draft gives p(x_i | x_<i) for
+        the whole block. x_i is accepted with probability min(1, p(x_i) / q(x_i)), the first rejected position is
+        re-sampled from norm(max(0, p - q)), and if the whole block is accepted one more residue is sampled from p.
+        X : [B, N ,5 ,3]
+        temperature : scalar or [B * num_samples]
+        Output :
+        S : [B * num_samples, N]
+        rounds : number of draft + verify rounds (sequential steps), if return_rounds
+        """
+        if mask is None:
+            mask = torch.ones(X.shape[:2], dtype=torch.float32, device=X.device)
+        _, h_V, h_E, E_idx = self.encode(X, L, mask, X.device)
+        h_V, h_E, E_idx, mask = [i.repeat_interleave(num_samples, 0) for i in (h_V, h_E, E_idx, mask)]
+        N_rows, N_nodes = mask.shape
+        rows = torch.arange(N_rows, device=X.device)
+        idx = torch.arange(N_nodes, device=X.device).unsqueeze(0)
+
+        S = torch.zeros((N_rows, N_nodes), dtype=torch.int64, device=X.device)
+        t = torch.zeros(N_rows, dtype=torch.int64, device=X.device)
+        rounds = 0
+        while bool((t < N_nodes).any()):
+            rounds += 1
+            # Draft : every position of the block conditioned on the decoded prefix only
+            known = (idx < t.unsqueeze(-1)).float()
+            log_q = self.decode(h_V, h_E, E_idx, self.W_seq(S), mask, gather_nodes(known.unsqueeze(-1), E_idx))
+            q = F.softmax(log_q[..., :20] / _per_row(temperature, log_q), dim=-1)
+            in_block = (idx >= t.unsqueeze(-1)) & (idx < t.unsqueeze(-1) + block)
+            S_draft = torch.multinomial(q.view(-1, 20), 1).view(N_rows, N_nodes)
+            S_draft = torch.where(in_block, S_draft, S)
+
+            # Verify : autoregressive probabilities of the drafted block in one pass
+            log_p = self.decode(h_V, h_E, E_idx, self.W_seq(S_draft), mask)
+            p = F.softmax(log_p[..., :20] / _per_row(temperature, log_p), dim=-1)
+            p_x = torch.gather(p, -1, S_draft.unsqueeze(-1)).squeeze(-1)
+            q_x = torch.gather(q, -1, S_draft.unsqueeze(-1)).squeeze(-1)
+            accept = torch.rand_like(p_x) * q_x < p_x
+            first_reject = torch.where(in_block & ~accept, idx, N_nodes).min(dim=-1).values
+            rejected = first_reject < N_nodes
+            # positions before the first rejection (or the whole block) are accepted
+            pos = torch.where(rejected, first_reject, torch.clamp(t + block, max=N_nodes))
+            S = torch.where(idx < pos.unsqueeze(-1), S_draft, S)
+
+            # one more residue at pos : from the residual distribution if rejected, else from p
+            pos_index = torch.clamp(pos, max=N_nodes - 1)
+            p_pos, q_pos = p[rows, pos_index], q[rows, pos_index]
+            residual = torch.clamp(p_pos - q_pos, min=0.)
+            residual_sum = residual.sum(-1, keepdim=True)
+            use_residual = rejected.unsqueeze(-1) & (residual_sum > 0)
+            probs = torch.where(use_residual, residual / torch.clamp(residual_sum, min=1e-12), p_pos)
+            S_extra = torch.multinomial(probs, 1).squeeze(-1)
+            has_extra = pos < N_nodes
+            S[rows, pos_index] = torch.where(has_extra, S_extra, S[rows, pos_index])
+            t = torch.where(has_extra, pos + 1, pos)
+        if return_rounds:
+            return S, rounds
+        return S
+
+    def score(self, X, S, L=None, mask=None):
+        """
+        Teacher forced scoring of num_samples sequences per structure, the Encoder runs once per structure
+        X : [B, N, 5, 3]
+        S : [B * num_samples, N] as returned by sample()
+        Output :
+        log_probs_seq [B * num_samples, N, vocab]
+        logits_cctop  [B * num_samples, N, num_tags]
+        """
+        if mask is None:
+            mask = torch.ones(X.shape[:2], dtype=torch.float32, device=X.device)
+        num_samples = S.size(0) // X.size(0)
+        outputs = self.encode(X, L, mask, X.device) + (mask,)
+        h_V_initial, h_V, h_E, E_idx, mask = [i.repeat_interleave(num_samples, 0) for i in outputs]
+        h_S = self.W_seq(S)
+        logits_cctop = self.cctop(h_V_initial, h_V, h_S)
+        log_probs_seq = self.decode(h_V, h_E, E_idx, h_S, mask)
+        return log_probs_seq, logits_cctop
 
-        # h_V_encoder = h_V
+    def _sample_logits(self, logits, temperature=1.0, top_k=0, top_p=1.0):
+        """
+        Sample one amino acid per row of logits [R, ..., vocab]
+        temperature, top_k, top_p : scalars or [R] tensors, top_k = 0 and top_p = 1 keep every amino acid
+        """
+        # mask [MASK] and padding tokens
+        logits = logits[..., :20] / _per_row(temperature, logits)
+        top_k = _per_row(top_k, logits)
+        if bool((top_k > 0).any()):
+            k = torch.where(top_k > 0, top_k, 20).clamp(1, 20).long()
+            logits_sorted = torch.sort(logits, dim=-1, descending=True).values
+            kth = torch.gather(logits_sorted, -1, (k - 1).expand(*logits.shape[:-1], 1))
+            logits = logits.masked_fill(logits < kth, float("-inf"))
+        top_p = _per_row(top_p, logits)
+        if bool((top_p < 1.).any()):
+            # nucleus : smallest set of amino acids with a total probability >= top_p
+            logits_sorted, index = torch.sort(logits, dim=-1, descending=True)
+            probs_sorted = F.softmax(logits_sorted, dim=-1)
+            remove_sorted = torch.cumsum(probs_sorted, dim=-1) - probs_sorted > top_p
+            remove = torch.zeros_like(remove_sorted).scatter(-1, index, remove_sorted)
+            logits = logits.masked_fill(remove, float("-inf"))
+        probs = F.softmax(logits, dim=-1)
+        return torch.multinomial(probs.reshape(-1, 20), 1).view(probs.shape[:-1])
+
+    def beam_search(self, X, L, mask=None, beam_size=4):
+        """
+        Batched beam search over the incremental decoder, the beams of a structure share its Encoder + IPA pass
+        X : [B, N ,5 ,3]
+        Output :
+        S      [B * beam_size, N] beams of structure b are rows b * beam_size, ..., sorted by score
+        scores [B * beam_size]    total log probability of each beam
+        """
+        if not 1 <= beam_size <= 20:
+            # the first step expands a single beam into the 20 amino acids, more beams would start from -inf
+            raise ValueError(f"beam_size must be between 1 and 20, got {beam_size}")
+        N_batch, N_nodes = X.size(0), X.size(1)
+        if mask is None:
+            mask = torch.ones((N_batch, N_nodes), dtype=torch.float32, device=X.device)
+        _, h_V, h_E, E_idx = self.encode(X, L, mask, X.device)
+        cache = self._decoder_cache(h_V, h_E, E_idx, mask, beam_size)
+        N_rows = N_batch * beam_size
+        S = torch.zeros((N_rows, N_nodes), dtype=torch.int64, device=X.device)
+        # all beams start identical, only the first one is expanded at the first step
+        scores = torch.full((N_batch, beam_size), float("-inf"), device=X.device)
+        scores[:, 0] = 0.
+        scores = scores.view(-1)
+        offset = (torch.arange(N_batch, device=X.device) * beam_size).unsqueeze(-1)
+        padding = torch.full((20,), float("-inf"), device=X.device)
+        padding[0] = 0.
+        for t in range(N_nodes):
+            t_rows = torch.full((N_rows,), t, dtype=torch.long, device=X.device)
+            log_probs = F.log_softmax(self._decode_step(cache, t_rows)[..., :20], dim=-1)
+            # padding positions keep token 0 at no cost
+            mask_t = mask[:, t].repeat_interleave(beam_size).unsqueeze(-1)
+            log_probs = torch.where(mask_t > 0, log_probs, padding)
+            candidates = (scores.unsqueeze(-1) + log_probs).view(N_batch, beam_size * 20)
+            top_scores, top_index = torch.topk(candidates, beam_size, dim=-1)
+            parent = (offset + torch.div(top_index, 20, rounding_mode="floor")).view(-1)
+            S_t = (top_index % 20).view(-1)
+            # reorder the beams and their key/value tables
+            S = S[parent]
+            cache["tables"] = [tables[parent] for tables in cache["tables"]]
+            scores = top_scores.view(-1)
+            self._decode_commit(cache, t_rows, S_t)
+            S[:, t] = S_t
+        return S, scores
+
+    def _sample_loop(self, h_V, h_E, E_idx, mask, temperature=1.0, top_k=0, top_p=1.0):
+        """ Reference sampling loop without caches, concatenates and projects the neighbor features of every decoder layer at each step """
         # Decoder alternates masked self-attention
         mask_attend = self._autoregressive_mask(E_idx).unsqueeze(-1)
         mask_1D = mask.view([mask.size(0), mask.size(1), 1, 1])
         mask_bw = mask_1D * mask_attend
         mask_fw = mask_1D * (1. - mask_attend)
-        N_batch, N_nodes = X.size(0), X.size(1)
-        log_probs = torch.zeros((N_batch, N_nodes, 20))
-        h_S = torch.zeros_like(h_V,device=self.device)
-        S = torch.zeros((N_batch, N_nodes), dtype=torch.int64,device=self.device)
+        N_batch, N_nodes = h_V.size(0), h_V.size(1)
+        h_S = torch.zeros_like(h_V)
+        S = torch.zeros((N_batch, N_nodes), dtype=torch.int64,device=h_V.device)
         h_V_stack = [h_V] + [torch.zeros_like(h_V) for _ in range(len(self.Decoder))]
         for t in range(N_nodes):
             # Hidden layers
@@ -816,19 +1234,9 @@ class TMPNN(nn.Module):
 
             # Sampling step
             h_V_t = h_V_stack[-1][:, t, :]
-            logits = self.W_out_seq(h_V_t) / temperature
-            probs = F.softmax(logits, dim=-1)
-            S_t = torch.multinomial(probs, 1).squeeze(-1)
+            S_t = self._sample_logits(self.W_out_seq(h_V_t), temperature, top_k, top_p)
 
             # Update
             h_S[:, t, :] = self.W_seq(S_t)
             S[:, t] = S_t
-
-        # # Using h_S and Encoder information to predict cctop
-        # h_cv = self.act(self.W_cv(h_V + h_S))
-        # logits_cctop = self.W_out_cctop(h_cv)
-        # B,N,C = logits_cctop.shape
-        # # logits_cctop [B, N, C]
-        # C = self.crf.decode_crf(logits_cctop,mask)
         return S
-
@@ -0,0 +1,162 @@
+import gzip
+import os
+
+import numpy as np
+import torch
+
+import data
+
+
+# backbone atoms of the model input X [L, 5, 3], same order as the coords of the jsonl dataset
+ATOMS = ("N", "CA", "C", "CB", "O")
+THREE_TO_ONE = {
+    'ALA': 'A', 'VAL': 'V', 'PHE': 'F', 'PRO': 'P', 'MET': 'M',
+    'ILE': 'I', 'LEU': 'L', 'ASP': 'D', 'GLU': 'E', 'LYS': 'K',
+    'ARG': 'R', 'SER': 'S', 'THR': 'T', 'TYR': 'Y', 'HIS': 'H',
+    'CYS': 'C', 'ASN': 'N', 'GLN': 'Q', 'TRP': 'W', 'GLY': 'G',
+}
+
+
+def virtual_cb(N, CA, C):
+    """ Ideal CB position from the backbone (ProteinMPNN constants), used for glycines and missing CB atoms """
+    b = CA - N
+    c = C - CA
+    a = np.cross(b, c)
+    return -0.58273431 * a + 0.56802827 * b - 0.54067466 * c + CA
+
+
+def _chains(records, name):
+    """
+    records : (chain, residue key, residue name, atom name, xyz) of one model
+    Output :
+    list of {"name", "seq", "coords": {atom: [L, 3]}} per chain, residues without N / CA / C / O are skipped
+    """
+    chains = {}
+    for chain, key, resname, atom, xyz in records:
+        residues = chains.setdefault(chain, {})
+        residue = residues.setdefault(key, {"resname": resname})
+        residue.setdefault(atom, xyz)
+    entries = []
+    for chain, residues in chains.items():
+        seq, coords = [], {atom: [] for atom in ATOMS}
+        for residue in residues.values():
+            if residue["resname"] not in THREE_TO_ONE or any(atom not in residue for atom in ("N", "CA", "C", "O")):
+                continue
+            seq.append(THREE_TO_ONE[residue["resname"]])
+            N, CA, C = [np.asarray(residue[atom], dtype=np.float32) for atom in ("N", "CA", "C")]
+            residue.setdefault("CB", virtual_cb(N, CA, C))
+            for atom in ATOMS:
+                coords[atom].append(np.asarray(residue[atom], dtype=np.float32))
+        if seq:
+            entries.append({
+                "name": f"{name}_{chain}" if chain.strip() else name,
+                "seq": "".join(seq),
+                "coords": {atom: np.stack(xyz) for atom, xyz in coords.items()},
+            })
+    return entries
+
+
+def parse_pdb(text, name="protein"):
+    """ Protein chains of the first model of a PDB file """
+    records = []
+    for line in text.splitlines():
+        if line.startswith("ENDMDL"):
+            break
+        if not line.startswith("ATOM"):
+            continue
+        altloc = line[16]
+        if altloc not in (" ", "A"):
+            continue
+        xyz = (float(line[30:38]), float(line[38:46]), float(line[46:54]))
+        records.append((line[21], (line[22:26], line[26]), line[17:20].strip(), line[12:16].strip(), xyz))
+    return _chains(records, name)
+
+
+def parse_mmcif(text, name="protein"):
+    """ Protein chains of the first model of the _atom_site loop of a mmCIF file """
+    lines = iter(text.splitlines())
+    columns = []
+    for line in lines:
+        if line.startswith("_atom_site."):
+            columns.append(line.split()[0][len("_atom_site."):])
+        elif columns:
+            first = line
+            break
+    else:
+        return []
+    column = {c: i for i, c in enumerate(columns)}
+    atom_id = column.get("auth_atom_id", column.get("label_atom_id"))
+    comp_id = column.get("auth_comp_id", column.get("label_comp_id"))
+    asym_id = column.get("auth_asym_id", column.get("label_asym_id"))
+    seq_id = column.get("auth_seq_id", column.get("label_seq_id"))
+    ins_code = column.get("pdbx_PDB_ins_code")
+    alt_id = column.get("label_alt_id")
+    model_num = column.get("pdbx_PDB_model_num")
+    x, y, z = column["Cartn_x"], column["Cartn_y"], column["Cartn_z"]
+
+    records, model = [], None
+    line = first
+    while line is not None and not line.startswith(("#", "loop_", "_")):
+        fields = line.split()
+        line = next(lines, None)
+        if len(fields) != len(columns) or fields[column["group_PDB"]] != "ATOM":
+            continue
+        if model_num is not None:
+            model = fields[model_num] if model is None else model
+            if fields[model_num] != model:
+                break
+        if alt_id is not None and fields[alt_id] not in (".", "?", "A"):
+            continue
+        key = (fields[seq_id], fields[ins_code] if ins_code is not None else "")
+        xyz = (float(fields[x]), float(fields[y]), float(fields[z]))
+        records.append((fields[asym_id], key, fields[comp_id], fields[atom_id].strip('"'), xyz))
+    return _chains(records, name)
+
+
+def parse_file(path):
+    """ Protein chains of a .pdb / .ent / .cif / .mmcif file, optionally gzipped, named after the file """
+    base = os.path.basename(path)
+    opener = gzip.open if base.endswith(".gz") else open
+    base = base[:-3] if base.endswith(".gz") else base
+    name, ext = os.path.splitext(base)
+    with opener(path, "rt") as f:
+        text = f.read()
+    if ext.lower() in (".cif", ".mmcif"):
+        return parse_mmcif(text, name)
+    return parse_pdb(text, name)
+
+
+def from_coords(coords, seq=None, name="protein"):
+    """
+    Chain entry of backbone coordinates {"N", "CA", "C", "O" (, "CB")}: [L, 3] lists / arrays,
+    a missing CB is replaced by the virtual CB, an unknown sequence by poly-alanine
+    """
+    coords = {atom: np.asarray(xyz, dtype=np.float32) for atom, xyz in coords.items()}
+    missing = [atom for atom in ("N", "CA", "C", "O") if atom not in coords]
+    if missing:
+        raise ValueError(f"missing backbone atoms {missing}")
+    length = len(coords["CA"])
+    if any(coords[atom].shape != (length, 3) for atom in coords):
+        raise ValueError("backbone coordinates must all be [L, 3]")
+    if "CB" not in coords:
+        coords["CB"] = virtual_cb(coords["N"], coords["CA"], coords["C"])
+    seq = seq if seq is not None else "A" * length
+    if len(seq) != length:
+        raise ValueError(f"sequence length {len(seq)} != {length} residues")
+    return {"name": name, "seq": seq, "coords": {atom: coords[atom] for atom in ATOMS}}
+
+
+def to_item(entry):
+    """
+    StructureDataset item of a parsed chain, the cctop labels are unknown (0)
+    """
+    seq = torch.tensor([data.restype_order.get(aa, 0) for aa in entry["seq"]], dtype=torch.long)
+    coord = torch.from_numpy(np.stack([np.asarray(entry["coords"][atom], dtype=np.float32) for atom in ATOMS], axis=-2))
+    return {
+        "name": entry["name"],
+        "coord": torch.nan_to_num(coord),
+        "seq": seq,
+        "cctop": torch.zeros_like(seq),
+        "mask_seq": seq.clone(),
+        "length": torch.tensor([len(seq)], dtype=torch.long),
+    }
@@ -0,0 +1,255 @@
+import json
+import math
+from argparse import ArgumentParser
+
+import numpy as np
+
+import data
+from structure_io import ATOMS, virtual_cb
+
+
+# ideal backbone geometry (Engh & Huber)
+BOND = {"N-CA": 1.458, "CA-C": 1.525, "C-N": 1.329, "C-O": 1.231}
+ANGLE = {"N-CA-C": 111.2, "CA-C-N": 116.2, "C-N-CA": 121.7, "CA-C-O": 120.5}
+# alpha helix torsions
+HELIX_PHI, HELIX_PSI, OMEGA = -57., -47., 180.
+# half thickness of the hydrophobic slab of the membrane (z = 0 is its center)
+MEMBRANE_HALF_WIDTH = 15.
+# distance between the axes of neighboring helices in a bundle
+HELIX_SPACING = 10.
+# amino acid weights of the membrane and of the soluble residues
+MEMBRANE_AA = {"L": 12, "I": 9, "V": 9, "F": 7, "A": 8, "G": 5, "M": 3, "W": 2, "Y": 2, "S": 2, "T": 2, "C": 1}
+SOLUBLE_AA = {"K": 6, "R": 6, "D": 5, "E": 6, "N": 4, "Q": 4, "S": 6, "T": 5, "G": 6, "P": 5, "A": 5, "H": 2,
+              "Y": 2, "L": 4, "V": 3, "I": 2, "F": 2, "M": 1, "W": 1, "C": 1}
+
+
+def place(a, b, c, bond, angle, torsion):
+    """
+    NeRF : position of the atom d bonded to c with |cd| = bond, angle bcd and torsion abcd in degrees
+    """
+    angle, torsion = math.radians(angle), math.radians(torsion)
+    bc = (c - b) / np.linalg.norm(c - b)
+    n = np.cross(b - a, bc)
+    n /= np.linalg.norm(n)
+    m = np.stack([bc, np.cross(n, bc), n], axis=-1)
+    d = np.array([-bond * math.cos(angle), bond * math.sin(angle) * math.cos(torsion), bond * math.sin(angle) * math.sin(torsion)])
+    return c + m @ d
+
+
+def backbone(phi, psi, omega=None):
+    """
+    Backbone of the torsions phi, psi, omega [L] (degrees) with ideal bond lengths and angles
+    Output :
+    {atom: [L, 3]} for N, CA, C, CB, O, CB is the virtual CB
+    """
+    length = len(phi)
+    omega = np.full(length, OMEGA) if omega is None else omega
+    theta = math.radians(180. - ANGLE["N-CA-C"])
+    N = [np.zeros(3)]
+    CA = [np.array([BOND["N-CA"], 0., 0.])]
+    C = [CA[0] + BOND["CA-C"] * np.array([math.cos(theta), math.sin(theta), 0.])]
+    for i in range(length - 1):
+        N.append(place(N[i], CA[i], C[i], BOND["C-N"], ANGLE["CA-C-N"], psi[i]))
+        CA.append(place(CA[i], C[i], N[i + 1], BOND["N-CA"], ANGLE["C-N-CA"], omega[i]))
+        C.append(place(C[i], N[i + 1], CA[i + 1], BOND["CA-C"], ANGLE["N-CA-C"], phi[i + 1]))
+    O = [place(N[i], CA[i], C[i], BOND["C-O"], ANGLE["CA-C-O"], psi[i] + 180.) for i in range(length)]
+    N, CA, C, O = [np.stack(x) for x in (N, CA, C, O)]
+    return {"N": N, "CA": CA, "C": C, "CB": virtual_cb(N, CA, C), "O": O}
+
+
+def _transform(coords, rotation=np.eye(3), translation=np.zeros(3)):
+    return {atom: xyz @ rotation.T + translation for atom, xyz in coords.items()}
+
+
+def _rotation(axis, angle):
+    """ Rotation matrix of angle (radians) around axis """
+    axis = np.asarray(axis, dtype=np.float64) / np.linalg.norm(axis)
+    K = np.array([[0., -axis[2], axis[1]], [axis[2], 0., -axis[0]], [-axis[1], axis[0], 0.]])
+    return np.eye(3) + math.sin(angle) * K + (1. - math.cos(angle)) * K @ K
+
+
+def ideal_helix(length, rng=None, spin=None):
+    """
+    Ideal alpha helix of length residues centered at the origin, its axis along z from the N to the C terminus
+    spin : rotation around the axis in radians, random when rng is given
+    """
+    coords = backbone(np.full(length, HELIX_PHI), np.full(length, HELIX_PSI))
+    CA = coords["CA"]
+    center = CA.mean(0)
+    if length >= 4:
+        axis = np.linalg.svd(CA - center)[2][0]
+        axis = axis if np.dot(CA[-1] - CA[0], axis) >= 0 else -axis
+    else:
+        axis = np.array([0., 0., 1.])
+    z = np.array([0., 0., 1.])
+    cross = np.cross(axis, z)
+    if np.linalg.norm(cross) < 1e-6:
+        rotation = np.eye(3) if axis[2] > 0 else _rotation([1., 0., 0.], math.pi)
+    else:
+        rotation = _rotation(cross, math.acos(np.clip(np.dot(axis, z), -1., 1.)))
+    if spin is None and rng is not None:
+        spin = rng.uniform(0, 2 * math.pi)
+    if spin is not None:
+        rotation = _rotation(z, spin) @ rotation
+    return _transform(coords, rotation, -rotation @ center)
+
+
+def _hex_positions(count):
+    """ Helix axis positions of a bundle, the hexagonal lattice points closest to the center, shell by shell """
+    if count == 1:
+        return np.zeros((1, 2))
+    if count <= 7:
+        radius = HELIX_SPACING / (2 * math.sin(math.pi / count))
+        angles = 2 * math.pi * np.arange(count) / count
+        return radius * np.stack([np.cos(angles), np.sin(angles)], -1)
+    shells = int(math.ceil(math.sqrt(count))) + 1
+    points = np.array([(i + 0.5 * j, math.sqrt(3) / 2 * j) for i in range(-shells, shells + 1) for j in range(-shells, shells + 1)])
+    radius, angle = np.linalg.norm(points, axis=-1), np.arctan2(points[:, 1], points[:, 0])
+    order = np.lexsort((angle, np.round(radius, 3)))
+    return HELIX_SPACING * points[order[:count]]
+
+
+def _loop(start, end, count, rng):
+    """
+    count loop residues between the CA atoms start and end, an arc bulging away from the membrane,
+    the other backbone atoms are placed around CA in the frame of the path (approximate geometry)
+    """
+    outward = np.array([0., 0., 1. if (start[2] + end[2]) >= 0 else -1.])
+    control = (start + end) / 2 + outward * (2. + 1.2 * count) + rng.normal(0, 1., 3)
+    s = np.arange(1, count + 1)[:, None] / (count + 1)
+    CA = (1 - s) ** 2 * start + 2 * s * (1 - s) * control + s ** 2 * end
+    path = np.concatenate([start[None], CA, end[None]])
+    tangent = path[2:] - path[:-2]
+    tangent /= np.linalg.norm(tangent, axis=-1, keepdims=True)
+    normal = np.cross(tangent, outward + rng.normal(0, 0.3, 3))
+    normal /= np.linalg.norm(normal, axis=-1, keepdims=True)
+    N = CA - 1.2 * tangent + 0.8 * normal
+    C = CA + 1.2 * tangent + 0.8 * normal
+    O = C + BOND["C-O"] * normal
+    return {"N": N, "CA": CA, "C": C, "CB": virtual_cb(N, CA, C), "O": O}
+
+
+def helix_bundle(length, rng, helix_length=(20, 26), loop_length=(3, 8), tilt=10.):
+    """
+    Membrane-like bundle of antiparallel helices around the z axis (the membrane normal), connected by loops
+    helix_length, loop_length : ranges of the segment lengths, loops are longer when the helices are far apart
+    tilt : standard deviation of the helix tilt in degrees
+    """
+    helices, total = [], 0
+    while total < length:
+        h = min(int(rng.integers(helix_length[0], helix_length[1] + 1)), length - total)
+        helices.append(h)
+        total += h + loop_length[0]
+    positions = _hex_positions(len(helices))
+
+    segments, total = [], 0
+    for k, h in enumerate(helices):
+        spin = rng.uniform(0, 2 * math.pi)
+        rotation = _rotation([1., 0., 0.], math.pi) if k % 2 == 1 else np.eye(3)
+        rotation = _rotation(rng.normal(size=3) * [1, 1, 0] + [0, 0, 1e-6], math.radians(rng.normal(0, tilt))) @ rotation
+        translation = np.array([*positions[k], rng.normal(0, 1.)])
+        place_helix = lambda n: _transform(ideal_helix(n, spin=spin), rotation, translation)
+        last = k == len(helices) - 1
+        coords = place_helix(h)
+        count = 0
+        if segments:
+            start = segments[-1]["CA"][-1]
+            count = max(int(rng.integers(loop_length[0], loop_length[1] + 1)), int(math.ceil(np.linalg.norm(coords["CA"][0] - start) / 3.3)) - 1)
+            # at least one helix residue is left after the loop
+            count = min(count, length - total - 1)
+        # the last helix takes every residue which is left, the others are cut at length
+        n = length - total - count if last else min(h, length - total - count)
+        if n != h:
+            coords = place_helix(n)
+        if count > 0:
+            segments.append(_loop(start, coords["CA"][0], count, rng))
+            total += count
+        segments.append(coords)
+        total += n
+        if total >= length:
+            break
+    coords = {atom: np.concatenate([segment[atom] for segment in segments]) for atom in ATOMS}
+    assert len(coords["CA"]) == length, (len(coords["CA"]), length)
+    return coords
+
+
+def topology(CA, half_width=MEMBRANE_HALF_WIDTH):
+    """ cctop labels from the depth in the membrane : M inside the slab, O above, I below """
+    z = CA[:, 2]
+    return "".join(np.where(np.abs(z) <= half_width, "M", np.where(z > 0, "O", "I")))
+
+
+def sequence(cctop, rng):
+    """ Random sequence with a hydrophobic membrane composition """
+    membrane = rng.choice(list(MEMBRANE_AA), size=len(cctop), p=np.array(list(MEMBRANE_AA.values())) / sum(MEMBRANE_AA.values()))
+    soluble = rng.choice(list(SOLUBLE_AA), size=len(cctop), p=np.array(list(SOLUBLE_AA.values())) / sum(SOLUBLE_AA.values()))
+    return "".join(m if c == "M" else s for m, s, c in zip(membrane, soluble, cctop))
+
+
+def sample_lengths(num, rng, distribution="lognormal", min_length=50, max_length=500, mean_length=250, sigma=0.5):
+    """ Chain lengths : "fixed" (mean_length), "uniform" in [min_length, max_length] or "lognormal" around mean_length """
+    if distribution == "fixed":
+        lengths = np.full(num, mean_length)
+    elif distribution == "uniform":
+        lengths = rng.integers(min_length, max_length + 1, size=num)
+    elif distribution == "lognormal":
+        lengths = rng.lognormal(math.log(mean_length), sigma, size=num)
+    else:
+        raise ValueError(f"unknown length distribution {distribution}")
+    return np.clip(np.round(lengths), min_length, max_length).astype(int)
+
+
+def generate(num, seed=0, kind="bundle", helix_fraction=0.2, prefix="synthetic", **length_kwargs):
+    """
+    Synthetic entries in the jsonl schema of StructureDataset : {"name", "seq", "cctop", "coords": {N, CA, C, CB, O}}
+    kind : "helix" (single ideal helices), "bundle" (helix bundles) or "mixed" (helix_fraction single helices)
+    length_kwargs : see sample_lengths
+    """
+    rng = np.random.default_rng(seed)
+    for i, length in enumerate(sample_lengths(num, rng, **length_kwargs)):
+        helix = kind == "helix" or (kind == "mixed" and rng.random() < helix_fraction)
+        coords = ideal_helix(length, rng) if helix else helix_bundle(length, rng)
+        cctop = topology(coords["CA"])
+        yield {
+            "name": f"{prefix}_{i}",
+            "seq": sequence(cctop, rng),
+            "cctop": cctop,
+            "coords": {atom: coords[atom].astype(np.float32) for atom in ATOMS},
+        }
+
+
+def synthetic_dataset(num, max_length=500, seed=0, **kwargs):
+    """ StructureDataset of num synthetic chains, no jsonl file is written """
+    kwargs.setdefault("max_length", max_length)
+    return data.StructureDataset(entries=list(generate(num, seed, **kwargs)), max_length=max_length)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Synthetic helix / helix bundle backbones in the jsonl dataset format')
+    parser.add_argument('--num', type=int, default=1000, help='number of chains')
+    parser.add_argument('--output', type=str, default="synthetic.jsonl")
+    parser.add_argument('--split_json', type=str, default=None, help='also write a train / validation / test split of the names')
+    parser.add_argument('--split', type=float, nargs=3, default=[0.8, 0.1, 0.1])
+    parser.add_argument('--kind', type=str, default="mixed", choices=["helix", "bundle", "mixed"])
+    parser.add_argument('--helix_fraction', type=float, default=0.2, help='single helices of --kind mixed')
+    parser.add_argument('--length_distribution', type=str, default="lognormal", choices=["fixed", "uniform", "lognormal"])
+    parser.add_argument('--min_length', type=int, default=50)
+    parser.add_argument('--max_length', type=int, default=500)
+    parser.add_argument('--mean_length', type=int, default=250)
+    parser.add_argument('--sigma', type=float, default=0.5, help='log standard deviation of the lognormal lengths')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    names = []
+    with open(args.output, "w") as f:
+        for entry in generate(args.num, args.seed, args.kind, args.helix_fraction, distribution=args.length_distribution,
+                              min_length=args.min_length, max_length=args.max_length, mean_length=args.mean_length, sigma=args.sigma):
+            entry["coords"] = {atom: np.round(xyz, 3).tolist() for atom, xyz in entry["coords"].items()}
+            f.write(json.dumps(entry) + "\n")
+            names.append(entry["name"])
+    if args.split_json is not None:
+        bounds = np.cumsum(np.array(args.split) / sum(args.split) * len(names)).round().astype(int)
+        splits = dict(zip(["train", "validation", "test"], np.split(np.array(names), bounds[:-1])))
+        with open(args.split_json, "w") as f:
+            json.dump({k: v.tolist() for k, v in splits.items()}, f)
+    print(f"{len(names)} synthetic chains -> {args.output}")
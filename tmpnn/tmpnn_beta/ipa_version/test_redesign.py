@@ -1,4 +1,4 @@
-import json, time, os, sys, glob, copy
+import json, time, os, sys, copy
 
 import numpy as np
 import torch
@@ -12,10 +12,11 @@ import struct2seq
 import utils
 import protein_features
 import data
+import export
+import metrics
 import utils
 # Debug plotting
 import matplotlib
-import glob
 import pandas as pd
 from argparse import ArgumentParser
 
@@ -28,22 +29,41 @@ plt.switch_backend('agg')
 parser = ArgumentParser(description='Structure to sequence modeling')
 parser.add_argument('--data_jsonl', type=str,help='Path for the jsonl data')
 parser.add_argument('--split_json', type=str, help='Path for the split json file')
-parser.add_argument('--checkpoint',type=str,help="model parameters")
+parser.add_argument('--checkpoint',type=str,help="model parameters, exported weights (export.py) or a training checkpoint")
 parser.add_argument('--output',default="./",type=str,help="output parameters")
 parser.add_argument('--temperature', type=float, default=1.0, help='Temperature to sample an amino acid')
+parser.add_argument('--temperatures', type=float, nargs='+', default=None, help='Temperature sweep sampled in one batched call, overrides --temperature')
+parser.add_argument('--top_k', type=int, default=0, help='Sample from the k most likely amino acids, 0 disables')
+parser.add_argument('--top_p', type=float, default=1.0, help='Nucleus sampling probability mass, 1.0 disables')
+parser.add_argument('--beam_size', type=int, default=4, help='Beams per backbone for --design_mode beam, at most 20')
 parser.add_argument('--batch_size',type=int,default=7000,help="batch size tokens")
 parser.add_argument('--cctop',type=bool,default=True,help="batch size tokens")
+parser.add_argument('--max_length',type=int,default=1300,help="max length of the test sequence")
+parser.add_argument('--num_samples',type=int,default=10,help="sequences sampled per backbone")
+parser.add_argument('--design_mode',type=str,default="autoregressive",choices=["autoregressive","mask_predict","speculative","beam"],help="sequence design algorithm")
+parser.add_argument('--iterations',type=int,default=5,help="mask-predict iterations")
+parser.add_argument('--block',type=int,default=8,help="drafted residues per speculative decoding round")
+parser.add_argument('--fixed_positions_json',type=str,default=None,help="json {name: [1-based residue numbers]} of residues kept native, only the others are redesigned")
+parser.add_argument('--fixed_first',action="store_true",help="decode the fixed positions first in one pass, the time then scales with the designed residues. Same order as training when the fixed positions precede all designed ones, otherwise validate it first")
+parser.add_argument('--omit_AAs',type=str,default="",help="amino acids which are never sampled, e.g. CM")
+parser.add_argument('--bias_AA',type=str,default="",help="per amino acid logit bias, e.g. A=-0.5,W=1.0")
+parser.add_argument('--records_format',type=str,default="csv",choices=["csv","parquet"],help="per sample records, written once at the end")
+parser.add_argument('--fasta',action="store_true",help="also stream the native and designed sequences to designs.fa")
 
 
 args = parser.parse_args()
+if (args.fixed_positions_json or args.omit_AAs or args.bias_AA) and args.design_mode != "autoregressive":
+    parser.error("--fixed_positions_json, --omit_AAs and --bias_AA need --design_mode autoregressive")
+if args.design_mode == "beam" and not 1 <= args.beam_size <= 20:
+    parser.error("--beam_size must be between 1 and 20")
+# ValueError before the model and the data are loaded, e.g. when every amino acid is omitted
+bias_AA, omit_AA = data.aa_bias(args.bias_AA, args.omit_AAs)
 
 
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-model = struct2seq.TMPNN(device=device) #此处的device是为了初始化device,之后就可以正常调用了
-model = model.to(device) #模型参数全部给device
-checkpoint = torch.load(args.checkpoint, map_location=device)
-model.load_state_dict(checkpoint['model_state_dict'])
+# exported weights (export.py) or a training checkpoint, the model is built from the stored hyperparams
+model = export.load_model(args.checkpoint, device)
 criterion = torch.nn.NLLLoss(reduction='none')
 
 # Load the test set from a splits file
@@ -51,27 +71,23 @@ with open(args.split_json) as f:
     dataset_splits = json.load(f)
 test_names = dataset_splits['test']
 # Load the dataset
-dataset = data.StructureDataset(jsonl_file=jsonl_file, max_length=args.max_length,high_fraction=args.mask) # total dataset of the pdb files
-
-# 统一所有的数据格式
-for i in dataset:
-    i['length'] = len(i['seq'])
-for i in dataset:
-    if 'cctop' not in i.keys():
-        i['cctop'] = "I"*i['length']
-    i['cctop'] = i['cctop'].replace("T","S") #替换减少一类
-for i in dataset:
-    if "AF" in i['name']:
-        i['name'] += "_A"
+dataset = data.StructureDataset(jsonl_file=args.data_jsonl, max_length=args.max_length) # total dataset of the pdb files, AF names and cctop labels are handled there
 # Split the dataset
 dataset_indices = {d['name']:i for i,d in enumerate(dataset)}
-test_set = Subset(dataset, [dataset_indices[name] for name in test_names])
+test_set = Subset(dataset, [dataset_indices[name] for name in test_names if name in dataset_indices])
 loader_test = data.StructureLoader(test_set, batch_size=args.batch_size)
 print('Testing {} domains'.format(len(test_set)))
 
+# Partial redesign : fixed residues and amino acid bias / omit lists
+fixed_positions = {}
+if args.fixed_positions_json is not None:
+    with open(args.fixed_positions_json) as f:
+        fixed_positions = json.load(f)
+bias_AA, omit_AA = bias_AA.to(device), omit_AA.to(device)
+
 
 def _plot_log_probs(log_probs, total_step):
-    alphabet = 'ACDEFGHIKLMNPQRSTVWY'
+    alphabet = ''.join(data.restypes)
     reorder = 'DEKRHQNSTPGAVILMCFWY'
     permute_ix = np.array([alphabet.index(c) for c in reorder])
     plt.close()
@@ -106,16 +122,17 @@ def _scores(S, log_probs, mask):
     scores = torch.sum(loss * mask, dim=-1) / torch.sum(mask, dim=-1)
     return scores
 
-def recovery(x,y):
-    return np.mean([i==j for i,j in zip(x,y)])
+def _identity(A, B, mask):
+    """ Fraction of identical tokens per row of A [R, N] and B [1 or R, N] """
+    return torch.sum(A.eq(B).float() * mask, dim=-1) / torch.sum(mask, dim=-1)
 
 def _S_to_seq(S, mask):
-    alphabet = 'ACDEFGHIKLMNPQRSTVWY'
+    alphabet = data.restypes
     seq = ''.join([alphabet[c] for c, m in zip(S.tolist(), mask.tolist()) if m > 0])
     return seq
 
 def _cctop(C,mask):
-    alphabet = "IMOSL"
+    alphabet = data.cctop_code
     cctop = ''.join([alphabet[c] for c, m in zip(C.tolist(), mask.tolist()) if m > 0])
     return cctop
 
@@ -124,114 +141,97 @@ def _cctop(C,mask):
 base_folder = args.output
 if not os.path.exists(base_folder):
     os.makedirs(base_folder)
-for subfolder in ['alignments']:
-    if not os.path.exists(base_folder + subfolder):
-        os.makedirs(base_folder + subfolder)
 logfile = base_folder + '/log.txt'
 with open(base_folder + '/hyperparams.json', 'w') as f:
     json.dump(vars(args), f)
 
 
-BATCH_COPIES = 10
+BATCH_COPIES = args.num_samples
 NUM_BATCHES = 1
 # temperatures = [1.0, 0.33, 0.1, 0.033, 0.01]
-temperatures = [args.temperature] 
+temperatures = args.temperatures if args.temperatures is not None else [args.temperature]
+if args.design_mode == "beam":
+    temperatures, BATCH_COPIES = [0.0], args.beam_size
+# every temperature gets BATCH_COPIES rows of one batched sampling call
+NUM_ROWS = len(temperatures) * BATCH_COPIES
+temperature_rows = torch.tensor(temperatures, dtype=torch.float32, device=device).repeat_interleave(BATCH_COPIES)
 
 # Timing
 start_time = time.time()
 total_residues = 0
+residues_per_second = 0.
+
+# per sample records, the DataFrame is built once at the end
+records = metrics.RecordAccumulator()
+fasta = open(base_folder + 'designs.fa', 'w') if args.fasta else None
 
 total_step = 0
 # Validation epoch
 model.eval()
-alphabet = "IMOULS"
 with torch.no_grad():
-    test_sum, test_weights = 0., 0.
     for ix, protein in enumerate(test_set):
-        
-        batch_clones = [copy.deepcopy(protein) for i in range(BATCH_COPIES)]
-        X, S,C,mask, lengths = utils.featurize(batch_clones, device, shuffle_fraction=0.)
+        # featurize the backbone once, the BATCH_COPIES samples share the Encoder + IPA outputs
+        batch = data.batch_collate_function([protein])
+        X, S, C, mask, lengths = [batch[key].to(device) for key in ["coord", "seq", "cctop", "mask", "length"]]
         log_probs,logits_cctop = model(X=X, S=S,L=lengths, mask=mask,device=device)
-        logits_cctop_top = logits_cctop[0].unsqueeze(0)
-        mask_top = mask[0].unsqueeze(0)
-        pred_cctop = (model.decode_crf(logits_cctop_top,mask_top))[0]
-        scores = _scores(S, log_probs, mask)
-        native_score = scores.cpu().data.numpy()[0]
-        print(scores)
-
-        # Generate some sequences
-        ali_file = base_folder + 'alignments/' + batch_clones[0]['name'] + '.fa'
-        
-        with open(ali_file, 'w') as f:
-            native_seq = _S_to_seq(S[0], mask[0])
-            native_cctop = _cctop(C[0],mask[0])
-            pred_cctop = "".join([alphabet[idx] for idx in pred_cctop])
-            f.write('>Native, score={}\n{}\n'.format(native_score, native_seq))
-            f.write(f">Ncctop,{native_cctop}\n")
-            f.write(f">Pcctop,{pred_cctop}\n{np.mean([i==j for i,j in zip(native_cctop,pred_cctop)]) :.3f}\n")
-            for temp in temperatures:
-                for j in range(NUM_BATCHES):
-                    S_sample = model.sample(X, lengths, mask, temperature=temp)
-
-                    # Compute scores
-
-                    log_probs,logits_cctop = model(X, S_sample, lengths, mask,device=device)
-                    batch_cctop = model.decode_crf(logits_cctop,mask)
-
-                    scores = _scores(S_sample, log_probs, mask)
-                    scores = scores.cpu().data.numpy()
-
-                    for b_ix in range(BATCH_COPIES):
-                        seq = _S_to_seq(S_sample[b_ix], mask[0])
-                        pred_cctop_idx = batch_cctop[b_ix]
-                        pred_cctop = "".join([alphabet[idx] for idx in pred_cctop_idx])
-                        score = scores[b_ix]
-                        f.write(f'>T={temp},sample={b_ix},score={score},recovery={recovery(seq,native_seq) :.3f},acc={np.mean([i==j for i,j in zip(native_cctop,pred_cctop)]) :.3f}\n{seq}\n{pred_cctop}\n')
-
-                    total_residues += torch.sum(mask).cpu().data.numpy()
-                    elapsed = time.time() - start_time
-                    residues_per_second = float(total_residues) / float(elapsed)
-                    print('{} residues / s'.format(residues_per_second))
-
-                frac_recovery = torch.sum(mask * (S.eq(S_sample).float())) / torch.sum(mask)
-                frac_recovery = frac_recovery.cpu().data.numpy()
-                # print(mask)
-                # print(frac_recovery, torch.numel(mask), torch.sum(mask).cpu().data.numpy(), batch_clones[0]['name'])
-                print(frac_recovery)
-
-# Plot the results
-files = glob.glob(base_folder + 'alignments/*.fa')
-df = pd.DataFrame(columns=['name', 'T', 'score', 'similarity'])
-
-def similarity(seq1, seq2):
-    matches = sum([c1==c2 for c1, c2 in zip(seq1,seq2)])
-    return float(matches) / len(seq1)
-
-for file in files:
-    with open(file, 'r') as f:
-        # Skip over native
-        entries = f.read().split('>')[1:]
-        entries = [e.strip().split('\n') for e in entries]
-
-        # Get native information
-        native_header = entries[0][0]
-        native_score = float(native_header.split(', ')[1].split('=')[1])
-        native_seq = entries[0][1]
-        # print(entries[0])
-        # print(native_score)
-
-        for header, seq in entries[1:]:
-            T, sample, score = [float(s.split('=')[1]) for s in header.split(', ')]
-            pdb, chain = file.split('/')[-1].split('.')[0:2]
-
-            df = df.append({
-                'name': pdb + '.' + chain,
-                'T': T, 'score': score,
-                'native': native_score,
-                'similarity': similarity(native_seq, seq)
-                },  ignore_index=True
+        pred_cctop = model.decode_crf(logits_cctop,mask)
+        native_score = _scores(S, log_probs, mask)
+        native_acc = _identity(pred_cctop, C, mask)
+
+        for j in range(NUM_BATCHES):
+            if args.design_mode == "mask_predict":
+                S_sample = model.mask_predict(X, lengths, mask, iterations=args.iterations, temperature=temperature_rows, num_samples=NUM_ROWS)
+            elif args.design_mode == "speculative":
+                S_sample, rounds = model.sample_speculative(X, lengths, mask, temperature=temperature_rows, block=args.block, num_samples=NUM_ROWS, return_rounds=True)
+                print(f'{rounds} speculative rounds for {S_sample.size(1)} residues')
+            elif args.design_mode == "beam":
+                S_sample, _ = model.beam_search(X, lengths, mask, beam_size=args.beam_size)
+            else:
+                fixed = torch.zeros_like(mask)
+                fixed[0, [i - 1 for i in fixed_positions.get(protein['name'], [])]] = 1.
+                S_sample = model.sample(X, lengths, mask, temperature=temperature_rows, num_samples=NUM_ROWS, top_k=args.top_k, top_p=args.top_p,
+                                        S=S, fixed=fixed, bias=bias_AA, omit=omit_AA, fixed_first=args.fixed_first)
+
+            # Compute scores, recovery and cctop accuracy of every row on device, one transfer per protein
+            mask_sample = mask.expand(NUM_ROWS, -1)
+            log_probs,logits_cctop = model.score(X, S_sample, lengths, mask)
+            batch_cctop = model.decode_crf(logits_cctop,mask_sample)
+            values = torch.stack([
+                _scores(S_sample, log_probs, mask_sample),
+                _identity(S_sample, S, mask_sample),
+                _identity(batch_cctop, C, mask_sample),
+            ], -1).cpu().numpy()
+            native = torch.cat([native_score, native_acc]).cpu().numpy()
+
+            records.add(
+                name=protein['name'],
+                T=np.repeat(np.asarray(temperatures, dtype=np.float32), BATCH_COPIES),
+                sample=np.tile(np.arange(BATCH_COPIES), len(temperatures)),
+                score=values[:, 0],
+                native=native[0],
+                recovery=values[:, 1],
+                cctop_acc=values[:, 2],
+                native_cctop_acc=native[1],
             )
+            if fasta is not None:
+                fasta.write(f">{protein['name']},native,score={native[0]:.4f}\n{_S_to_seq(S[0], mask[0])}\n{_cctop(C[0], mask[0])}\n")
+                for b_ix in range(NUM_ROWS):
+                    fasta.write(f">{protein['name']},T={temperatures[b_ix // BATCH_COPIES]},sample={b_ix % BATCH_COPIES},"
+                                f"score={values[b_ix, 0]:.4f},recovery={values[b_ix, 1]:.3f},acc={values[b_ix, 2]:.3f}\n"
+                                f"{_S_to_seq(S_sample[b_ix], mask[0])}\n{_cctop(batch_cctop[b_ix], mask[0])}\n")
+
+            total_residues += float(lengths.sum()) * NUM_ROWS
+            elapsed = time.time() - start_time
+            residues_per_second = float(total_residues) / float(elapsed)
+
+        if ix % 100 == 0:
+            print(f'{ix + 1}/{len(test_set)} {protein["name"]} recovery {values[:, 1].mean():.3f} {residues_per_second:.1f} residues / s')
+
+if fasta is not None:
+    fasta.close()
 
+# Store the per sample records once
+df = records.write(base_folder + f'samples.{args.records_format}')
 df['diff'] = -(df['score'] - df['native'])
 
 boxplot = df.boxplot(column='diff', by= 'T')
@@ -242,7 +242,7 @@ boxplot.get_figure().suptitle('')
 plt.tight_layout()
 plt.savefig(base_folder + 'decoding.pdf')
 
-boxplot = df.boxplot(column='similarity', by= 'T')
+boxplot = df.boxplot(column='recovery', by= 'T')
 plt.xlabel('Decoding temperature')
 plt.ylabel('Native sequence recovery')
 boxplot.get_figure().gca().set_title('')
@@ -251,8 +251,8 @@ plt.tight_layout()
 plt.savefig(base_folder + 'recovery.pdf')
 
 # Store the results
-df_mean = df.groupby(['name', 'T'], as_index=False).mean()
+df_mean = df.drop(columns=['sample']).groupby(['name', 'T'], as_index=False).mean()
 df_mean.to_csv(base_folder + 'results.csv')
 
 print('Speed total: {} residues / s'.format(residues_per_second))
-print('Median', df_mean['similarity'].median())
+print('Median', df_mean['recovery'].median())
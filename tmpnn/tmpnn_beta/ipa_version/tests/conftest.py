@@ -0,0 +1,32 @@
+import os
+import sys
+
+import pytest
+import torch
+
+# the modules of ipa_version import each other as top level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark
+import struct2seq
+
+
+@pytest.fixture
+def model():
+    """ Small randomly initialized TMPNN in eval mode, fast enough for the sequential samplers on cpu """
+    torch.manual_seed(0)
+    return struct2seq.TMPNN(device=torch.device("cpu"), node_features=32, edge_features=32, hidden_dim=32,
+                            num_encoder_layers=2, num_decoder_layers=2, ipa_layer=1, k_neighbors=8, dropout=0.).eval()
+
+
+@pytest.fixture
+def backbone():
+    """
+    backbone(batch_size, length) : synthetic helix bundles
+    Output :
+    X [B, L, 5, 3], L [B, 1]
+    """
+    def make(batch_size, length, seed=0):
+        X = benchmark.helix_backbone(batch_size, length, torch.device("cpu"), seed)
+        return X, torch.full((batch_size, 1), length, dtype=torch.long)
+    return make
@@ -0,0 +1,86 @@
+import itertools
+
+import pytest
+import torch
+
+from crf import CRF
+
+
+# L = 6 : the odd number of transfer matrices takes the padding branch of the tree reduction
+LENGTHS = [6, 5, 3, 1]
+
+
+def _crf(num_tags=5, seed=0):
+    """ CRF with transitions large enough that the best path is not simply the best tag of every residue """
+    torch.manual_seed(seed)
+    crf = CRF(num_tags)
+    with torch.no_grad():
+        for parameter in crf.parameters():
+            parameter.normal_()
+    return crf
+
+
+def _inputs(crf, lengths, seed=0):
+    """ emissions [B, L, C] and the ragged mask [B, L] of the given lengths """
+    generator = torch.Generator().manual_seed(seed)
+    emissions = torch.randn(len(lengths), max(lengths), crf.num_tags, generator=generator)
+    mask = (torch.arange(max(lengths)) < torch.tensor(lengths).unsqueeze(1)).float()
+    return emissions, mask
+
+
+def _path_scores(crf, emissions, length):
+    """ All num_tags ** length paths [P, length] of one sequence emissions [L, C] and their scores [P] """
+    paths = torch.tensor(list(itertools.product(range(crf.num_tags), repeat=length)))
+    positions = torch.arange(length)
+    scores = crf.start_transitions[paths[:, 0]] + crf.end_transitions[paths[:, -1]]
+    scores = scores + emissions[positions, paths].sum(-1)
+    scores = scores + crf.transitions[paths[:, :-1], paths[:, 1:]].sum(-1)
+    return paths, scores
+
+
+@pytest.mark.parametrize("lengths", [LENGTHS, [1, 1]])
+def test_viterbi_matches_enumeration(lengths):
+    """ decode returns the highest scoring of all paths, padding positions are 0 """
+    crf = _crf()
+    emissions, mask = _inputs(crf, lengths)
+    tags = crf.decode(emissions, mask)
+    with torch.no_grad():
+        for b, length in enumerate(lengths):
+            paths, scores = _path_scores(crf, emissions[b], length)
+            assert tags[b, :length].tolist() == paths[scores.argmax()].tolist(), b
+            assert not bool(tags[b, length:].any()), b
+
+
+@pytest.mark.parametrize("lengths", [LENGTHS, [1, 1]])
+def test_log_likelihood_matches_enumeration(lengths):
+    """ forward is the path score minus log Z of all paths, for random and for the Viterbi tags """
+    crf = _crf()
+    emissions, mask = _inputs(crf, lengths)
+    generator = torch.Generator().manual_seed(1)
+    for tags in (torch.randint(0, crf.num_tags, mask.shape, generator=generator), crf.decode(emissions, mask)):
+        llh = crf(emissions, tags, mask, reduction="none")
+        expected = []
+        with torch.no_grad():
+            for b, length in enumerate(lengths):
+                paths, scores = _path_scores(crf, emissions[b], length)
+                index = (paths == tags[b, :length]).all(-1).nonzero().item()
+                expected.append(scores[index] - torch.logsumexp(scores, 0))
+        torch.testing.assert_close(llh, torch.stack(expected))
+    # log probabilities of a normalized distribution over the paths
+    assert bool((llh <= 0).all())
+
+
+def test_log_likelihood_gradient_matches_enumeration():
+    """ The tree reduction backpropagates like the enumerated log-sum-exp """
+    crf, reference = _crf(), _crf()
+    emissions, mask = _inputs(crf, LENGTHS)
+    tags = crf.decode(emissions, mask)
+    crf(emissions, tags, mask).backward()
+    loss = 0.
+    for b, length in enumerate(LENGTHS):
+        paths, scores = _path_scores(reference, emissions[b], length)
+        index = (paths == tags[b, :length]).all(-1).nonzero().item()
+        loss = loss + scores[index] - torch.logsumexp(scores, 0)
+    loss.backward()
+    for (name, parameter), expected in zip(crf.named_parameters(), reference.parameters()):
+        torch.testing.assert_close(parameter.grad, expected.grad, msg=name)
@@ -0,0 +1,24 @@
+import pytest
+import torch
+
+import export
+import struct2seq
+
+
+@pytest.mark.parametrize("suffix", [".pt", ".safetensors"])
+def test_load_model_round_trip(tmp_path, suffix):
+    """ Weights exported from a training checkpoint come back in a model built on the meta device """
+    if suffix == ".safetensors":
+        pytest.importorskip("safetensors")
+    hyperparams = {"num_tags": 5, "ipa_layer": 1, "encoder_layer": 1, "decoder_layer": 1, "epochs": 10}
+    torch.manual_seed(0)
+    model = struct2seq.TMPNN(device=torch.device("cpu"), **export.model_hyperparams(hyperparams)).eval()
+    checkpoint, output = str(tmp_path / "epoch1.pt"), str(tmp_path / f"model{suffix}")
+    torch.save({"hyperparams": hyperparams, "model_state_dict": model.state_dict(), "optimizer_state_dict": {}}, checkpoint)
+    export.export(checkpoint, output)
+    normal_ = torch.nn.init.normal_
+    loaded = export.load_model(output)
+    # the init functions are restored after the meta construction
+    assert torch.nn.init.normal_ is normal_
+    torch.testing.assert_close(loaded.state_dict(), model.state_dict(), rtol=0, atol=0)
+    assert loaded.W_out_seq.weight is loaded.W_seq.weight
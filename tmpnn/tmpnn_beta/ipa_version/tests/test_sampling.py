@@ -0,0 +1,91 @@
+import itertools
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+import data
+
+
+def _marginals(S, num_classes=20):
+    """ Per position amino acid frequencies [N, 20] of the rows of S [R, N] """
+    return F.one_hot(S, num_classes).float().mean(0)
+
+
+def _exact_marginals(model, X, L, temperature):
+    """ Per position marginals [N, 20] of the autoregressive distribution, enumerating all 20^N sequences """
+    N = X.size(1)
+    S = torch.tensor(list(itertools.product(range(20), repeat=N)))
+    with torch.no_grad():
+        log_probs, _ = model.score(X, S, L)
+    log_p = F.log_softmax(log_probs[..., :20] / temperature, dim=-1)
+    # log p(S) = sum_i log p(s_i | s_<i), only valid because decode is autoregressive
+    p = torch.exp(torch.gather(log_p, -1, S.unsqueeze(-1)).squeeze(-1).sum(-1))
+    return torch.stack([torch.zeros(20).index_add_(0, S[:, i], p) for i in range(N)])
+
+
+def test_speculative_greedy_matches_sample(model, backbone):
+    """ Near zero temperature both samplers are greedy, so speculative decoding must reproduce sample() """
+    X, L = backbone(2, 30)
+    with torch.no_grad():
+        torch.manual_seed(0)
+        S = model.sample(X, L, temperature=1e-4)
+        for block in (1, 4, 8):
+            torch.manual_seed(1)
+            assert torch.equal(model.sample_speculative(X, L, temperature=1e-4, block=block), S)
+
+
+def test_speculative_marginals_match_sample(model, backbone):
+    """ Accept / reject + residual resampling keeps the distribution of sample() (exact marginals of a 3 residue chain) """
+    X, L = backbone(1, 3)
+    temperature, num_samples = 0.3, 20000
+    expected = _exact_marginals(model, X, L, temperature)
+    with torch.no_grad():
+        torch.manual_seed(0)
+        sampled = _marginals(model.sample(X, L, temperature=temperature, num_samples=num_samples))
+        # block 2 < N also covers the extra residue sampled after a fully accepted block
+        speculative = {block: _marginals(model.sample_speculative(X, L, temperature=temperature, block=block, num_samples=num_samples))
+                       for block in (2, 8)}
+    # total variation distance of every position, the sampling noise is about 0.01 at 20000 samples
+    assert (0.5 * (sampled - expected).abs().sum(-1)).max() < 0.03
+    for block, marginals in speculative.items():
+        assert (0.5 * (marginals - expected).abs().sum(-1)).max() < 0.03, block
+
+
+def test_beam_search(model, backbone):
+    """ One beam is greedy decoding, every returned beam has a finite score, also for a chain of one residue """
+    X, L = backbone(2, 20)
+    mask = torch.ones(X.shape[:2])
+    mask[1, 1:] = 0.
+    with torch.no_grad():
+        S, _ = model.beam_search(X, L, beam_size=1)
+        assert torch.equal(S, model.sample(X, L, temperature=1e-4))
+        S, scores = model.beam_search(X, L, mask, beam_size=20)
+    assert S.shape == (40, 20) and bool(torch.isfinite(scores).all())
+    assert bool((scores.view(2, 20)[:, :-1] >= scores.view(2, 20)[:, 1:]).all())
+    with pytest.raises(ValueError):
+        model.beam_search(X, L, beam_size=21)
+
+
+def test_fixed_first_prefix_matches_default(model, backbone):
+    """ With a fixed N-terminal segment fixed_first decodes in the training order, fixed residues stay native """
+    X, L = backbone(2, 30)
+    S_native = torch.randint(0, 20, (2, 30))
+    fixed = torch.zeros(2, 30)
+    fixed[:, :10] = 1.
+    with torch.no_grad():
+        S = model.sample(X, L, temperature=1e-4, S=S_native, fixed=fixed)
+        S_first = model.sample(X, L, temperature=1e-4, S=S_native, fixed=fixed, fixed_first=True)
+    assert torch.equal(S_first, S)
+    assert torch.equal(S[:, :10], S_native[:, :10])
+
+
+def test_omit_all_amino_acids(model, backbone):
+    """ Omitting every amino acid is rejected when the options are parsed, and by sample() """
+    with pytest.raises(ValueError):
+        data.aa_bias(omit_AAs=data.restypes)
+    bias, omit = data.aa_bias("A=-0.5, W=1", "CM")
+    assert bias[data.restype_order["W"]] == 1. and int(omit.sum()) == 2
+    X, L = backbone(1, 10)
+    with pytest.raises(ValueError):
+        model.sample(X, L, omit=torch.ones(20, dtype=torch.bool))
@@ -0,0 +1,50 @@
+import torch
+import torch.nn.functional as F
+
+from protein_features import cat_neighbors_nodes, gather_nodes
+
+
+def _ragged_mask(X):
+    mask = torch.ones(X.shape[:2])
+    mask[1:, -5:] = 0.
+    return mask
+
+
+def test_factored_encoder_keys_values(model, backbone):
+    """ EncoderLayer with h_EV=None (factored W_K / W_V) matches the projection of the concatenated [h_E, h_V_j] """
+    X, L = backbone(2, 24)
+    mask = _ragged_mask(X)
+    with torch.no_grad():
+        V, E, E_idx, _ = model.features(X, mask, L, X.device)
+        h_V, h_E = model.W_v(V), model.W_e(E)
+        mask_attend = mask.unsqueeze(-1) * gather_nodes(mask.unsqueeze(-1), E_idx).squeeze(-1)
+        for layer in model.Encoder:
+            h_EV = cat_neighbors_nodes(h_V, h_E, E_idx)
+            h_V_old, h_E_old = layer(h_V, h_E, h_EV, E_idx, mask, mask_attend)
+            h_V, h_E = layer(h_V, h_E, None, E_idx, mask, mask_attend)
+            torch.testing.assert_close(h_V, h_V_old)
+            torch.testing.assert_close(h_E, h_E_old)
+
+
+def test_factored_decoder_keys_values(model, backbone):
+    """ TMPNN.decode matches the decoder loop over the concatenated [h_E, h_S_j, h_V_j] of the baseline """
+    X, L = backbone(2, 24)
+    mask = _ragged_mask(X)
+    S = torch.randint(0, 20, mask.shape)
+    with torch.no_grad():
+        _, h_V, h_E, E_idx = model.encode(X, L, mask, X.device)
+        h_S = model.W_seq(S)
+        log_probs = model.decode(h_V, h_E, E_idx, h_S, mask)
+
+        mask_attend = model._autoregressive_mask(E_idx).unsqueeze(-1)
+        mask_1D = mask.view([mask.size(0), mask.size(1), 1, 1])
+        mask_bw = mask_1D * mask_attend
+        mask_fw = mask_1D * (1. - mask_attend)
+        h_ES = cat_neighbors_nodes(h_S, h_E, E_idx)
+        h_ES_encoder = cat_neighbors_nodes(torch.zeros_like(h_S), h_E, E_idx)
+        h_ESV_encoder_fw = mask_fw * cat_neighbors_nodes(h_V, h_ES_encoder, E_idx)
+        for layer in model.Decoder:
+            h_ESV = mask_bw * cat_neighbors_nodes(h_V, h_ES, E_idx) + h_ESV_encoder_fw
+            h_V = layer(h_V, h_ESV, mask_V=mask)
+        log_probs_old = F.log_softmax(model.W_out_seq(h_V), dim=-1)
+    torch.testing.assert_close(log_probs, log_probs_old)
@@ -0,0 +1,72 @@
+import os
+import subprocess
+import sys
+
+import pytest
+import torch
+
+import struct2seq
+import utils
+
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# a one layer model on a few short chains, several optimizer steps per epoch
+TRAIN_ARGS = ["--epochs", "2", "--batch_size", "100", "--max_length", "100", "--encoder_layer", "1", "--decoder_layer", "1",
+              "--ipa_layer", "1", "--log_every", "1", "--metrics_backend", "local", "--seed", "3"]
+
+
+def _run(script, *args):
+    subprocess.run([sys.executable, os.path.join(HERE, script), *args], cwd=HERE, check=True, capture_output=True,
+                   env=dict(os.environ, CUDA_VISIBLE_DEVICES=""))
+
+
+def _checkpoints(output):
+    """ {file name: checkpoint} of the epoch checkpoints of a run """
+    folder = os.path.join(output, "checkpoints")
+    return {name: torch.load(os.path.join(folder, name), map_location="cpu", weights_only=False)
+            for name in sorted(os.listdir(folder)) if name.startswith("epoch")}
+
+
+@pytest.fixture(scope="module")
+def runs(tmp_path_factory):
+    """ The same training run uninterrupted, and stopped mid-epoch then resumed with --resume auto """
+    folder = tmp_path_factory.mktemp("train")
+    data_jsonl, split_json = str(folder / "synthetic.jsonl"), str(folder / "split.json")
+    _run("synthetic.py", "--num", "12", "--output", data_jsonl, "--split_json", split_json, "--split", "8", "2", "2",
+         "--length_distribution", "uniform", "--min_length", "30", "--max_length", "60")
+    data_args = ["--data_jsonl", data_jsonl, "--split_json", split_json]
+    full, resumed = str(folder / "full"), str(folder / "resumed")
+    _run("train_s2s.py", *TRAIN_ARGS, *data_args, "--output_folder", full)
+    _run("train_s2s.py", *TRAIN_ARGS, *data_args, "--output_folder", resumed, "--max_steps", "2")
+    interrupted = torch.load(os.path.join(resumed, "checkpoints", "resume.pt"), map_location="cpu", weights_only=False)
+    _run("train_s2s.py", *TRAIN_ARGS, *data_args, "--output_folder", resumed, "--resume", "auto")
+    return full, resumed, interrupted
+
+
+def test_resume_reproduces_uninterrupted_run(runs):
+    """ RNG states, the batch offset in the epoch and the optimizer / scheduler states are all restored """
+    full, resumed, interrupted = runs
+    # stopped inside the first epoch, with batches of it left
+    assert interrupted["position"] == (0, 2) and interrupted["step"] == 2
+    expected, checkpoints = _checkpoints(full), _checkpoints(resumed)
+    assert list(checkpoints) == list(expected) and len(expected) == 2
+    assert expected[list(expected)[0]]["step"] > interrupted["step"]
+    for name, state in checkpoints.items():
+        torch.testing.assert_close(state["model_state_dict"], expected[name]["model_state_dict"], rtol=0, atol=0)
+        torch.testing.assert_close(state["optimizer_state_dict"], expected[name]["optimizer_state_dict"], rtol=0, atol=0)
+        assert state["scheduler_state_dict"] == expected[name]["scheduler_state_dict"]
+        assert state["step"] == expected[name]["step"]
+        for key in ("train", "validation"):
+            assert state["history"][key] == expected[name]["history"][key]
+
+
+def test_training_state_round_trip(runs):
+    """ training_state() checkpoints, mid-epoch and at the end of an epoch, load back with utils.load_checkpoint """
+    full, _, interrupted = runs
+    assert interrupted["rank_states"][0]["numpy"] is not None and interrupted["rank_states"][0]["train_metrics"] is not None
+    name, state = list(_checkpoints(full).items())[-1]
+    hyperparams = state["hyperparams"]
+    model = struct2seq.TMPNN(device=torch.device("cpu"), num_tags=hyperparams["num_tags"], ipa_layer=hyperparams["ipa_layer"],
+                             num_encoder_layers=hyperparams["encoder_layer"], num_decoder_layers=hyperparams["decoder_layer"])
+    utils.load_checkpoint(os.path.join(full, "checkpoints", name), model)
+    torch.testing.assert_close(model.state_dict(), state["model_state_dict"], rtol=0, atol=0)
@@ -3,12 +3,16 @@ import time
 import os
 import sys
 import shutil
+import random
+import contextlib
 from argparse import ArgumentParser
 
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.data import DataLoader
 from torch.utils.data.dataset import Subset
 
@@ -17,8 +21,27 @@ import struct2seq
 import data
 import utils
 import noam_opt
+import metrics
+import checkpoint
 
 
+class TrainingModule(nn.Module):
+    """
+    TMPNN forward and the CRF loss of the cctop head in one forward pass
+    DDP only tracks the parameters used inside the forward of the module it wraps, the CRF transitions
+    must not get their gradients from a call on the bare model outside of it
+    """
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, X, S, S_mask, lengths, mask, C, device=None):
+        log_probs_seq, logits_cctop = self.model(X, S, S_mask, lengths, mask, device=device)
+        # losses are computed in float32
+        log_probs_seq, logits_cctop = log_probs_seq.float(), logits_cctop.float()
+        loss_crf = self.model.neg_loss_crf(logits_cctop, C, mask)
+        return log_probs_seq, logits_cctop, loss_crf
+
 
 # 0.1 noise
 # 0.2*cctop(CRF loss, no smoothing) + recovery(smoothing 0.1)
@@ -44,6 +67,19 @@ parser.add_argument('--max_length',type=int,default=1300,help="max length of the
 parser.add_argument('--ipa_layer',type=int,default=3,help="ipa layers in the middle blocks")
 parser.add_argument('--encoder_layer',type=int,default=3,help="encoder layers")
 parser.add_argument('--decoder_layer',type=int,default=3,help="decoder layers")
+parser.add_argument('--checkpoint_encoder',type=int,default=0,help="activation checkpointing on every N-th encoder layer, 0 disables")
+parser.add_argument('--checkpoint_ipa',type=int,default=0,help="activation checkpointing on every N-th ipa layer, 0 disables")
+parser.add_argument('--checkpoint_decoder',type=int,default=0,help="activation checkpointing on every N-th decoder layer, 0 disables")
+parser.add_argument('--amp',type=str,default="none",choices=["none","bf16","fp16"],help="autocast precision, fp16 uses loss scaling and needs cuda")
+parser.add_argument('--metrics_backend',type=str,nargs='+',default=["local"],choices=["local","wandb"],help="metrics sinks, local appends to output_folder/metrics.jsonl")
+parser.add_argument('--tokens_per_step',type=int,default=0,help="accumulate gradients over batches until this many residues per optimizer step, 0 is one batch per step")
+parser.add_argument('--dist_backend',type=str,default=None,choices=["nccl","gloo"],help="process group backend under torchrun, default nccl on cuda and gloo on cpu")
+parser.add_argument('--keep_checkpoints',type=int,default=3,help="keep the best N checkpoints by validation perplexity plus the latest one")
+parser.add_argument('--seed',type=int,default=0,help="seed of the batch order, dropout and noise")
+parser.add_argument('--resume',type=str,default=None,help="checkpoint to resume from, auto picks the most recent one of output_folder/checkpoints")
+parser.add_argument('--save_every',type=int,default=0,help="write checkpoints/resume.pt every N optimizer steps, 0 only saves at the end of an epoch")
+parser.add_argument('--max_steps',type=int,default=0,help="stop after N optimizer steps in total, writing checkpoints/resume.pt to continue with --resume auto, 0 trains all epochs")
+parser.add_argument('--log_every',type=int,default=50,help="average the training metrics over N steps before logging them")
 
 
 
@@ -51,10 +87,27 @@ parser.add_argument('--decoder_layer',type=int,default=3,help="decoder layers")
 
 args = parser.parse_args()
 
-if not os.path.exists(args.output_folder):
-    os.makedirs(args.output_folder)
-if not os.path.exists(os.path.join(args.output_folder,"checkpoints")):
-    os.makedirs(os.path.join(args.output_folder,"checkpoints"))
+# Distributed data parallel : torchrun --nproc_per_node N train_s2s.py ... sets RANK / WORLD_SIZE / LOCAL_RANK
+world_size = int(os.environ.get("WORLD_SIZE", 1))
+rank = int(os.environ.get("RANK", 0))
+local_rank = int(os.environ.get("LOCAL_RANK", 0))
+distributed = world_size > 1
+if torch.cuda.is_available():
+    device = torch.device("cuda", local_rank)
+    torch.cuda.set_device(device)
+else:
+    device = torch.device("cpu")
+if distributed:
+    dist.init_process_group(backend=args.dist_backend or ("nccl" if device.type == "cuda" else "gloo"))
+# only rank 0 writes logs and checkpoints
+is_main = rank == 0
+
+os.makedirs(os.path.join(args.output_folder,"checkpoints"), exist_ok=True)
+resume_path = checkpoint.find_resume(os.path.join(args.output_folder,"checkpoints")) if args.resume == "auto" else args.resume
+
+random.seed(args.seed + rank)
+np.random.seed(args.seed + rank)
+torch.manual_seed(args.seed + rank)
 
 # Load the data
 print("start loading parameters...")
@@ -76,36 +129,96 @@ train_set, validation_set, test_set = [
 
 
 
-loader_train, loader_validation, loader_test = [data.StructureTokenloader(d, batch_size=args.batch_size) for d in [train_set, validation_set, test_set]]
+# every rank gets its own share of the token batches
+loader_train, loader_validation, loader_test = [data.StructureTokenloader(d, batch_size=args.batch_size, num_replicas=world_size, rank=rank, seed=args.seed) for d in [train_set, validation_set, test_set]]
 
-with open(os.path.join(args.output_folder,"log_all.txt"),"a") as f:
-    f.write(f'Training:{len(train_set)}, Validation:{len(validation_set)}, Test:{len(test_set)}\n')
-# print(f'Training:{len(train_set)}, Validation:{len(validation_set)}, Test:{len(test_set)}')
-
-# Log files
+# log_all.txt is written from a background thread, metrics stay on device until they are logged
 logfile = os.path.join(args.output_folder,"log.txt")
-with open(logfile,"w") as f:
-    f.write("Epoch,Train,Validation\n")
+if is_main:
+    log_writer = metrics.BufferedWriter(os.path.join(args.output_folder,"log_all.txt"))
+    log_writer.write(f'Training:{len(train_set)}, Validation:{len(validation_set)}, Test:{len(test_set)}\n')
+    # print(f'Training:{len(train_set)}, Validation:{len(validation_set)}, Test:{len(test_set)}')
+
+    # Log files
+    if resume_path is None:
+        with open(logfile,"w") as f:
+            f.write("Epoch,Train,Validation\n")
 # Training Epochs (Training + Validation + Save model)
 start_train = time.time()
 epoch_losses_train, epoch_losses_valid = [], []
 epoch_checkpoints = []
+# checkpoints are written from a background thread, old ones are pruned as training goes
+if is_main:
+    checkpoint_writer = checkpoint.AsyncCheckpointWriter(os.path.join(args.output_folder,"checkpoints"), keep=max(1, args.keep_checkpoints))
 total_step = 0
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-model = struct2seq.TMPNN(device=device,noise_2D=args.noise_2D,noise_3D=args.noise_3D,ipa_layer=args.ipa_layer,num_tags=args.num_tags,num_encoder_layers=args.encoder_layer,num_decoder_layers=args.decoder_layer)
+model = struct2seq.TMPNN(device=device,noise_2D=args.noise_2D,noise_3D=args.noise_3D,ipa_layer=args.ipa_layer,num_tags=args.num_tags,num_encoder_layers=args.encoder_layer,num_decoder_layers=args.decoder_layer,
+                         checkpoint_encoder=args.checkpoint_encoder,checkpoint_ipa=args.checkpoint_ipa,checkpoint_decoder=args.checkpoint_decoder)
 model = model.to(device)
+# the unused W_cctop / merge_seq weights are kept for checkpoint compatibility, hence find_unused_parameters
+ddp_model = DistributedDataParallel(TrainingModule(model), device_ids=[local_rank] if device.type == "cuda" else None, find_unused_parameters=True) if distributed else TrainingModule(model)
 optimizer,schuduler = noam_opt.transformer_optim_setup(model.parameters(),128)
 
+# Mixed precision : bf16 on cpu, fp16 (with loss scaling) or bf16 on cuda
+amp_dtype = {"none":None,"bf16":torch.bfloat16,"fp16":torch.float16}[args.amp]
+if amp_dtype == torch.float16 and device.type != "cuda":
+    print("fp16 autocast needs cuda, use bf16 instead")
+    amp_dtype = torch.bfloat16
+scaler = torch.cuda.amp.GradScaler(enabled=(amp_dtype == torch.float16))
+
+def training_state(position, train_metrics=None, step_metrics=None):
+    """
+    Everything needed to continue training from the next batch, a collective call under DDP
+    position : (epoch, batches of the epoch already done)
+    """
+    rank_state = {
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+        'numpy': np.random.get_state(),
+        'random': random.getstate(),
+        'train_metrics': checkpoint.snapshot(train_metrics.state_dict()) if train_metrics is not None else None,
+        'step_metrics': checkpoint.snapshot(step_metrics.state_dict()) if step_metrics is not None else None,
+    }
+    rank_states = [rank_state]
+    if distributed:
+        rank_states = [None] * world_size
+        dist.all_gather_object(rank_states, rank_state)
+    return {
+        'epoch': position[0] - 1 if position[1] == 0 else position[0],
+        'position': position,
+        'hyperparams': vars(args),
+        'model_state_dict': model.state_dict(),
+        'optimizer_state_dict': optimizer.state_dict(),
+        'scheduler_state_dict':schuduler.state_dict(),
+        'scaler_state_dict':scaler.state_dict(),
+        'step':total_step,
+        'history': {'train': epoch_losses_train, 'validation': epoch_losses_valid, 'checkpoints': epoch_checkpoints},
+        'rank_states': rank_states
+    }
+
+# Resume from the exact next batch
+start_epoch, start_batch, resume_state = 0, 0, None
+if resume_path is not None:
+    print(f"resume from {resume_path}")
+    # the checkpoint pickles the python / numpy RNG states, which weights_only loading (default since torch 2.6) rejects
+    resume_state = torch.load(resume_path, map_location="cpu", weights_only=False)
+    model.load_state_dict(resume_state['model_state_dict'])
+    optimizer.load_state_dict(resume_state['optimizer_state_dict'])
+    schuduler.load_state_dict(resume_state['scheduler_state_dict'])
+    scaler.load_state_dict(resume_state['scaler_state_dict'])
+    total_step = resume_state['step']
+    start_epoch, start_batch = resume_state['position']
+    epoch_losses_train = resume_state['history']['train']
+    epoch_losses_valid = resume_state['history']['validation']
+    epoch_checkpoints = resume_state['history']['checkpoints']
+
 start_time = time.time()
 
 print("start training...")
-import wandb
 # from torch.utils.tensorboard import SummaryWriter
 # writer = SummaryWriter()
 # wandb.init(project='tmpnn-ipa-v2.0', sync_tensorboard=True)
-wandb.init(project=args.job_name)
-wandb.config = {
+config = {
   "epochs": args.epochs,
   "batch_size": args.batch_size,
   "mask":args.mask,
@@ -115,70 +228,144 @@ wandb.config = {
   "num_tags":args.num_tags,
   "ipa_layer":args.ipa_layer,
   "encoder_layer":args.encoder_layer,
-  "decoder_layer":args.decoder_layer
+  "decoder_layer":args.decoder_layer,
+  "checkpoint_encoder":args.checkpoint_encoder,
+  "checkpoint_ipa":args.checkpoint_ipa,
+  "checkpoint_decoder":args.checkpoint_decoder,
+  "amp":args.amp,
+  "log_every":args.log_every,
+  "tokens_per_step":args.tokens_per_step,
+  "keep_checkpoints":args.keep_checkpoints,
+  "seed":args.seed
 }
-for e in range(args.epochs):
+# wandb is optional, the local backend works on air-gapped nodes (plot with plot_metrics.py)
+metrics_logger = metrics.metrics_logger(args.metrics_backend if is_main else [], args.output_folder, project=args.job_name, config=config)
+def log_steps(step_metrics, e, train_i, lr):
+    """ Log the training metrics averaged since the last call, one device to host copy """
+    m = step_metrics.flush(distributed=distributed)
+    if not m or not is_main:
+        return
+    log_writer.write(f"|\tEpoch {e}\t|\tIteration {train_i}\t|\tPPL {np.exp(m['nll']) :.3f}\t|\tPPL_sm {np.exp(m['nll_smoothed']) :.3f}|\tAcc{m['acc'] :.4f}|\n")
+
+    # tensorboard visualization - for training
+    # writer.add_scalar('PPL/train', np.exp(m['nll_smoothed']), total_step)
+    # writer.add_scalar('Acc/train', m['acc'], total_step)
+
+    metrics_logger.log({'epoch': e, 'step': total_step, 'Loss': m['loss'], 'PPL': np.exp(m['nll_smoothed']),"Acc/train": m['acc'] ,"lr":lr})
+
+# every rank has the same number of token batches, under DDP they accumulate a fixed number of them per step
+num_batches = max(1, -(-args.tokens_per_step // (args.batch_size * world_size))) if distributed else None
+
+if resume_state is not None:
+    # random states of this rank at the saved step, restored last since building the model consumes them
+    rank_state = resume_state['rank_states'][rank % len(resume_state['rank_states'])]
+    torch.set_rng_state(rank_state['torch'])
+    if torch.cuda.is_available() and rank_state['cuda'] is not None:
+        torch.cuda.set_rng_state_all(rank_state['cuda'])
+    np.random.set_state(rank_state['numpy'])
+    random.setstate(rank_state['random'])
+
+lr, train_i = schuduler.get_last_lr()[0], 0
+for e in range(start_epoch, args.epochs):
     # Training epoch
     model.train()
-    train_sum, train_weights = 0., 0.
-    cctop_train_sum = 0.
-    for train_i, batch in enumerate(loader_train):
+    batches_done = start_batch if e == start_epoch else 0
+    # the batch order only depends on seed + epoch, a resumed epoch skips the batches already done
+    loader_train.batch_sampler.set_epoch(e, batches_done)
+    for loader in (loader_validation, loader_test):
+        loader.batch_sampler.set_epoch(e)
+    train_metrics = metrics.MetricsAccumulator()
+    step_metrics = metrics.MetricsAccumulator()
+    if batches_done > 0:
+        rank_state = resume_state['rank_states'][rank % len(resume_state['rank_states'])]
+        train_metrics.load_state_dict(rank_state['train_metrics'], device)
+        step_metrics.load_state_dict(rank_state['step_metrics'], device)
+    for train_i, micro_batches in enumerate(data.accumulate_batches(loader_train, args.tokens_per_step, num_batches)):
         start_batch = time.time()
-        # Get a batch, S_mask for the encoder module
-        for key in batch.keys():
-            batch[key] = batch[key].to(device)
-        X = batch["coord"]
-        S = batch["seq"]
-        mask = batch["mask"]
-        C = batch["cctop"]
-        lengths = batch["length"]
-        S_mask = batch["mask_seq"]
-        num_tokens = (torch.sum(lengths)).item()
-
+        # the loss of every micro batch is weighted by its share of the residues of the optimizer step
+        # (counted on the cpu before the batches are moved to the device)
+        batch_tokens = [float(torch.sum(batch["mask"])) for batch in micro_batches]
+        step_tokens = sum(batch_tokens)
+        if distributed:
+            # DDP averages the gradients of the ranks, normalize by the mean residues per rank of the step
+            step_tokens = torch.tensor(step_tokens, device=device)
+            dist.all_reduce(step_tokens)
+            step_tokens = step_tokens.item() / world_size
         optimizer.zero_grad()
-        log_probs_seq, logits_cctop = model(X, S, S_mask, lengths, mask,device=device)
-        _, loss_av_smoothed = utils.loss_smoothed(S, log_probs_seq, mask, weight=0.05,num_classes=22)
-        loss_crf = model.neg_loss_crf(logits_cctop,C,mask)
-        # _, cctop_loss_av_smoothed = utils.loss_smoothed(C, log_probs_cctop, mask, weight=0.01,num_classes=5)
-        loss_bw = 0.2 * loss_crf + loss_av_smoothed
-        loss_bw.backward()
-        optimizer.step()
-        schuduler.step()
-        lr = schuduler.get_last_lr()[0]
-
-        # writer.add_scalar('Loss', loss_bw, total_step)
-        
+        for i, (batch, tokens) in enumerate(zip(micro_batches, batch_tokens)):
+            # Get a batch, S_mask for the encoder module
+            for key in batch.keys():
+                batch[key] = batch[key].to(device)
+            X = batch["coord"]
+            S = batch["seq"]
+            mask = batch["mask"]
+            C = batch["cctop"]
+            lengths = batch["length"]
+            S_mask = batch["mask_seq"]
+            num_tokens = torch.sum(lengths)
 
-        loss, loss_av = utils.loss_nll(S, log_probs_seq, mask)
-        # crf decoder output List[List[int]] not a tensor, add the mask tensor
-        bag_list = model.decode_crf(logits_cctop,mask)
-        for i in range(len(bag_list)):
-            if len(bag_list[i]) != S.size(1):
-                bag_list[i] += [0 for _ in range(S.size(1)-len(bag_list[i]))]
-        cctop_train = torch.tensor(bag_list,dtype=torch.long,device=device)
-        acc_cctop_train = torch.sum((cctop_train == C) * mask)
-        cctop_train_sum += acc_cctop_train
+            # gradients are all-reduced on the last micro batch only
+            sync = contextlib.nullcontext() if not distributed or i == len(micro_batches) - 1 else ddp_model.no_sync()
+            with sync:
+                with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                    log_probs_seq, logits_cctop, loss_crf = ddp_model(X, S, S_mask, lengths, mask, C, device=device)
+                _, loss_av_smoothed = utils.loss_smoothed(S, log_probs_seq, mask, weight=0.05,num_classes=22)
+                # _, cctop_loss_av_smoothed = utils.loss_smoothed(C, log_probs_cctop, mask, weight=0.01,num_classes=5)
+                loss_bw = 0.2 * loss_crf + loss_av_smoothed
+                scaler.scale(loss_bw * (tokens / step_tokens)).backward()
 
-        total_step += 1
-        with open(os.path.join(args.output_folder,"log_all.txt"),"a") as f:
-            f.write(f"|\tEpoch {e}\t|\tIteration {train_i}\t|\tPPL {np.exp(loss_av.cpu().data.numpy()) :.3f}\t|\tPPL_sm {np.exp(loss_av_smoothed.cpu().data.numpy()) :.3f}|\tAcc{acc_cctop_train/num_tokens :.4f}|\n")
-        
-        # tensorboard visualization - for training
-        # writer.add_scalar('PPL/train', np.exp(loss_av_smoothed.cpu().data.numpy()), total_step)
-        # writer.add_scalar('Acc/train', acc_cctop_train/num_tokens, total_step)
+            # writer.add_scalar('Loss', loss_bw, total_step)
 
-        wandb.log({'Loss': loss_bw, 'PPL': np.exp(loss_av_smoothed.cpu().data.numpy()),"Acc/train": acc_cctop_train/num_tokens ,"lr":lr})
+            loss, loss_av = utils.loss_nll(S, log_probs_seq, mask)
+            # CRF Viterbi path [B, L] on device, padding is 0
+            cctop_train = model.decode_crf(logits_cctop,mask)
+            acc_cctop_train = torch.sum((cctop_train == C) * mask)
+
+            step_metrics.add("loss", loss_bw * torch.sum(mask), torch.sum(mask))
+            step_metrics.add("nll", loss_av * torch.sum(mask), torch.sum(mask))
+            step_metrics.add("nll_smoothed", loss_av_smoothed * torch.sum(mask), torch.sum(mask))
+            step_metrics.add("acc", acc_cctop_train, num_tokens)
+
+            # Accumulate true loss
+            train_metrics.add("loss", torch.sum(loss * mask) + loss_crf * num_tokens, torch.sum(mask))
+            train_metrics.add("acc", acc_cctop_train, torch.sum(mask))
+
+        # one optimizer (and Noam scheduler) step per accumulated step
+        scaler.step(optimizer)
+        scaler.update()
+        schuduler.step()
+        lr = schuduler.get_last_lr()[0]
 
-        # Accumulate true loss
-        train_sum += torch.sum(loss * mask).cpu().data.numpy()
-        train_sum += (loss_crf.cpu().data.numpy()) * num_tokens
-        train_weights += torch.sum(mask).cpu().data.numpy()
+        total_step += 1
+        batches_done += len(micro_batches)
+        if total_step % args.log_every == 0:
+            log_steps(step_metrics, e, train_i, lr)
+        if args.save_every > 0 and total_step % args.save_every == 0:
+            state = training_state((e, batches_done), train_metrics, step_metrics)
+            if is_main:
+                checkpoint_writer.save(state, "resume.pt", None)
+        if args.max_steps > 0 and total_step >= args.max_steps:
+            break
+
+    if args.max_steps > 0 and total_step >= args.max_steps:
+        # stop mid-epoch, --resume auto continues from the next batch
+        state = training_state((e, batches_done), train_metrics, step_metrics)
+        if is_main:
+            checkpoint_writer.save(state, "resume.pt", None)
+            checkpoint_writer.close()
+            log_writer.close()
+        metrics_logger.close()
+        if distributed:
+            dist.destroy_process_group()
+        sys.exit(0)
+
+    # the steps since the last log
+    log_steps(step_metrics, e, train_i, lr)
 
     # Validation epoch
     model.eval()
     with torch.no_grad():
-        validation_sum, validation_weights = 0., 0.
-        validation_sum_cctop = 0.
+        validation_metrics = metrics.MetricsAccumulator()
         for _, batch in enumerate(loader_validation):
             # Get a batch, S_mask for the encoder module
             for key in batch.keys():
@@ -189,61 +376,56 @@ for e in range(args.epochs):
             C = batch["cctop"]
             lengths = batch["length"]
             S_mask = batch["mask_seq"]
-            num_tokens = (torch.sum(lengths)).item()
+            num_tokens = torch.sum(lengths)
 
 
-            log_probs_seq, logits_cctop = model(X, S, S_mask, lengths, mask,device=device)
+            with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                log_probs_seq, logits_cctop = model(X, S, S_mask, lengths, mask,device=device)
+            log_probs_seq, logits_cctop = log_probs_seq.float(), logits_cctop.float()
             loss, loss_av = utils.loss_nll(S, log_probs_seq, mask)
             loss_crf = model.neg_loss_crf(logits_cctop,C,mask)
 
-            bag_list = model.decode_crf(logits_cctop,mask)
-            for i in range(len(bag_list)):
-                if len(bag_list[i]) != S.size(1):
-                    bag_list[i] += [0 for _ in range(S.size(1)-len(bag_list[i]))]
-            cctop_validation = torch.tensor(bag_list,dtype=torch.long,device=device)
+            # CRF Viterbi path [B, L] on device, padding is 0
+            cctop_validation = model.decode_crf(logits_cctop,mask)
             acc_cctop_validation = torch.sum((cctop_validation == C) * mask)
-            validation_sum_cctop += acc_cctop_validation
             # Accumulate
-            validation_sum += torch.sum(loss * mask).cpu().data.numpy()
-            validation_sum += loss_crf.cpu().data.numpy() *num_tokens
-            validation_weights += torch.sum(mask).cpu().data.numpy()
+            validation_metrics.add("loss", torch.sum(loss * mask) + loss_crf * num_tokens, torch.sum(mask))
+            validation_metrics.add("acc", acc_cctop_validation, torch.sum(mask))
 
-    train_loss = train_sum / train_weights
+    train_epoch, validation_epoch = train_metrics.flush(distributed=distributed), validation_metrics.flush(distributed=distributed)
+    train_loss = train_epoch["loss"]
     train_perplexity = np.exp(train_loss)
-    train_cctop = cctop_train_sum/train_weights
-    validation_loss = validation_sum / validation_weights
+    train_cctop = train_epoch["acc"]
+    validation_loss = validation_epoch["loss"]
     validation_perplexity = np.exp(validation_loss)
-    validation_cctop = validation_sum_cctop/validation_weights
-    with open(os.path.join(args.output_folder,"log_all.txt"),"a") as f:
-        f.write(f"Loss\tTrain {train_loss :.4f}\t\tValidation {validation_loss :.4f}\n")
-        f.write(f"Perplexity\tTrain:{train_perplexity :.4f}\t\tValidation:{validation_perplexity :.4f}\n")
-        f.write(f"Acc\tTrain:{train_cctop :.4f}\tValidation:{validation_cctop:.4f}\n")
+    validation_cctop = validation_epoch["acc"]
+    if is_main:
+        log_writer.write(f"Loss\tTrain {train_loss :.4f}\t\tValidation {validation_loss :.4f}\n")
+        log_writer.write(f"Perplexity\tTrain:{train_perplexity :.4f}\t\tValidation:{validation_perplexity :.4f}\n")
+        log_writer.write(f"Acc\tTrain:{train_cctop :.4f}\tValidation:{validation_cctop:.4f}\n")
     
     # tensorboard visualization - for training
     # writer.add_scalar('PPL-epoch/train', train_perplexity, e)
     # writer.add_scalar('Acc-epoch/train', train_cctop, e)
     # writer.add_scalar('PPL-epoch/validation', nvalidation_perplexity, e)
     # writer.add_scalar('Acc-epoch/validation', validation_cctop, e)
-    wandb.log({'PPL-epoch/train': train_perplexity, 'Acc-epoch/train': train_cctop,"PPL-epoch/validation": validation_perplexity, "Acc-epoch/validation":validation_cctop })
-
-
-    with open(logfile, 'a') as f:
-        f.write(f"{e}\t{train_perplexity}\t{validation_perplexity}\n")
+    metrics_logger.log({'epoch': e, 'step': total_step, 'Loss-epoch/train': train_loss, 'Loss-epoch/validation': validation_loss,
+                        'PPL-epoch/train': train_perplexity, 'Acc-epoch/train': train_cctop,"PPL-epoch/validation": validation_perplexity, "Acc-epoch/validation":validation_cctop })
 
     # Save the model
-    checkpoint_filename = os.path.join(args.output_folder ,'checkpoints/epoch{}_step{}.pt'.format(e+1, total_step))
-    torch.save({
-        'epoch': e,
-        'hyperparams': vars(args),
-        'model_state_dict': model.state_dict(),
-        'optimizer_state_dict': optimizer.state_dict(),
-        'scheduler_state_dict':schuduler.state_dict(),
-        'step':total_step
-    }, checkpoint_filename)
-
+    checkpoint_name = 'epoch{}_step{}.pt'.format(e+1, total_step)
+    checkpoint_filename = os.path.join(args.output_folder ,'checkpoints', checkpoint_name)
     epoch_losses_valid.append(validation_perplexity)
     epoch_losses_train.append(train_perplexity)
     epoch_checkpoints.append(checkpoint_filename)
+    state = training_state((e + 1, 0))
+    if is_main:
+        with open(logfile, 'a') as f:
+            f.write(f"{e}\t{train_perplexity}\t{validation_perplexity}\n")
+
+        # the state dicts are copied to the cpu here, torch.save runs on the writer thread
+        state['validation_perplexity'] = validation_perplexity
+        checkpoint_writer.save(state, checkpoint_name, validation_perplexity)
 
 # Determine best model via early stopping on validation
 best_model_idx = np.argmin(epoch_losses_valid).item()
@@ -251,15 +433,24 @@ best_checkpoint = epoch_checkpoints[best_model_idx]
 train_perplexity = epoch_losses_train[best_model_idx]
 validation_perplexity = epoch_losses_valid[best_model_idx]
 best_checkpoint_copy = os.path.join(args.output_folder ,'best_checkpoint_epoch{}.pt'.format(best_model_idx + 1))
-shutil.copy(best_checkpoint, best_checkpoint_copy)
+if is_main:
+    checkpoint_writer.close()
+    # the best checkpoint is always among the kept ones, link it instead of copying
+    if os.path.exists(best_checkpoint_copy):
+        os.remove(best_checkpoint_copy)
+    try:
+        os.link(best_checkpoint, best_checkpoint_copy)
+    except OSError:
+        shutil.copy(best_checkpoint, best_checkpoint_copy)
+if distributed:
+    dist.barrier()
 utils.load_checkpoint(best_checkpoint_copy, model)
 
 
 # Test epoch
 model.eval()
 with torch.no_grad():
-    test_sum, test_weights = 0., 0.
-    test_sum_cctop=0.
+    test_metrics = metrics.MetricsAccumulator()
     for _, batch in enumerate(loader_test):
         # Get a batch, S_mask for the encoder module
         for key in batch.keys():
@@ -270,28 +461,31 @@ with torch.no_grad():
         C = batch["cctop"]
         lengths = batch["length"]
         S_mask = batch["mask_seq"]
-        num_tokens = (torch.sum(lengths)).item()
-        log_probs_seq, logits_cctop = model(X, S, S_mask, lengths, mask,device=device)
+        num_tokens = torch.sum(lengths)
+        with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+            log_probs_seq, logits_cctop = model(X, S, S_mask, lengths, mask,device=device)
+        log_probs_seq, logits_cctop = log_probs_seq.float(), logits_cctop.float()
         loss, loss_av = utils.loss_nll(S, log_probs_seq, mask)
         loss_crf = model.neg_loss_crf(logits_cctop,C,mask)
         # Accumulate
-        bag_list = model.decode_crf(logits_cctop,mask)
-        for i in range(len(bag_list)):
-            if len(bag_list[i]) != S.size(1):
-                bag_list[i] += [0 for _ in range(S.size(1)-len(bag_list[i]))]
-        cctop_test = torch.tensor(bag_list,dtype=torch.long,device=device)
+        # CRF Viterbi path [B, L] on device, padding is 0
+        cctop_test = model.decode_crf(logits_cctop,mask)
         acc_cctop_test = torch.sum((cctop_test == C) * mask)
-        test_sum_cctop += acc_cctop_test
-        test_sum += torch.sum(loss * mask).cpu().data.numpy()
-        test_sum += loss_crf.cpu().data.numpy() * num_tokens
-        test_weights += torch.sum(mask).cpu().data.numpy()
+        test_metrics.add("loss", torch.sum(loss * mask) + loss_crf * num_tokens, torch.sum(mask))
+        test_metrics.add("acc", acc_cctop_test, torch.sum(mask))
 
-test_loss = test_sum / test_weights
+test_epoch = test_metrics.flush(distributed=distributed)
+test_loss = test_epoch["loss"]
 test_perplexity = np.exp(test_loss)
-test_cctop = test_sum_cctop / test_weights
-with open(os.path.join(args.output_folder,"log_all.txt"),"a") as f:
-    f.write(f"Perplexity\tTest:{test_perplexity :.3f}\tAccuracy\t{test_cctop :.3f}\n")
-# print('Perplexity\tTest:{}'.format(test_perplexity))
-
-with open(os.path.join(args.output_folder,"result.txt"), 'w') as f:
-    f.write(f'Best epoch: {best_model_idx+1}\nPerplexities:\n\tTrain: {train_perplexity}\n\tValidation: {validation_perplexity}\n\tTest: {test_perplexity},{test_cctop}')
+test_cctop = test_epoch["acc"]
+metrics_logger.log({'step': total_step, 'PPL/test': test_perplexity, 'Acc/test': test_cctop})
+metrics_logger.close()
+if is_main:
+    log_writer.write(f"Perplexity\tTest:{test_perplexity :.3f}\tAccuracy\t{test_cctop :.3f}\n")
+    log_writer.close()
+    # print('Perplexity\tTest:{}'.format(test_perplexity))
+
+    with open(os.path.join(args.output_folder,"result.txt"), 'w') as f:
+        f.write(f'Best epoch: {best_model_idx+1}\nPerplexities:\n\tTrain: {train_perplexity}\n\tValidation: {validation_perplexity}\n\tTest: {test_perplexity},{test_cctop}')
+if distributed:
+    dist.destroy_process_group()
@@ -1,4 +1,3 @@
-from symbol import atom
 import os
 import numpy as np
 from Bio.PDB import *
@@ -357,7 +356,8 @@ def backbone_select(pdb_structure: Union[str, Bio.PDB.Structure.Structure], outp
 
 def load_checkpoint(checkpoint_path, model,device="cpu"):
     print('Loading checkpoint from {}'.format(checkpoint_path))
-    state_dicts = torch.load(checkpoint_path, map_location=device)
+    # training checkpoints pickle the python / numpy RNG states and numpy floats, which weights_only loading rejects
+    state_dicts = torch.load(checkpoint_path, map_location=device, weights_only=False)
     model.load_state_dict(state_dicts['model_state_dict'])
     print('\tEpoch {}'.format(state_dicts['epoch']))
     return